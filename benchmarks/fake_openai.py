@@ -0,0 +1,225 @@
+"""
+Offline stand-in for the OpenAI endpoints the app calls, for load tests.
+
+    python benchmarks/fake_openai.py --port 8001 --chat-latency lognormal:800,0.5 --embedding-latency normal:120,30
+
+and start the app with OPENAI_API_BASE=http://127.0.0.1:8001/v1, any org openai key works.
+
+- POST /v1/chat/completions: answers the detect_languages function call, or a
+  canned answer, streamed token by token with stream=true
+- POST /v1/embeddings: deterministic unit vectors, the same text always gets
+  the same vector
+
+Latencies are distributions in milliseconds: fixed:MS, uniform:LOW,HIGH,
+normal:MEAN,STD or lognormal:MEDIAN,SIGMA.
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from typing import Callable
+
+import numpy as np
+from aiohttp import web
+
+EMBEDDING_DIMENSIONS = 1536
+
+ANSWER = (
+    "Thank you for your question. Based on the documents, here is what you "
+    "should know. Please talk to a health worker near you if it does not get better."
+)
+
+
+def latency_distribution(spec: str, seed: int = 0) -> Callable[[], float]:
+    """
+    Returns a function sampling a latency in seconds from e.g. "lognormal:800,0.5"
+    """
+    rng = np.random.default_rng(seed)
+    name, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+
+    if name == "fixed":
+        sample = lambda: values[0]
+    elif name == "uniform":
+        sample = lambda: rng.uniform(values[0], values[1])
+    elif name == "normal":
+        sample = lambda: rng.normal(values[0], values[1])
+    elif name == "lognormal":
+        sample = lambda: values[0] * rng.lognormal(0, values[1])
+    else:
+        raise ValueError(f"Unknown latency distribution {spec}")
+
+    return lambda: max(sample(), 0) / 1000
+
+
+def vector_for(text: str) -> list[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def count_tokens(text: str) -> int:
+    # close enough for usage numbers, avoids needing the tiktoken files offline
+    return max(1, len(text) // 4)
+
+
+def detect_languages_message(messages: list[dict]) -> dict:
+    question = messages[-1]["content"].split(": ", 1)[-1]
+    arguments = {
+        "language": "English",
+        "confidence": 0.99,
+        "english_translation": question,
+        "translation_confidence": 0.99,
+    }
+    return {
+        "role": "assistant",
+        "content": None,
+        "function_call": {
+            "name": "detect_languages",
+            "arguments": json.dumps(arguments),
+        },
+    }
+
+
+def answer_message(messages: list[dict]) -> dict:
+    # evaluator prompts are a lone system message and expect a score
+    if len(messages) == 1 and messages[0]["role"] == "system":
+        return {"role": "assistant", "content": "4"}
+    return {"role": "assistant", "content": ANSWER}
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        chat_latency: Callable[[], float],
+        embedding_latency: Callable[[], float],
+        token_interval: float,
+    ):
+        self.chat_latency = chat_latency
+        self.embedding_latency = embedding_latency
+        self.token_interval = token_interval
+        self.requests = {"chat": 0, "embeddings": 0}
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests["chat"] += 1
+        body = await request.json()
+        messages = body["messages"]
+
+        message = (
+            detect_languages_message(messages)
+            if body.get("functions")
+            else answer_message(messages)
+        )
+        prompt_tokens = sum(count_tokens(m["content"] or "") for m in messages)
+        completion_tokens = count_tokens(
+            message["content"] or message.get("function_call", {}).get("arguments", "")
+        )
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.chat_latency())
+            return web.json_response(
+                {
+                    "id": f"chatcmpl-{created}",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": body["model"],
+                    "choices": [
+                        {"index": 0, "message": message, "finish_reason": "stop"}
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                }
+            )
+
+        # the sampled latency is the time to the first token
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(self.chat_latency())
+
+        def chunk(delta: dict, finish_reason=None) -> bytes:
+            data = {
+                "id": f"chatcmpl-{created}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body["model"],
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        await response.write(chunk({"role": "assistant"}))
+        for word in (message["content"] or "").split(" "):
+            await response.write(chunk({"content": word + " "}))
+            await asyncio.sleep(self.token_interval)
+        await response.write(chunk({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.requests["embeddings"] += 1
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+
+        await asyncio.sleep(self.embedding_latency())
+
+        tokens = sum(count_tokens(text) for text in inputs)
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": vector_for(text),
+                    }
+                    for index, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--chat-latency", default="lognormal:800,0.4")
+    parser.add_argument("--embedding-latency", default="normal:150,40")
+    parser.add_argument(
+        "--token-interval-ms",
+        type=float,
+        default=20,
+        help="delay between streamed tokens",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake_openai = FakeOpenAI(
+        latency_distribution(args.chat_latency, args.seed),
+        latency_distribution(args.embedding_latency, args.seed + 1),
+        args.token_interval_ms / 1000,
+    )
+    web.run_app(fake_openai.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Load test of /api/chat and /api/upload, reporting throughput and latency
+percentiles per endpoint.
+
+    python benchmarks/load_test.py --api-key sk_ABC123 --concurrency 16 --requests 500 --upload-ratio 0.05
+
+Point the server at benchmarks/fake_openai.py (OPENAI_API_BASE) to run it offline.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+import aiohttp
+import numpy as np
+
+QUESTIONS = [
+    "What is HIV?",
+    "How is HIV transmitted?",
+    "What are the symptoms of anxiety?",
+    "How can I manage stress at home?",
+    "Is it normal to have irregular periods?",
+    "How often should I change a sanitary pad?",
+    "What should I eat during pregnancy?",
+    "How do I dispose of sanitary waste safely?",
+    "What are the signs of depression?",
+    "Peshab ki jagah se kharash ho rahi hai",
+    "Mahavari ke dauran dard kam kaise karein?",
+    "When should I see a doctor for period pain?",
+]
+
+DEFAULT_PDFS = os.path.join(
+    os.path.dirname(__file__), "..", "llm", "data", "sources", "*.pdf"
+)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint: str, seconds: float, error: str = None) -> None:
+        if error is None:
+            self.latencies[endpoint].append(seconds)
+        else:
+            self.errors[endpoint][error] += 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = sorted(set(self.latencies) | set(self.errors))
+        report = {"elapsed_seconds": round(elapsed, 3), "endpoints": {}}
+        for endpoint in endpoints:
+            latencies = np.asarray(self.latencies[endpoint]) * 1000
+            errors = sum(self.errors[endpoint].values())
+            report["endpoints"][endpoint] = {
+                "requests": len(latencies) + errors,
+                "errors": dict(self.errors[endpoint]),
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                **(
+                    {
+                        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+                        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+                        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+                        "mean_ms": round(float(latencies.mean()), 1),
+                        "max_ms": round(float(latencies.max()), 1),
+                    }
+                    if len(latencies)
+                    else {}
+                ),
+            }
+        return report
+
+
+async def timed_request(
+    recorder: Recorder, endpoint: str, request, expected_status: int
+) -> dict:
+    start = time.perf_counter()
+    try:
+        async with request() as response:
+            body = await response.json(content_type=None)
+            if response.status != expected_status:
+                recorder.record(endpoint, 0, f"HTTP {response.status}")
+                return {}
+            recorder.record(endpoint, time.perf_counter() - start)
+            return body
+    except Exception as error:
+        recorder.record(endpoint, 0, type(error).__name__)
+        return {}
+
+
+async def chat(session, args, recorder: Recorder, session_ids: list) -> None:
+    data = {"question": random.choice(QUESTIONS)}
+    if args.category_id:
+        data["category_id"] = args.category_id
+    if args.evaluate:
+        data["evaluate"] = args.evaluate
+    # continue an earlier conversation some of the time, so history is loaded too
+    if session_ids and random.random() < args.followup_ratio:
+        data["session_id"] = random.choice(session_ids)
+
+    body = await timed_request(
+        recorder,
+        args.chat_path,
+        lambda: session.post(f"{args.base_url}{args.chat_path}", json=data),
+        201,
+    )
+    if body.get("session_id"):
+        session_ids.append(body["session_id"])
+
+
+async def upload(session, args, recorder: Recorder, pdfs: list, job_ids: list) -> None:
+    path = random.choice(pdfs)
+    # read up front, the request is only sent once timed_request awaits it
+    with open(path, "rb") as file:
+        payload = file.read()
+
+    def request():
+        form = aiohttp.FormData()
+        form.add_field("file", payload, filename=os.path.basename(path))
+        form.add_field("category_id", str(args.category_id))
+        return session.post(f"{args.base_url}/api/upload", data=form)
+
+    body = await timed_request(recorder, "/api/upload", request, 202)
+    if body.get("job_id"):
+        job_ids.append(body["job_id"])
+
+
+async def wait_for_ingestion(session, args, job_ids: list) -> dict:
+    """
+    Polls the upload jobs until they finish, returns their status counts and
+    the ingestion time of the completed ones
+    """
+    pending, finished = set(job_ids), {}
+    while pending:
+        for job_id in list(pending):
+            async with session.get(f"{args.base_url}/api/upload/{job_id}") as response:
+                job = await response.json(content_type=None)
+            if job.get("status") in ("completed", "failed"):
+                finished[job_id] = job
+                pending.discard(job_id)
+        if pending:
+            await asyncio.sleep(1)
+
+    seconds = [
+        job["pages_processed"] / job["pages_per_second"]
+        for job in finished.values()
+        if job["status"] == "completed" and job.get("pages_per_second")
+    ]
+    statuses = defaultdict(int)
+    for job in finished.values():
+        statuses[job["status"]] += 1
+    return {
+        "jobs": dict(statuses),
+        "p50_seconds": round(float(np.percentile(seconds, 50)), 2) if seconds else None,
+        "p95_seconds": round(float(np.percentile(seconds, 95)), 2) if seconds else None,
+    }
+
+
+async def setup(session, args) -> None:
+    if args.openai_key:
+        async with session.post(
+            f"{args.base_url}/api/openai_key", json={"key": args.openai_key}
+        ) as response:
+            response.raise_for_status()
+    if not args.category_id:
+        async with session.post(
+            f"{args.base_url}/api/knowledge/category",
+            json={"name": f"load test {int(time.time())}"},
+        ) as response:
+            args.category_id = (await response.json(content_type=None))["id"]
+
+
+async def run(args) -> dict:
+    recorder = Recorder()
+    pdfs = glob.glob(args.pdfs)
+    if args.upload_ratio and not pdfs:
+        sys.exit(f"No PDFs match {args.pdfs}")
+
+    session_ids, job_ids = [], []
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"Authorization": args.api_key},
+    ) as session:
+        await setup(session, args)
+
+        remaining = args.requests
+        deadline = time.perf_counter() + args.duration if args.duration else None
+
+        def next_request() -> bool:
+            nonlocal remaining
+            if deadline is not None:
+                return time.perf_counter() < deadline
+            remaining -= 1
+            return remaining >= 0
+
+        async def user():
+            while next_request():
+                if random.random() < args.upload_ratio:
+                    await upload(session, args, recorder, pdfs, job_ids)
+                else:
+                    await chat(session, args, recorder, session_ids)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[user() for _ in range(args.concurrency)])
+        report = recorder.report(time.perf_counter() - start)
+
+        if args.wait_ingestion and job_ids:
+            report["ingestion"] = await wait_for_ingestion(session, args, job_ids)
+
+    report["config"] = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "duration": args.duration,
+        "upload_ratio": args.upload_ratio,
+        "followup_ratio": args.followup_ratio,
+        "chat_path": args.chat_path,
+        "evaluate": args.evaluate,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--api-key", required=True, help="the org's api key")
+    parser.add_argument(
+        "--openai-key", help="set this as the org's openai key before starting"
+    )
+    parser.add_argument(
+        "--category-id",
+        type=int,
+        help="knowledge category to chat with and upload to, created if left out",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--duration", type=float, help="run for this many seconds instead"
+    )
+    parser.add_argument("--upload-ratio", type=float, default=0.0)
+    parser.add_argument("--followup-ratio", type=float, default=0.3)
+    parser.add_argument(
+        "--chat-path",
+        default="/api/chat",
+        help="/api/chat or /api/chat/async",
+    )
+    parser.add_argument("--evaluate", choices=["true", "deferred"])
+    parser.add_argument("--pdfs", default=DEFAULT_PDFS, help="glob of PDFs to upload")
+    parser.add_argument(
+        "--wait-ingestion",
+        action="store_true",
+        help="wait for the uploads to be ingested and report how long it took",
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this json file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,814 @@
+"""
+Retrieval micro-benchmark: latency, recall@k and memory of each retrieval
+backend over synthetic corpora.
+
+    python benchmarks/retrieval_benchmark.py --sizes 10000 100000 1000000 --output retrieval.json
+    python benchmarks/retrieval_benchmark.py --sizes 10000 --compare retrieval.json
+
+The corpora are clustered unit vectors spread over many orgs (a few large ones,
+a long tail of small ones) and knowledge categories. Queries are perturbed
+corpus vectors, searched within their org or within their category, the way
+/api/chat does with and without a category_id. Recall is measured against an
+exact search of the same scope.
+
+Backends, all going through the app's retrieval functions except numpy:
+
+- pg_exact: the L2Distance query with index scans disabled, a full scan of the scope
+- pg_hnsw: the same query on the HNSW index, for each --ef-search
+- pg_ivfflat: the same query on an IVFFlat index, for each --probes
+- pg_halfvec: the half precision HNSW index, re-ranked at full precision,
+  for each --rerank-candidates
+- pg_binary: the same on the binary quantized HNSW index (hamming distance)
+- faiss: the per worker flat FAISS indexes of the faiss backend
+- snapshot: the memory mapped NumPy snapshots of the snapshot backend
+- numpy: brute force over in-memory matrices of each scope
+
+memory_bytes is the size of what each backend searches: the table for
+pg_exact, the index for pg_hnsw, pg_ivfflat, pg_halfvec and pg_binary, the
+vectors held in the worker for faiss and numpy, the snapshot files (shared by
+the workers through the page cache) for snapshot. Compare pg_halfvec and
+pg_binary with pg_hnsw for the recall given up for a smaller index.
+
+Runs in a test database (test_<DB_NAME>) created and dropped next to the
+configured one, use --keepdb to keep the last corpus between runs. The 1M
+corpus needs about 8GB of memory and 15GB of disk, and building its HNSW
+index takes a long time.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llm.settings")
+
+import django
+
+django.setup()
+
+import faiss
+from django.db import connection, transaction
+from pgvector.psycopg import register_vector
+
+from llm.models import Organization, KnowledgeCategory, File, Embedding
+from llm.utils import faiss_store, snapshot_store
+from llm.utils.retrieval import (
+    pgvector_embeddings,
+    compact_embeddings,
+    vector_index,
+    VECTOR_INDEX_PARAMS,
+    faiss_embeddings,
+    snapshot_embeddings,
+)
+
+EMBEDDING_DIMENSIONS = 1536
+HNSW_INDEX = "embedding_vectors_l2_idx"
+ANN_INDEXES = [
+    "embedding_vectors_l2_idx",
+    "embedding_vectors_cosine_idx",
+    "embedding_vectors_ip_idx",
+    "embedding_vectors_l2_halfvec_idx",
+    "embedding_vectors_cosine_halfvec_idx",
+    "embedding_vectors_ip_halfvec_idx",
+    "embedding_vectors_binary_idx",
+]
+IVFFLAT_INDEX = "embedding_vectors_l2_ivfflat_bench_idx"
+
+
+class Corpus:
+    """
+    Synthetic chunk vectors with the org and category of each row. Row i is
+    stored with id i + 1.
+    """
+
+    def __init__(self, size: int, orgs: int, categories: int, seed: int):
+        self.size = size
+        self.orgs = orgs
+        self.categories = categories
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        # a few large orgs and a long tail of small ones
+        org_weights = 1 / np.arange(1, orgs + 1) ** 1.1
+        self.row_org = rng.choice(orgs, size=size, p=org_weights / org_weights.sum())
+        category_weights = rng.dirichlet(np.ones(categories), size=orgs)
+        self.row_category = np.empty(size, dtype=np.int64)
+        for org in range(orgs):
+            rows = np.flatnonzero(self.row_org == org)
+            self.row_category[rows] = rng.choice(
+                categories, size=len(rows), p=category_weights[org]
+            )
+
+        # each category's chunks cluster around a few topics, like the chunks
+        # of related documents
+        topics_per_category = 8
+        topics = normalize(
+            rng.standard_normal(
+                (orgs * categories * topics_per_category, EMBEDDING_DIMENSIONS),
+                dtype=np.float32,
+            )
+        )
+        row_topic = (
+            self.row_org * categories + self.row_category
+        ) * topics_per_category + rng.integers(topics_per_category, size=size)
+
+        self.vectors = np.empty((size, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        for start in range(0, size, 100000):
+            end = min(start + 100000, size)
+            noise = rng.standard_normal(
+                (end - start, EMBEDDING_DIMENSIONS), dtype=np.float32
+            )
+            self.vectors[start:end] = normalize(
+                topics[row_topic[start:end]]
+                + noise * (0.8 / EMBEDDING_DIMENSIONS**0.5)
+            )
+
+    @property
+    def tag(self) -> str:
+        return f"bench size={self.size} orgs={self.orgs} categories={self.categories} seed={self.seed}"
+
+    def scope_rows(self, org: int, category=None) -> np.ndarray:
+        mask = self.row_org == org
+        if category is not None:
+            mask &= self.row_category == category
+        return np.flatnonzero(mask)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def execute(sql: str, params=None) -> list:
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall() if cursor.description else []
+
+
+def corpus_loaded(corpus: Corpus) -> bool:
+    return (
+        Organization.objects.filter(name__startswith=corpus.tag).count() == corpus.orgs
+        and Embedding.objects.count() == corpus.size
+        and bool(execute("SELECT to_regclass(%s)", [HNSW_INDEX])[0][0])
+    )
+
+
+def load_corpus(corpus: Corpus, text_chars: int, maintenance_work_mem: str) -> dict:
+    """
+    Replaces the tables' content with the corpus and builds the l2 HNSW index
+    once the rows are in, which is much faster than inserting into it
+    """
+    execute("TRUNCATE organization, embedding RESTART IDENTITY CASCADE")
+    for index in ANN_INDEXES + [IVFFLAT_INDEX]:
+        execute(f"DROP INDEX IF EXISTS {index}")
+
+    organizations = Organization.objects.bulk_create(
+        [
+            Organization(
+                name=f"{corpus.tag} {org}",
+                api_key=f"{corpus.tag} {org}",
+                system_prompt="",
+            )
+            for org in range(corpus.orgs)
+        ]
+    )
+    knowledge_cats = KnowledgeCategory.objects.bulk_create(
+        [
+            KnowledgeCategory(
+                name=f"{corpus.tag} {org} {category}", org=organizations[org]
+            )
+            for org in range(corpus.orgs)
+            for category in range(corpus.categories)
+        ]
+    )
+    files = File.objects.bulk_create(
+        [
+            File(knowledge_category=knowledge_cat, name=f"{knowledge_cat.name}.pdf")
+            for knowledge_cat in knowledge_cats
+        ]
+    )
+
+    # chunks are ~400 tokens of text, which is fetched with every result row
+    filler = ("lorem ipsum " * (text_chars // 12 + 1))[:text_chars]
+    start = time.perf_counter()
+    # cursors pick up the vector type from their connection when they are created
+    connection.ensure_connection()
+    register_vector(connection.connection)
+    with connection.cursor() as cursor:
+        with cursor.cursor.copy(
+            "COPY embedding (source_name, original_text, text_vectors, organization_id, num_tokens, file_id)"
+            " FROM STDIN WITH (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["text", "text", "vector", "int4", "int4", "int4"])
+            for row in range(corpus.size):
+                org, category = int(corpus.row_org[row]), int(corpus.row_category[row])
+                copy.write_row(
+                    (
+                        "bench.pdf",
+                        f"chunk {row} {filler}",
+                        corpus.vectors[row],
+                        organizations[org].id,
+                        400,
+                        files[org * corpus.categories + category].id,
+                    )
+                )
+    load_seconds = time.perf_counter() - start
+    assert execute("SELECT min(id), max(id) FROM embedding")[0] == (1, corpus.size)
+
+    execute("ANALYZE embedding")
+    execute(
+        "SELECT set_config('maintenance_work_mem', %s, false)", [maintenance_work_mem]
+    )
+    start = time.perf_counter()
+    execute(
+        f"CREATE INDEX {HNSW_INDEX} ON embedding USING hnsw (text_vectors vector_l2_ops) WITH (m = 16, ef_construction = 64)"
+    )
+    return {
+        "load_seconds": round(load_seconds, 2),
+        "hnsw_build_seconds": round(time.perf_counter() - start, 2),
+    }
+
+
+class Query:
+    def __init__(self, vector: np.ndarray, org: int, category, expected: list[int]):
+        self.vector = vector
+        self.org = org
+        self.category = category
+        self.expected = expected
+
+    @property
+    def scope(self) -> str:
+        return "org" if self.category is None else "category"
+
+
+def make_queries(corpus: Corpus, count: int, top_k: int, seed: int) -> list[Query]:
+    """
+    Questions close to a random chunk, half of them searched within the
+    chunk's category, with their exact top k as the expected result
+    """
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for number, row in enumerate(rng.integers(corpus.size, size=count)):
+        noise = rng.standard_normal(EMBEDDING_DIMENSIONS, dtype=np.float32)
+        vector = normalize(
+            (corpus.vectors[row] + noise * (0.5 / EMBEDDING_DIMENSIONS**0.5))[None]
+        )[0]
+        org = int(corpus.row_org[row])
+        category = int(corpus.row_category[row]) if number % 2 else None
+        rows = corpus.scope_rows(org, category)
+        distances = ((corpus.vectors[rows] - vector) ** 2).sum(axis=1)
+        nearest = rows[np.argsort(distances)[:top_k]]
+        queries.append(Query(vector, org, category, [int(row) + 1 for row in nearest]))
+    return queries
+
+
+class BenchmarkContext:
+    """
+    Maps corpus orgs and categories to their rows, sets up the orgs' retrieval settings
+    """
+
+    def __init__(self, corpus: Corpus, top_k: int):
+        self.corpus = corpus
+        self.organizations = list(
+            Organization.objects.filter(name__startswith=corpus.tag).order_by("id")
+        )
+        self.knowledge_cats = list(
+            KnowledgeCategory.objects.filter(org__in=self.organizations).order_by("id")
+        )
+        for organization in self.organizations:
+            organization.retrieval_top_k = top_k
+            organization.retrieval_distance = "l2"
+
+    def scope(self, query: Query):
+        organization = self.organizations[query.org]
+        knowledge_cat = (
+            self.knowledge_cats[query.org * self.corpus.categories + query.category]
+            if query.category is not None
+            else None
+        )
+        return organization, knowledge_cat
+
+
+def vector_scan(search, query: Query) -> str:
+    """
+    The scan node postgres plans for the query's retrieval sql, e.g.
+    "Index Scan using embedding_vectors_l2_idx on embedding"
+    """
+    plans = []
+
+    def explain(execute, sql, params, many, context):
+        if "ORDER BY" in sql and not plans:
+            execute(f"EXPLAIN {sql}", params, many, context)
+            plans.extend(row[0] for row in context["cursor"].fetchall())
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(explain):
+        search(query)
+    scans = [
+        line.split("->")[-1].split("  (")[0].strip() for line in plans if "Scan" in line
+    ]
+    return scans[-1] if scans else "none"
+
+
+def measure(
+    backend: str,
+    params: dict,
+    queries: list[Query],
+    search,
+    warmup: int,
+    explain: bool = False,
+) -> list[dict]:
+    """
+    Runs every query through search(query) -> ids, returns one result per
+    scope. With explain, also counts the scans postgres picked, small scopes
+    often skip the ANN index.
+    """
+    for query in queries[:warmup]:
+        search(query)
+
+    samples = {}
+    for query in queries:
+        start = time.perf_counter()
+        ids = search(query)
+        seconds = time.perf_counter() - start
+        recall = len(set(ids) & set(query.expected)) / len(query.expected)
+        samples.setdefault(query.scope, []).append((seconds, recall))
+
+    plans = {}
+    if explain:
+        for query in queries:
+            scans = plans.setdefault(query.scope, {})
+            scan = vector_scan(search, query)
+            scans[scan] = scans.get(scan, 0) + 1
+
+    results = []
+    for scope, scope_samples in samples.items():
+        latencies = np.array([seconds for seconds, _ in scope_samples]) * 1000
+        results.append(
+            {
+                "backend": backend,
+                "params": params,
+                "scope": scope,
+                "queries": len(scope_samples),
+                "latency_ms": {
+                    "p50": round(float(np.percentile(latencies, 50)), 3),
+                    "p95": round(float(np.percentile(latencies, 95)), 3),
+                    "p99": round(float(np.percentile(latencies, 99)), 3),
+                    "mean": round(float(latencies.mean()), 3),
+                },
+                "recall_at_k": round(
+                    float(np.mean([recall for _, recall in scope_samples])), 4
+                ),
+                **({"plans": plans[scope]} if explain else {}),
+            }
+        )
+    return results
+
+
+def relation_size(name: str) -> int:
+    return execute("SELECT pg_total_relation_size(%s)", [name])[0][0]
+
+
+def bench_pg_exact(context: BenchmarkContext, queries, args) -> list[dict]:
+    def search(query):
+        organization, knowledge_cat = context.scope(query)
+        with transaction.atomic():
+            execute("SET LOCAL enable_indexscan = off")
+            return [
+                embedding.id
+                for embedding in pgvector_embeddings(
+                    organization, query.vector, knowledge_cat
+                )
+            ]
+
+    results = measure("pg_exact", {}, queries, search, args.warmup, explain=True)
+    for result in results:
+        result["memory_bytes"] = relation_size("embedding")
+    return results
+
+
+def bench_pg_hnsw(context: BenchmarkContext, queries, args) -> list[dict]:
+    results = []
+    for ef_search in args.ef_search:
+        for organization in context.organizations:
+            organization.retrieval_ef_search = ef_search
+
+        def search(query):
+            organization, knowledge_cat = context.scope(query)
+            return [
+                embedding.id
+                for embedding in pgvector_embeddings(
+                    organization, query.vector, knowledge_cat
+                )
+            ]
+
+        results += measure(
+            "pg_hnsw",
+            {"ef_search": ef_search},
+            queries,
+            search,
+            args.warmup,
+            explain=True,
+        )
+
+    for organization in context.organizations:
+        organization.retrieval_ef_search = None
+    for result in results:
+        result["memory_bytes"] = relation_size(HNSW_INDEX)
+    return results
+
+
+def bench_pg_ivfflat(context: BenchmarkContext, queries, args) -> list[dict]:
+    """
+    Builds the IVFFlat index in place of the HNSW one inside a transaction
+    that is rolled back, which brings the HNSW index back
+    """
+    lists = args.lists or max(
+        1,
+        (
+            context.corpus.size // 1000
+            if context.corpus.size <= 1000000
+            else int(context.corpus.size**0.5)
+        ),
+    )
+    results = []
+    with transaction.atomic():
+        execute(f"DROP INDEX {HNSW_INDEX}")
+        start = time.perf_counter()
+        execute(
+            f"CREATE INDEX {IVFFLAT_INDEX} ON embedding USING ivfflat (text_vectors vector_l2_ops) WITH (lists = {lists})"
+        )
+        build_seconds = round(time.perf_counter() - start, 2)
+        memory_bytes = relation_size(IVFFLAT_INDEX)
+
+        for probes in args.probes:
+            for organization in context.organizations:
+                organization.retrieval_probes = probes
+
+            def search(query):
+                organization, knowledge_cat = context.scope(query)
+                return [
+                    embedding.id
+                    for embedding in pgvector_embeddings(
+                        organization, query.vector, knowledge_cat
+                    )
+                ]
+
+            results += measure(
+                "pg_ivfflat",
+                {"lists": lists, "probes": probes},
+                queries,
+                search,
+                args.warmup,
+                explain=True,
+            )
+        transaction.set_rollback(True)
+
+    for organization in context.organizations:
+        organization.retrieval_probes = None
+    for result in results:
+        result["build_seconds"] = build_seconds
+        result["memory_bytes"] = memory_bytes
+    return results
+
+
+def bench_pg_compact(
+    backend: str, precision: str, context: BenchmarkContext, queries, args
+) -> list[dict]:
+    """
+    Builds the compact index inside a transaction that is rolled back, like
+    the IVFFlat one
+    """
+    # the benchmark orgs search by l2 distance
+    index, expression = vector_index(precision, "l2")
+    results = []
+    with transaction.atomic():
+        start = time.perf_counter()
+        execute(
+            f"CREATE INDEX {index} ON embedding USING hnsw ({expression}) {VECTOR_INDEX_PARAMS}"
+        )
+        build_seconds = round(time.perf_counter() - start, 2)
+        memory_bytes = relation_size(index)
+
+        for candidates in args.rerank_candidates:
+            for organization in context.organizations:
+                organization.retrieval_precision = precision
+                organization.retrieval_rerank_candidates = candidates
+
+            def search(query):
+                organization, knowledge_cat = context.scope(query)
+                return [
+                    embedding.id
+                    for embedding in compact_embeddings(
+                        organization, query.vector, knowledge_cat
+                    )
+                ]
+
+            results += measure(
+                backend,
+                {"rerank_candidates": candidates},
+                queries,
+                search,
+                args.warmup,
+                explain=True,
+            )
+        transaction.set_rollback(True)
+
+    for organization in context.organizations:
+        organization.retrieval_precision = "full"
+        organization.retrieval_rerank_candidates = None
+    for result in results:
+        result["build_seconds"] = build_seconds
+        result["memory_bytes"] = memory_bytes
+    return results
+
+
+def bench_pg_halfvec(context: BenchmarkContext, queries, args) -> list[dict]:
+    return bench_pg_compact("pg_halfvec", "half", context, queries, args)
+
+
+def bench_pg_binary(context: BenchmarkContext, queries, args) -> list[dict]:
+    return bench_pg_compact("pg_binary", "binary", context, queries, args)
+
+
+def bench_faiss(context: BenchmarkContext, queries, args) -> list[dict]:
+    faiss_store._indexes.clear()
+
+    def search(query):
+        organization, knowledge_cat = context.scope(query)
+        return [
+            embedding.id
+            for embedding in faiss_embeddings(organization, query.vector, knowledge_cat)
+        ]
+
+    # the indexes are built on the first search of each scope
+    start = time.perf_counter()
+    for query in queries:
+        organization, knowledge_cat = context.scope(query)
+        faiss_store.get_index(
+            organization.id, knowledge_cat.id if knowledge_cat else None, "l2"
+        ).search(query.vector, 1)
+    build_seconds = round(time.perf_counter() - start, 2)
+
+    results = measure("faiss", {"index": "flat"}, queries, search, args.warmup)
+    memory_bytes = sum(
+        index.index.ntotal * EMBEDDING_DIMENSIONS * 4
+        for index in faiss_store._indexes.values()
+    )
+    for result in results:
+        result["build_seconds"] = build_seconds
+        result["memory_bytes"] = memory_bytes
+    faiss_store._indexes.clear()
+    return results
+
+
+def bench_numpy(context: BenchmarkContext, queries, args) -> list[dict]:
+    corpus = context.corpus
+    start = time.perf_counter()
+    matrices = {}
+    for query in queries:
+        key = (query.org, query.category)
+        if key not in matrices:
+            rows = corpus.scope_rows(query.org, query.category)
+            vectors = np.ascontiguousarray(corpus.vectors[rows])
+            matrices[key] = (rows + 1, vectors, (vectors**2).sum(axis=1))
+    build_seconds = round(time.perf_counter() - start, 2)
+
+    def search(query):
+        ids, vectors, squared_norms = matrices[(query.org, query.category)]
+        # |v - q|^2 without the |q|^2 term, which does not change the order
+        distances = squared_norms - 2 * (vectors @ query.vector)
+        k = min(args.top_k, len(ids))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        embeddings_by_id = Embedding.objects.defer("text_vectors").in_bulk(
+            ids[nearest].tolist()
+        )
+        return [
+            int(embedding_id)
+            for embedding_id in ids[nearest]
+            if embedding_id in embeddings_by_id
+        ]
+
+    results = measure("numpy", {}, queries, search, args.warmup)
+    memory_bytes = sum(
+        vectors.nbytes + squared_norms.nbytes
+        for _, vectors, squared_norms in matrices.values()
+    )
+    for result in results:
+        result["build_seconds"] = build_seconds
+        result["memory_bytes"] = memory_bytes
+    return results
+
+
+def bench_snapshot(context: BenchmarkContext, queries, args) -> list[dict]:
+    """
+    Exports the snapshots of the scopes queried to a temporary SNAPSHOT_DIR
+    """
+    snapshot_store.SNAPSHOT_DIR = tempfile.mkdtemp(prefix="retrieval_benchmark_")
+    snapshot_store._snapshots.clear()
+    try:
+        scopes = {context.scope(query) for query in queries}
+        start = time.perf_counter()
+        for organization, knowledge_cat in scopes:
+            snapshot_store.export(
+                organization.id, knowledge_cat.id if knowledge_cat else None
+            )
+        build_seconds = round(time.perf_counter() - start, 2)
+
+        def search(query):
+            organization, knowledge_cat = context.scope(query)
+            return [
+                embedding.id
+                for embedding in snapshot_embeddings(
+                    organization, query.vector, knowledge_cat
+                )
+            ]
+
+        results = measure("snapshot", {}, queries, search, args.warmup)
+        memory_bytes = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for directory, _, names in os.walk(snapshot_store.SNAPSHOT_DIR)
+            for name in names
+            if name.endswith(".npy")
+        )
+    finally:
+        snapshot_store._snapshots.clear()
+        shutil.rmtree(snapshot_store.SNAPSHOT_DIR, ignore_errors=True)
+
+    for result in results:
+        result["build_seconds"] = build_seconds
+        result["memory_bytes"] = memory_bytes
+    return results
+
+
+BACKENDS = {
+    "pg_exact": bench_pg_exact,
+    "pg_hnsw": bench_pg_hnsw,
+    "pg_ivfflat": bench_pg_ivfflat,
+    "pg_halfvec": bench_pg_halfvec,
+    "pg_binary": bench_pg_binary,
+    "faiss": bench_faiss,
+    "numpy": bench_numpy,
+    "snapshot": bench_snapshot,
+}
+
+
+def environment() -> dict:
+    return {
+        "postgres": execute("SHOW server_version")[0][0],
+        "pgvector": execute(
+            "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+        )[0][0],
+        "numpy": np.__version__,
+        "faiss": faiss.__version__,
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def result_key(result: dict) -> tuple:
+    return (
+        result["size"],
+        result["backend"],
+        json.dumps(result["params"], sort_keys=True),
+        result["scope"],
+    )
+
+
+def compare(
+    report: dict, baseline: dict, latency_tolerance: float, recall_tolerance: float
+) -> list[str]:
+    """
+    Results that got slower or less accurate than the same result in the baseline
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = baseline_results.get(result_key(result))
+        if before is None:
+            continue
+        name = f"{result['backend']} {result['params']} size={result['size']} scope={result['scope']}"
+        p95, p95_before = result["latency_ms"]["p95"], before["latency_ms"]["p95"]
+        if p95 > p95_before * (1 + latency_tolerance):
+            regressions.append(f"{name}: p95 {p95_before}ms -> {p95}ms")
+        recall, recall_before = result["recall_at_k"], before["recall_at_k"]
+        if recall < recall_before - recall_tolerance:
+            regressions.append(f"{name}: recall@k {recall_before} -> {recall}")
+    return regressions
+
+
+def run(args) -> dict:
+    report = {
+        "config": vars(args).copy(),
+        "environment": environment(),
+        "corpora": [],
+        "results": [],
+    }
+    for size in args.sizes:
+        corpus = Corpus(size, args.orgs, args.categories, args.seed)
+        if args.keepdb and corpus_loaded(corpus):
+            corpus_info = {"size": size, "reused": True}
+        else:
+            corpus_info = {
+                "size": size,
+                **load_corpus(corpus, args.text_chars, args.maintenance_work_mem),
+            }
+        corpus_info["table_bytes"] = relation_size("embedding")
+        report["corpora"].append(corpus_info)
+        print(f"corpus of {size} chunks ready: {corpus_info}", file=sys.stderr)
+
+        context = BenchmarkContext(corpus, args.top_k)
+        queries = make_queries(corpus, args.queries, args.top_k, args.seed)
+        for backend in args.backends:
+            if backend == "pg_exact" and size > args.exact_max_size:
+                continue
+            for result in BACKENDS[backend](context, queries, args):
+                report["results"].append({"size": size, **result})
+                print(json.dumps(report["results"][-1]), file=sys.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--orgs", type=int, default=50)
+    parser.add_argument("--categories", type=int, default=5, help="per org")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument(
+        "--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS)
+    )
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[40, 100, 200])
+    parser.add_argument(
+        "--lists",
+        type=int,
+        help="ivfflat lists, rows / 1000 (sqrt(rows) over 1M) if left out",
+    )
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 10, 40])
+    parser.add_argument(
+        "--rerank-candidates",
+        type=int,
+        nargs="+",
+        default=[40, 100, 200],
+        help="chunks pg_halfvec and pg_binary take from their index to re-rank",
+    )
+    parser.add_argument(
+        "--exact-max-size",
+        type=int,
+        default=1000000,
+        help="skip pg_exact on larger corpora",
+    )
+    parser.add_argument(
+        "--text-chars", type=int, default=1600, help="length of each chunk's text"
+    )
+    parser.add_argument("--maintenance-work-mem", default="1GB")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--keepdb",
+        action="store_true",
+        help="keep the test database, and reuse the corpus if it matches",
+    )
+    parser.add_argument("--output", help="also write the report to this json file")
+    parser.add_argument(
+        "--compare",
+        help="baseline report, exit with 1 if a result regressed against it",
+    )
+    parser.add_argument("--latency-tolerance", type=float, default=0.25)
+    parser.add_argument("--recall-tolerance", type=float, default=0.02)
+    args = parser.parse_args()
+
+    old_name = connection.creation.create_test_db(verbosity=0, keepdb=args.keepdb)
+    try:
+        report = run(args)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=args.keepdb)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(
+                report,
+                json.load(baseline),
+                args.latency_tolerance,
+                args.recall_tolerance,
+            )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,15 @@
 import uuid
 import os
+import contextlib
+from types import SimpleNamespace
+from typing import Union
+import asyncio
 import django
 import json
-import openai
 from logging import basicConfig, INFO, getLogger
 
-from pypdf import PdfReader
-from pgvector.django import L2Distance
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.forms.models import model_to_dict
 from django.db.models import Sum
 from rest_framework import status
@@ -16,25 +18,72 @@ from rest_framework.parsers import MultiPartParser
 from rest_framework.views import APIView
 
 from llm.utils.prompt import (
-    context_prompt_messages,
-    evaluate_criteria_score,
     count_tokens_for_text,
+    evaluate_response,
+    aevaluate_response,
+    evaluate_messages,
+)
+from llm.utils.language import detect_language, adetect_language, english_question
+from llm.utils.answer_cache import (
+    prompt_version,
+    lookup_answer,
+    store_answer,
+    invalidate_answers,
+)
+from llm.utils.embedding_cache import (
+    cache_key,
+    get_question_embedding,
+    aget_question_embedding,
+    aget_question_embeddings,
+)
+from llm.utils import llm_client
+from llm.utils.general import (
+    generate_session_id,
+    run_in_background,
+    sse_event,
+    config_number,
+)
+from llm.utils.retrieval import (
+    retrieve_embeddings,
+    embeddings_removed,
+    knowledge_category_deleted,
+    sync_vector_indexes,
+    pgvector_version,
+    DISTANCE_FUNCTIONS,
+    MAX_EF_SEARCH,
+)
+from llm.utils.token_budget import build_prompt, model_family, fixed_prompt_fits
+from llm.utils.context_selection import select_context
+from llm.utils.history import load_history, aload_history, summarize_history
+from llm.utils.ingestion import job_status
+from llm.utils.org_cache import update_organization
+from llm.utils.metrics import (
+    ChatMetrics,
+    render_metrics,
+    METRICS_TOKEN,
+    CONTENT_TYPE_LATEST,
+)
+from llm.models import (
+    Organization,
+    Embedding,
+    Message,
+    File,
+    KnowledgeCategory,
+    IngestionJob,
 )
-from llm.utils.general import generate_session_id
-from llm.models import Organization, Embedding, Message, File, KnowledgeCategory
 
 
 basicConfig(level=INFO)
 logger = getLogger()
 
-TOKEN_LIMIT = 7000
+# questions per /api/chat/batch request, and how many of them run at once
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", 100))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", 8))
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llm.settings")
 
 django.setup()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
 
 @api_view(["POST"])
 def create_chat(request):
@@ -48,7 +97,9 @@ def create_chat(request):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        openai.api_key = organization.openai_key
+        # the org's key goes with every openai call, never into module state
+        # shared by concurrent requests
+        openai_kwargs = {"api_key": organization.openai_key}
 
         knowledge_cat = None
         if "category_id" in request.data:
@@ -66,169 +117,747 @@ def create_chat(request):
         gpt_model = request.data.get("gpt_model", "gpt-3.5-turbo").strip()
         session_id = (request.data.get("session_id") or generate_session_id()).strip()
 
-        # 1. Function calling to do language detection of the user's question (1st call to OpenAI)
-        response = openai.ChatCompletion.create(
-            model=gpt_model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Detect the languages in this text: {question}",
-                }
-            ],
-            functions=[
+        # before any paid call
+        if not fixed_prompt_fits(gpt_model, system_prompt, organization, question):
+            return JsonResponse(
                 {
-                    "name": "detect_languages",
-                    "description": "Detecting language and other insights on a piece of user input text.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "language": {
-                                "title": "Language",
-                                "description": "The primary detected language e.g English, French, Hindi, etc",
-                                "type": "string",
-                            },
-                            "confidence": {
-                                "title": "Confidence",
-                                "description": "Confidence level of the language detection from scale of 0 to 1",
-                                "type": "number",
-                            },
-                            "english_translation": {
-                                "title": "English translation",
-                                "description": "English translation of the user input text if not in English",
-                                "type": "string",
-                            },
-                            "translation_confidence": {
-                                "title": "Confidence",
-                                "description": "Confidence level of the language translation to English from scale of 0 to 1",
-                                "type": "number",
-                            },
-                        },
-                        "required": [
-                            "language",
-                            "confidence",
-                            "english_translation",
-                            "translation_confidence",
-                        ],
-                    },
-                }
-            ],
-            function_call={"name": "detect_languages"},
-            temperature=0,
-        )
+                    "error": f"The question and system prompt are too long for {gpt_model}"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        language_results = json.loads(
-            response["choices"][0]["message"]["function_call"]["arguments"]
+        metrics = ChatMetrics("chat", organization, model_family(gpt_model))
+        try:
+            with metrics.active():
+                # 1. Language detection of the user's question, locally or via function calling (1st call to OpenAI)
+                with metrics.stage("language"):
+                    language_results = detect_language(
+                        question, organization, gpt_model, **openai_kwargs
+                    )
+                logger.info(
+                    f"Fetched language results via {language_results['detector']}"
+                )
+                logger.info(f"Language detected: {language_results['language']}")
+
+                # 2. Fetch the chat history from our message store to send to openai and back in the response
+                # only the recent turns that fit the history budget, older ones are summarized
+                with metrics.stage("history"):
+                    history_summary, historical_chats = load_history(session_id)
+
+                with metrics.stage("embedding"):
+                    prompt_embeddings = get_question_embedding(
+                        question, **openai_kwargs
+                    )
+
+                # 3. Reuse a cached answer to a near duplicate question if the org opted in
+                cached_answer = None
+                answer_version = prompt_version(
+                    system_prompt, organization.examples_text, gpt_model
+                )
+                new_session = not historical_chats and not history_summary
+                if organization.answer_cache_enabled and new_session:
+                    with metrics.stage("answer_cache"):
+                        cached_answer = lookup_answer(
+                            organization,
+                            knowledge_cat,
+                            answer_version,
+                            language_results["language"],
+                            prompt_embeddings,
+                        )
+
+                if cached_answer:
+                    embedding_results = []
+                    token_budget = None
+                    prompt_response = SimpleNamespace(
+                        role="assistant", content=cached_answer.answer
+                    )
+                else:
+                    # 4. Pull relevant chunks from vector database
+                    with metrics.stage("retrieval"):
+                        embedding_results = retrieve_embeddings(
+                            organization,
+                            prompt_embeddings,
+                            knowledge_cat,
+                            english_question(language_results),
+                        )
+                    metrics.retrieval_rows = len(embedding_results)
+                    logger.info(
+                        f"retrieved {len(embedding_results)} relevant document context from db"
+                    )
+
+                    # Drop redundant chunks, then fill what the model's context window leaves after the rest of the prompt
+                    with metrics.stage("context"):
+                        context_embeddings = select_context(
+                            organization, prompt_embeddings, embedding_results
+                        )
+                        prompt_messages, final_embeddings, token_budget = build_prompt(
+                            gpt_model,
+                            system_prompt,
+                            organization,
+                            language_results["language"],
+                            context_embeddings,
+                            language_results["english_translation"],
+                            historical_chats,
+                            history_summary,
+                        )
+
+                    # 5. Retrieval question and answer (2nd call to OpenAI, use language from 1. to help LLM respond in same language as user question)
+                    with metrics.stage("completion"):
+                        response = llm_client.chat_completion(
+                            model=gpt_model,
+                            messages=prompt_messages,
+                            **openai_kwargs,
+                        )
+                    logger.info(
+                        "received response from the ai bot for the current prompt"
+                    )
+
+                    prompt_response = response.choices[0].message
+
+                    if organization.answer_cache_enabled and new_session:
+                        with metrics.stage("answer_cache"):
+                            store_answer(
+                                organization,
+                                knowledge_cat,
+                                answer_version,
+                                language_results["language"],
+                                prompt_embeddings,
+                                question,
+                                prompt_response.content,
+                            )
+
+                # 6. Evaluate all the criteria concurrently if the request asks for it,
+                # with "deferred" the scores are computed after the response is sent
+                evaluator_prompts = organization.evaluator_prompts or {}
+                evaluation_deferred = request.data.get("evaluate") == "deferred"
+                evaluation_scores = {}
+                if request.data.get("evaluate") and not evaluation_deferred:
+                    logger.info("Evaluting the response")
+                    with metrics.stage("evaluation"):
+                        evaluation_scores = evaluate_response(
+                            evaluator_prompts,
+                            question,
+                            prompt_response,
+                            gpt_model,
+                            **openai_kwargs,
+                        )
+                    logger.info("Completed evaluating the llm response")
+
+                elif not evaluation_deferred:
+                    logger.info("Evaluator prompt for the org has not been set")
+
+                # 7. Store the current question and ans to the message store
+                with metrics.stage("persistence"):
+                    stored_messages = [
+                        Message.objects.create(
+                            session_id=session_id,
+                            role="user",
+                            message=question,
+                            evaluation_score=evaluation_scores,
+                        ),
+                        Message.objects.create(
+                            session_id=session_id,
+                            role=prompt_response.role,
+                            message=prompt_response.content,
+                            evaluation_score=evaluation_scores,
+                        ),
+                    ]
+                logger.info("Stored messages in django db")
+
+                run_in_background(
+                    summarize_history, session_id, gpt_model, **openai_kwargs
+                )
+
+                if evaluation_deferred:
+                    run_in_background(
+                        evaluate_messages,
+                        [message.id for message in stored_messages],
+                        evaluator_prompts,
+                        question,
+                        prompt_response,
+                        gpt_model,
+                        **openai_kwargs,
+                    )
+        finally:
+            # failed requests are timed too
+            metrics.finish()
+
+        response = JsonResponse(
+            {
+                "question": question,
+                "answer": prompt_response.content,
+                "language_results": language_results,
+                "embedding_results_count": len(embedding_results),
+                "answer_cached": cached_answer is not None,
+                "token_budget": token_budget,
+                "chat_history": [
+                    {"role": chat.role, "message": chat.message}
+                    for chat in historical_chats
+                ],
+                "session_id": session_id,
+                "evaluation_scores": evaluation_scores,
+                "evaluation_deferred": evaluation_deferred,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+        response["Server-Timing"] = metrics.server_timing()
+        return response
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong {error}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
-        logger.info("Fetched language results via function calls")
-        logger.info(f"Language detected: {language_results['language']}")
 
-        # 2. Pull relevant chunks from vector database
-        prompt_embeddings = openai.Embedding.create(
-            model="text-embedding-ada-002", input=question
-        )["data"][0]["embedding"]
 
-        embedding_results_query = Embedding.objects
+async def aprepare_chat(
+    organization: Organization,
+    question: str,
+    session_id: str,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    system_prompt: Union[str, None],
+    gpt_model: str,
+    metrics: ChatMetrics,
+    prompt_embeddings: Union[list[float], None] = None,
+) -> SimpleNamespace:
+    """
+    The steps of the async chat pipeline up to the completion call, shared by
+    achat and the streaming endpoint. The chat has either a cached_answer or
+    the prompt_messages to send.
+    """
+    openai_kwargs = {"api_key": organization.openai_key}
+
+    async def question_embedding():
+        if prompt_embeddings is not None:
+            return prompt_embeddings
+        return await aget_question_embedding(question, **openai_kwargs)
+
+    # 1. Language detection, question embedding and chat history do not depend on each other
+    (
+        language_results,
+        prompt_embeddings,
+        (history_summary, historical_chats),
+    ) = await asyncio.gather(
+        metrics.timed(
+            "language",
+            adetect_language(question, organization, gpt_model, **openai_kwargs),
+        ),
+        metrics.timed("embedding", question_embedding()),
+        metrics.timed("history", aload_history(session_id)),
+    )
+    logger.info(f"Language detected: {language_results['language']}")
+
+    chat = SimpleNamespace(
+        language_results=language_results,
+        prompt_embeddings=prompt_embeddings,
+        history_summary=history_summary,
+        historical_chats=historical_chats,
+        answer_version=prompt_version(
+            system_prompt, organization.examples_text, gpt_model
+        ),
+        new_session=not historical_chats and not history_summary,
+        cached_answer=None,
+        embedding_results=[],
+        token_budget=None,
+        prompt_messages=None,
+    )
+
+    # 2. Reuse a cached answer to a near duplicate question if the org opted in
+    if organization.answer_cache_enabled and chat.new_session:
+        with metrics.stage("answer_cache"):
+            chat.cached_answer = await sync_to_async(lookup_answer)(
+                organization,
+                knowledge_cat,
+                chat.answer_version,
+                language_results["language"],
+                prompt_embeddings,
+            )
+    if chat.cached_answer:
+        return chat
+
+    # 3. Pull relevant chunks from vector database and build the prompt
+    with metrics.stage("retrieval"):
+        chat.embedding_results = await sync_to_async(retrieve_embeddings)(
+            organization,
+            prompt_embeddings,
+            knowledge_cat,
+            english_question(language_results),
+        )
+    metrics.retrieval_rows = len(chat.embedding_results)
 
-        if knowledge_cat:
-            embedding_results_query = embedding_results_query.filter(
-                file__knowledge_category=knowledge_cat
+    with metrics.stage("context"):
+        context_embeddings = await sync_to_async(select_context)(
+            organization, prompt_embeddings, chat.embedding_results
+        )
+        chat.prompt_messages, final_embeddings, chat.token_budget = build_prompt(
+            gpt_model,
+            system_prompt,
+            organization,
+            language_results["language"],
+            context_embeddings,
+            language_results["english_translation"],
+            historical_chats,
+            history_summary,
+        )
+    return chat
+
+
+async def afinish_chat(
+    organization: Organization,
+    chat: SimpleNamespace,
+    question: str,
+    session_id: str,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    gpt_model: str,
+    metrics: ChatMetrics,
+    prompt_response,
+    evaluate=None,
+) -> dict:
+    """
+    The steps of the async chat pipeline once the answer is known, shared by
+    achat and the streaming endpoint. Returns the chat response body.
+    """
+    openai_kwargs = {"api_key": organization.openai_key}
+
+    if (
+        not chat.cached_answer
+        and organization.answer_cache_enabled
+        and chat.new_session
+    ):
+        with metrics.stage("answer_cache"):
+            await sync_to_async(store_answer)(
+                organization,
+                knowledge_cat,
+                chat.answer_version,
+                chat.language_results["language"],
+                chat.prompt_embeddings,
+                question,
+                prompt_response.content,
             )
 
-        embedding_results = (
-            embedding_results_query.alias(
-                distance=L2Distance("text_vectors", prompt_embeddings),
+    # 4. Evaluate all the criteria concurrently if the request asks for it
+    evaluator_prompts = organization.evaluator_prompts or {}
+    evaluation_deferred = evaluate == "deferred"
+    evaluation_scores = {}
+    if evaluate and not evaluation_deferred:
+        with metrics.stage("evaluation"):
+            evaluation_scores = await aevaluate_response(
+                evaluator_prompts, question, prompt_response, gpt_model, **openai_kwargs
             )
-            # .filter(distance__gt=0.7)
-            .order_by("-distance")
+
+    # 5. Store the current question and ans to the message store
+    with metrics.stage("persistence"):
+        stored_messages = await Message.objects.abulk_create(
+            [
+                Message(
+                    session_id=session_id,
+                    role="user",
+                    message=question,
+                    evaluation_score=evaluation_scores,
+                ),
+                Message(
+                    session_id=session_id,
+                    role=prompt_response.role,
+                    message=prompt_response.content,
+                    evaluation_score=evaluation_scores,
+                ),
+            ]
         )
-        logger.info(
-            f"retrieved {len(embedding_results)} relevant document context from db"
+
+    # the thread pool outlives the request, unlike this event loop under wsgi
+    run_in_background(summarize_history, session_id, gpt_model, **openai_kwargs)
+
+    if evaluation_deferred:
+        run_in_background(
+            evaluate_messages,
+            [message.id for message in stored_messages],
+            evaluator_prompts,
+            question,
+            prompt_response,
+            gpt_model,
+            **openai_kwargs,
         )
 
-        # Filter embedding to make sure token limit is under 7000
-        final_embeddings: list[Embedding] = []
-        token_count = 0
-        for embedding in embedding_results:
-            token_count += embedding.num_tokens
-            if token_count < TOKEN_LIMIT:
-                final_embeddings.append(embedding)
-            else:
-                break
+    return {
+        "question": question,
+        "answer": prompt_response.content,
+        "language_results": chat.language_results,
+        "embedding_results_count": len(chat.embedding_results),
+        "answer_cached": chat.cached_answer is not None,
+        "token_budget": chat.token_budget,
+        "chat_history": [
+            {"role": message.role, "message": message.message}
+            for message in chat.historical_chats
+        ],
+        "session_id": session_id,
+        "evaluation_scores": evaluation_scores,
+        "evaluation_deferred": evaluation_deferred,
+    }
+
+
+async def achat(
+    organization: Organization,
+    question: str,
+    session_id: str,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    system_prompt: Union[str, None],
+    gpt_model: str,
+    metrics: ChatMetrics,
+    evaluate=None,
+    prompt_embeddings: Union[list[float], None] = None,
+) -> dict:
+    """
+    The async chat pipeline, returns the chat response body. Pass
+    prompt_embeddings when the question was already embedded. Stage timings
+    go into metrics, activate it around the call to count the tokens too.
+    """
+    chat = await aprepare_chat(
+        organization,
+        question,
+        session_id,
+        knowledge_cat,
+        system_prompt,
+        gpt_model,
+        metrics,
+        prompt_embeddings,
+    )
+
+    if chat.cached_answer:
+        prompt_response = SimpleNamespace(
+            role="assistant", content=chat.cached_answer.answer
+        )
+    else:
+        with metrics.stage("completion"):
+            response = await llm_client.achat_completion(
+                model=gpt_model,
+                messages=chat.prompt_messages,
+                api_key=organization.openai_key,
+            )
+        logger.info("received response from the ai bot for the current prompt")
+        prompt_response = response.choices[0].message
 
-        logger.info(
-            f"Using {len(final_embeddings)}/{len(embedding_results)} relevant docs to make sure token limit is under {TOKEN_LIMIT}. Token count: {token_count}"
+    return await afinish_chat(
+        organization,
+        chat,
+        question,
+        session_id,
+        knowledge_cat,
+        gpt_model,
+        metrics,
+        prompt_response,
+        evaluate,
+    )
+
+
+async def aread_chat_request(organization: Organization, data: dict) -> tuple:
+    """
+    (question, session_id, knowledge_cat, system_prompt, gpt_model) of an async
+    chat request body, same fields as create_chat
+    """
+    knowledge_cat = None
+    if "category_id" in data:
+        knowledge_cat = await KnowledgeCategory.objects.filter(
+            id=data["category_id"]
+        ).afirst()
+
+    question = data.get("question").strip()
+    system_prompt = data.get("system_prompt", None) or organization.system_prompt
+    system_prompt = system_prompt.strip() if system_prompt else None
+
+    gpt_model = data.get("gpt_model", "gpt-3.5-turbo").strip()
+    session_id = (data.get("session_id") or generate_session_id()).strip()
+    return question, session_id, knowledge_cat, system_prompt, gpt_model
+
+
+async def acreate_chat(request):
+    """
+    Same pipeline as create_chat but non blocking, to be served via llm.asgi.
+    Stages that do not depend on each other run concurrently and the org's
+    openai key is passed per call instead of being set globally.
+    """
+    if request.method != "POST":
+        return JsonResponse(
+            {"error": f"Method {request.method} not allowed"},
+            status=status.HTTP_405_METHOD_NOT_ALLOWED,
         )
 
-        relevant_english_context = "".join(
-            result.original_text for result in final_embeddings
+    try:
+        organization: Organization = request.org
+        logger.info(f"processing async chat prompt request for org {organization.name}")
+
+        if not organization.openai_key:
+            return JsonResponse(
+                {"error": "Please add your openai key"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        data = json.loads(request.body)
+        (
+            question,
+            session_id,
+            knowledge_cat,
+            system_prompt,
+            gpt_model,
+        ) = await aread_chat_request(organization, data)
+        if not fixed_prompt_fits(gpt_model, system_prompt, organization, question):
+            return JsonResponse(
+                {
+                    "error": f"The question and system prompt are too long for {gpt_model}"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        metrics = ChatMetrics("chat/async", organization, model_family(gpt_model))
+        try:
+            async with llm_client.pooled_aiosession(request):
+                with metrics.active():
+                    chat_response = await achat(
+                        organization,
+                        question,
+                        session_id,
+                        knowledge_cat,
+                        system_prompt,
+                        gpt_model,
+                        metrics,
+                        data.get("evaluate"),
+                    )
+        finally:
+            # failed requests are timed too
+            metrics.finish()
+
+        response = JsonResponse(chat_response, status=status.HTTP_201_CREATED)
+        response["Server-Timing"] = metrics.server_timing()
+        return response
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong {error}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
 
-        # 3. Fetch the chat history from our message store to send to openai and back in the response
-        historical_chats = Message.objects.filter(session_id=session_id).all()
 
-        # 4. Retrieval question and answer (2nd call to OpenAI, use language from 1. to help LLM respond in same language as user question)
-        response = openai.ChatCompletion.create(
-            model=gpt_model,
-            messages=context_prompt_messages(
-                system_prompt,
-                organization.id,
-                language_results["language"],
-                relevant_english_context,
-                language_results["english_translation"],
-                historical_chats,
-            ),
+# django 4.2's csrf_exempt decorator does not support async views
+acreate_chat.csrf_exempt = True
+
+
+async def acreate_chat_batch(request):
+    """
+    Example request body:
+
+    {
+        "items": [
+            {"question": "What is HIV?", "session_id": "abc123", "category_id": 1},
+            {"question": "What is HIV?"}
+        ],
+        "gpt_model": "gpt-3.5-turbo",
+        "evaluate": "deferred"
+    }
+
+    system_prompt, gpt_model and evaluate apply to every item. Items with the
+    same question, category and session are answered once. Items of the same
+    session are answered one after another, in their order. All the questions
+    are embedded in a single request and at most CHAT_BATCH_CONCURRENCY chats
+    run at a time. results[i] is the chat response, or the error, of items[i].
+    """
+    if request.method != "POST":
+        return JsonResponse(
+            {"error": f"Method {request.method} not allowed"},
+            status=status.HTTP_405_METHOD_NOT_ALLOWED,
         )
-        logger.info("received response from the ai bot for the current prompt")
 
-        prompt_response = response.choices[0].message
+    try:
+        organization: Organization = request.org
+        logger.info(f"processing batch chat request for org {organization.name}")
+
+        if not organization.openai_key:
+            return JsonResponse(
+                {"error": "Please add your openai key"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        data = json.loads(request.body)
+        items = data.get("items") or []
+        if not isinstance(items, list) or not 0 < len(items) <= CHAT_BATCH_MAX_ITEMS:
+            return JsonResponse(
+                {
+                    "error": f"items should be a list of 1 to {CHAT_BATCH_MAX_ITEMS} questions"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        # 5. Evaluate if the request asks for it
-        evaluation_scores = {}
-        if request.data.get("evaluate"):
-            logger.info("Evaluting the response")
-            evaluator_prompts = organization.evaluator_prompts  # { 'coherence': ... }
-            for criteria, evaluator_prompt in evaluator_prompts.items():
-                score = evaluate_criteria_score(
-                    evaluator_prompt, question, prompt_response, gpt_model
+        system_prompt = data.get("system_prompt", None) or organization.system_prompt
+        system_prompt = system_prompt.strip() if system_prompt else None
+        gpt_model = data.get("gpt_model", "gpt-3.5-turbo").strip()
+
+        category_ids = {
+            item["category_id"] for item in items if item.get("category_id")
+        }
+        knowledge_cats = await sync_to_async(KnowledgeCategory.objects.in_bulk)(
+            category_ids
+        )
+
+        # items asking the same thing in the same session share one chat
+        groups: dict[tuple, list[int]] = {}
+        results: list[Union[dict, None]] = [None] * len(items)
+        for index, item in enumerate(items):
+            question = (item.get("question") or "").strip()
+            if not question:
+                results[index] = {
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "error": "question is required",
+                }
+                continue
+            if not fixed_prompt_fits(gpt_model, system_prompt, organization, question):
+                results[index] = {
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "error": f"The question and system prompt are too long for {gpt_model}",
+                }
+                continue
+            key = (
+                cache_key(question),
+                item.get("category_id"),
+                (item.get("session_id") or "").strip() or None,
+            )
+            groups.setdefault(key, []).append(index)
+
+        questions = [
+            items[indexes[0]]["question"].strip() for indexes in groups.values()
+        ]
+        semaphore = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+
+        # the header has the timings of the whole batch, each chat is recorded
+        # in the metrics on its own
+        batch_metrics = ChatMetrics("chat/batch", organization, model_family(gpt_model))
+
+        # a session's questions run one after another, in item order (the lock is
+        # fifo), so each chat loads the turns stored by the ones before it
+        session_locks = {key[2]: asyncio.Lock() for key in groups if key[2] is not None}
+
+        async def answer(key, question, prompt_embeddings):
+            _, category_id, session_id = key
+            session_lock = session_locks.get(session_id) or contextlib.nullcontext()
+            async with session_lock, semaphore:
+                metrics = ChatMetrics(
+                    "chat/batch", organization, model_family(gpt_model)
                 )
-                evaluation_scores[criteria] = score
-                logger.info(f"Evaluated criteria: {criteria} with score: {score}")
+                try:
+                    with metrics.active():
+                        chat_response = await achat(
+                            organization,
+                            question,
+                            session_id or generate_session_id(),
+                            knowledge_cats.get(category_id),
+                            system_prompt,
+                            gpt_model,
+                            metrics,
+                            data.get("evaluate"),
+                            prompt_embeddings,
+                        )
+                    return {"status": status.HTTP_201_CREATED, **chat_response}
+                except Exception as error:
+                    logger.error(f"Error: {error}")
+                    return {
+                        "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        "error": f"Something went wrong {error}",
+                    }
+                finally:
+                    metrics.finish()
+                    batch_metrics.add_tokens(
+                        metrics.tokens["prompt"], metrics.tokens["completion"]
+                    )
 
-            logger.info("Completed evaluating the llm response", evaluator_prompts)
+        async with llm_client.pooled_aiosession(request):
+            with batch_metrics.stage("embedding"):
+                question_embeddings = (
+                    await aget_question_embeddings(
+                        questions, api_key=organization.openai_key
+                    )
+                    if questions
+                    else []
+                )
+            logger.info(
+                f"embedded {len(questions)} unique questions for {len(items)} batch items"
+            )
+
+            with batch_metrics.stage("chats"):
+                group_results = await asyncio.gather(
+                    *[
+                        answer(key, question, prompt_embeddings)
+                        for key, question, prompt_embeddings in zip(
+                            groups, questions, question_embeddings
+                        )
+                    ]
+                )
 
-        else:
-            logger.info("Evaluator prompt for the org has not been set")
+        for indexes, group_result in zip(groups.values(), group_results):
+            for index in indexes:
+                results[index] = group_result
 
-        # 6. Store the current question and ans to the message store
-        Message.objects.create(
-            session_id=session_id,
-            role="user",
-            message=question,
-            evaluation_score=evaluation_scores,
+        response = JsonResponse(
+            {"results": results, "unique_questions": len(questions)},
+            status=status.HTTP_200_OK,
         )
-        Message.objects.create(
-            session_id=session_id,
-            role=prompt_response.role,
-            message=prompt_response.content,
-            evaluation_score=evaluation_scores,
+        response["Server-Timing"] = batch_metrics.server_timing()
+        return response
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong {error}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
-        logger.info("Stored messages in django db")
 
+
+acreate_chat_batch.csrf_exempt = True
+
+
+async def acreate_chat_stream(request):
+    """
+    Same request body as create_chat, answered as server-sent events:
+
+    event: language, the language results
+    event: token, {"content": ...} for each piece of the answer as openai streams it
+    event: done, the rest of the create_chat response, with the stage timings
+    event: error, if anything fails once the stream has started
+
+    The messages are stored once the answer is complete. The timings go in the
+    done event as they are not known yet when the headers are sent. The events
+    only go out as they come when served via llm.asgi, Django buffers an async
+    stream under WSGI.
+    """
+    if request.method != "POST":
         return JsonResponse(
-            {
-                "question": question,
-                "answer": prompt_response.content,
-                "language_results": language_results,
-                "embedding_results_count": len(embedding_results),
-                "chat_history": [
-                    {"role": chat.role, "message": chat.message}
-                    for chat in historical_chats
-                ],
-                "session_id": session_id,
-                "evaluation_scores": evaluation_scores,
-            },
-            status=status.HTTP_201_CREATED,
+            {"error": f"Method {request.method} not allowed"},
+            status=status.HTTP_405_METHOD_NOT_ALLOWED,
         )
+
+    try:
+        organization: Organization = request.org
+        logger.info(
+            f"processing streaming chat prompt request for org {organization.name}"
+        )
+
+        if not organization.openai_key:
+            return JsonResponse(
+                {"error": "Please add your openai key"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        data = json.loads(request.body)
+        (
+            question,
+            session_id,
+            knowledge_cat,
+            system_prompt,
+            gpt_model,
+        ) = await aread_chat_request(organization, data)
+        if not fixed_prompt_fits(gpt_model, system_prompt, organization, question):
+            return JsonResponse(
+                {
+                    "error": f"The question and system prompt are too long for {gpt_model}"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        metrics = ChatMetrics("chat/stream", organization, model_family(gpt_model))
     except Exception as error:
         logger.error(f"Error: {error}")
         return JsonResponse(
@@ -236,6 +865,104 @@ def create_chat(request):
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
 
+    # metrics is only activated around awaits that don't yield, the server
+    # may resume the generator in another context
+    async def events():
+        try:
+            async with llm_client.pooled_aiosession(request):
+                with metrics.active():
+                    chat = await aprepare_chat(
+                        organization,
+                        question,
+                        session_id,
+                        knowledge_cat,
+                        system_prompt,
+                        gpt_model,
+                        metrics,
+                    )
+                # the answer is in this language
+                yield sse_event("language", chat.language_results)
+
+                if chat.cached_answer:
+                    answer = chat.cached_answer.answer
+                    yield sse_event("token", {"content": answer})
+                else:
+                    # includes the time the client takes to read the tokens
+                    with metrics.stage("completion"):
+                        response = await llm_client.achat_completion(
+                            model=gpt_model,
+                            messages=chat.prompt_messages,
+                            stream=True,
+                            api_key=organization.openai_key,
+                        )
+
+                        answer_parts = []
+                        async for chunk in response:
+                            content = chunk.choices[0].delta.get("content")
+                            if content:
+                                answer_parts.append(content)
+                                yield sse_event("token", {"content": content})
+                    answer = "".join(answer_parts)
+                    logger.info("streamed the response from the ai bot")
+
+                    # streamed responses come without usage
+                    metrics.add_tokens(
+                        chat.token_budget["prompt"],
+                        count_tokens_for_text(answer, gpt_model),
+                    )
+
+                # evaluated once the whole answer is out
+                with metrics.active():
+                    chat_response = await afinish_chat(
+                        organization,
+                        chat,
+                        question,
+                        session_id,
+                        knowledge_cat,
+                        gpt_model,
+                        metrics,
+                        SimpleNamespace(role="assistant", content=answer),
+                        data.get("evaluate"),
+                    )
+
+            metrics.finish()
+            # sent in the language and token events already
+            del chat_response["answer"], chat_response["language_results"]
+            yield sse_event("done", {**chat_response, "timings": metrics.as_dict()})
+        except Exception as error:
+            logger.error(f"Error: {error}")
+            metrics.finish()
+            yield sse_event("error", {"error": f"Something went wrong {error}"})
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # stop nginx from buffering the events
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+acreate_chat_stream.csrf_exempt = True
+
+
+@api_view(["GET"])
+def get_metrics(request):
+    """
+    Chat latency, stage, token and retrieval histograms in Prometheus format,
+    labelled by org id and model family. Served without an org api key, to the
+    holders of METRICS_TOKEN only.
+    """
+    if not METRICS_TOKEN:
+        return JsonResponse(
+            {"error": "Metrics are disabled, set METRICS_TOKEN to serve them"},
+            status=status.HTTP_403_FORBIDDEN,
+        )
+    if request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return JsonResponse(
+            {"error": "Invalid metrics token"},
+            status=status.HTTP_401_UNAUTHORIZED,
+        )
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
 
 class FileUploadView(APIView):
     parser_classes = (MultiPartParser,)
@@ -248,8 +975,6 @@ class FileUploadView(APIView):
             if "file" not in request.data:
                 raise ValueError("Empty content")
 
-            openai.api_key = org.openai_key
-
             request_file = request.data["file"]
             file_name = (
                 request.data["filename"].strip()
@@ -285,31 +1010,21 @@ class FileUploadView(APIView):
                 name=file_name,
             )
 
-            pdf_reader = PdfReader(request_file)
-            for page in pdf_reader.pages:
-                page_text = page.extract_text().replace("\n", " ")
-
-                if len(page_text) > 0:
-                    response = openai.Embedding.create(
-                        model="text-embedding-ada-002", input=page_text
-                    )
-
-                    embeddings = response["data"][0]["embedding"]
-                    if len(embeddings) != 1536:
-                        raise ValueError(
-                            f"Invalid embedding length: #{len(embeddings)}"
-                        )
-
-                    Embedding.objects.create(
-                        source_name=file.name,
-                        original_text=page_text,
-                        text_vectors=embeddings,
-                        organization=org,
-                        num_tokens=count_tokens_for_text(page_text),
-                        file=file,
-                    )
+            # The pages are embedded by the ingestion worker, poll the job for progress
+            job = IngestionJob.objects.create(
+                organization=org,
+                file=file,
+                content=request_file.read(),
+            )
 
-            return JsonResponse({"msg": f"Uploaded file {file.name} successfully"})
+            return JsonResponse(
+                {
+                    "msg": f"Queued file {file.name} for upload",
+                    "job_id": job.uuid,
+                    "status": job.status,
+                },
+                status=status.HTTP_202_ACCEPTED,
+            )
         except ValueError as error:
             logger.error(f"Error: {error}")
             return JsonResponse(
@@ -324,6 +1039,47 @@ class FileUploadView(APIView):
             )
 
 
+@api_view(["GET"])
+def get_upload_status(request, job_uuid):
+    """
+    Progress of a queued document upload
+    """
+    try:
+        org: Organization = request.org
+
+        try:
+            uuid.UUID(
+                job_uuid
+            )  # This will raise a ValueError if uuid_str is not a valid UUID
+        except ValueError:
+            return JsonResponse(
+                {"error": "Invalid UUID"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        job = (
+            IngestionJob.objects.filter(uuid=job_uuid, organization=org)
+            .select_related("file")
+            .defer("content")
+            .first()
+        )
+
+        if not job:
+            return JsonResponse(
+                {"error": f"Upload job does not exists"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        return JsonResponse(job_status(job), status=status.HTTP_200_OK)
+
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
 @api_view(["POST"])
 def set_system_prompt(request):
     try:
@@ -332,7 +1088,8 @@ def set_system_prompt(request):
 
         system_prompt = request.data.get("system_prompt").strip()
 
-        Organization.objects.filter(id=org.id).update(system_prompt=system_prompt)
+        update_organization(org, system_prompt=system_prompt)
+        invalidate_answers(org)
 
         return JsonResponse(
             {"msg": f"Updated System Prompt"},
@@ -354,9 +1111,7 @@ def set_evaluator_prompt(request):
 
         evaluator_prompts = request.data.get("evaluator_prompts")
 
-        Organization.objects.filter(id=org.id).update(
-            evaluator_prompts=evaluator_prompts
-        )
+        update_organization(org, evaluator_prompts=evaluator_prompts)
 
         return JsonResponse(
             {"msg": f"Updated Evaluator Prompt"},
@@ -387,7 +1142,8 @@ def set_examples_text(request):
 
         examples_text = request.data.get("examples_text")
 
-        Organization.objects.filter(id=org.id).update(examples_text=examples_text)
+        update_organization(org, examples_text=examples_text)
+        invalidate_answers(org)
 
         return JsonResponse(
             {"msg": f"Updated Examples Text"},
@@ -418,7 +1174,7 @@ def set_openai_key(request):
 
         openai_key = request.data.get("key")
 
-        Organization.objects.filter(id=org.id).update(openai_key=openai_key)
+        update_organization(org, openai_key=openai_key)
 
         return JsonResponse(
             {"msg": f"Updated openai key"},
@@ -433,6 +1189,246 @@ def set_openai_key(request):
         )
 
 
+@api_view(["POST"])
+def set_language_detection_threshold(request):
+    """
+    Example request body:
+
+    {
+        "threshold": 0.8
+    }
+
+    Questions detected locally with a lower confidence fall back to openai function calling.
+    Set it above 1 to always use openai.
+    """
+    try:
+        org: Organization = request.org
+        logger.info(
+            f"processing set language detection threshold request for org {org.name}"
+        )
+
+        threshold = config_number(request.data, "threshold")
+        if not 0 <= threshold < float("inf"):
+            raise ValueError("threshold should be a non-negative number")
+
+        update_organization(org, language_detection_threshold=threshold)
+
+        return JsonResponse(
+            {"msg": f"Updated language detection threshold"},
+            status=status.HTTP_200_OK,
+        )
+
+    except ValueError as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Invalid language detection threshold: {error}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@api_view(["POST"])
+def set_answer_cache(request):
+    """
+    Example request body:
+
+    {
+        "enabled": true,
+        "similarity": 0.95
+    }
+
+    New sessions whose question has at least this cosine similarity with a
+    previously answered question get the cached answer
+    """
+    try:
+        org: Organization = request.org
+        logger.info(f"processing set answer cache request for org {org.name}")
+
+        answer_cache_config = {}
+
+        if "enabled" in request.data:
+            enabled = request.data["enabled"]
+            # form-encoded bodies carry the flag as a string
+            if isinstance(enabled, str) and enabled.lower() in ("true", "false"):
+                enabled = enabled.lower() == "true"
+            if not isinstance(enabled, bool):
+                raise ValueError("enabled should be true or false")
+            answer_cache_config["answer_cache_enabled"] = enabled
+
+        if "similarity" in request.data:
+            similarity = config_number(request.data, "similarity")
+            if not 0 < similarity <= 1:
+                raise ValueError("similarity should be between 0 and 1")
+            answer_cache_config["answer_cache_similarity"] = similarity
+
+        update_organization(org, **answer_cache_config)
+        invalidate_answers(org)
+
+        return JsonResponse(
+            {"msg": f"Updated answer cache"},
+            status=status.HTTP_200_OK,
+        )
+
+    except ValueError as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Invalid answer cache config: {error}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+@api_view(["POST"])
+def set_retrieval_config(request):
+    """
+    Example request body:
+
+    {
+        "backend": "faiss",
+        "top_k": 20,
+        "distance": "cosine",
+        "ef_search": 100,
+        "probes": 10,
+        "precision": "half",
+        "rerank_candidates": 100,
+        "context_selection": "mmr",
+        "dedup_similarity": 0.95,
+        "mmr_lambda": 0.7
+    }
+
+    Any key left out keeps its current value
+    """
+    try:
+        org: Organization = request.org
+        logger.info(f"processing set retrieval config request for org {org.name}")
+
+        retrieval_config = {}
+
+        if "backend" in request.data:
+            backend = request.data["backend"]
+            if backend not in ("pgvector", "faiss", "hybrid", "snapshot"):
+                raise ValueError(
+                    "backend should be one of pgvector, faiss, hybrid, snapshot"
+                )
+            retrieval_config["retrieval_backend"] = backend
+
+        if "top_k" in request.data:
+            top_k = config_number(request.data, "top_k", int)
+            if not 1 <= top_k <= MAX_EF_SEARCH:
+                raise ValueError(f"top_k should be between 1 and {MAX_EF_SEARCH}")
+            retrieval_config["retrieval_top_k"] = top_k
+
+        if "distance" in request.data:
+            distance = request.data["distance"]
+            if distance not in tuple(DISTANCE_FUNCTIONS):
+                raise ValueError(
+                    f"distance should be one of {', '.join(DISTANCE_FUNCTIONS)}"
+                )
+            retrieval_config["retrieval_distance"] = distance
+
+        # null (or 0) for ef_search, probes and rerank_candidates goes back
+        # to the default
+        if request.data.get("ef_search"):
+            ef_search = config_number(request.data, "ef_search", int)
+            if not 1 <= ef_search <= MAX_EF_SEARCH:
+                raise ValueError(f"ef_search should be between 1 and {MAX_EF_SEARCH}")
+            retrieval_config["retrieval_ef_search"] = ef_search
+        elif "ef_search" in request.data:
+            retrieval_config["retrieval_ef_search"] = None
+
+        if request.data.get("probes"):
+            probes = config_number(request.data, "probes", int)
+            if probes < 1:
+                raise ValueError("probes should be a positive integer")
+            retrieval_config["retrieval_probes"] = probes
+        elif "probes" in request.data:
+            retrieval_config["retrieval_probes"] = None
+
+        if "precision" in request.data:
+            precision = request.data["precision"]
+            if precision not in ("full", "half", "binary"):
+                raise ValueError("precision should be one of full, half, binary")
+            if precision != "full" and pgvector_version() < (0, 7):
+                raise ValueError(
+                    f"precision {precision} needs pgvector 0.7.0 or later, the database has {'.'.join(map(str, pgvector_version()))}"
+                )
+            retrieval_config["retrieval_precision"] = precision
+
+        if request.data.get("rerank_candidates"):
+            retrieval_config["retrieval_rerank_candidates"] = config_number(
+                request.data, "rerank_candidates", int
+            )
+        elif "rerank_candidates" in request.data:
+            retrieval_config["retrieval_rerank_candidates"] = None
+
+        # the compact search asks the index for max(top_k, rerank_candidates)
+        top_k = retrieval_config.get("retrieval_top_k", org.retrieval_top_k)
+        rerank_candidates = retrieval_config.get(
+            "retrieval_rerank_candidates", org.retrieval_rerank_candidates
+        )
+        if rerank_candidates is not None and not (
+            top_k <= rerank_candidates <= MAX_EF_SEARCH
+        ):
+            raise ValueError(
+                f"rerank_candidates should be between top_k ({top_k}) and {MAX_EF_SEARCH}"
+            )
+
+        if "context_selection" in request.data:
+            context_selection = request.data["context_selection"]
+            if context_selection not in ("retrieval", "dedup", "mmr"):
+                raise ValueError(
+                    "context_selection should be one of retrieval, dedup, mmr"
+                )
+            retrieval_config["context_selection"] = context_selection
+
+        if "dedup_similarity" in request.data:
+            dedup_similarity = config_number(request.data, "dedup_similarity")
+            if not 0 < dedup_similarity <= 1:
+                raise ValueError("dedup_similarity should be between 0 and 1")
+            retrieval_config["context_dedup_similarity"] = dedup_similarity
+
+        if "mmr_lambda" in request.data:
+            mmr_lambda = config_number(request.data, "mmr_lambda")
+            if not 0 <= mmr_lambda <= 1:
+                raise ValueError("mmr_lambda should be between 0 and 1")
+            retrieval_config["context_mmr_lambda"] = mmr_lambda
+
+        update_organization(org, **retrieval_config)
+
+        if {"backend", "precision", "distance"} & set(request.data):
+            # builds the vector index the org now searches, and drops the
+            # one nobody searches anymore
+            run_in_background(sync_vector_indexes)
+
+        return JsonResponse(
+            {"msg": f"Updated retrieval config"},
+            status=status.HTTP_200_OK,
+        )
+
+    except ValueError as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Invalid retrieval config: {error}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    except Exception as error:
+        logger.error(f"Error: {error}")
+        return JsonResponse(
+            {"error": f"Something went wrong"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
 @api_view(["POST"])
 def create_knowledge_category(request):
     """
@@ -531,8 +1527,17 @@ def delete_knowledge_category(request, category_uuid):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        embedding_ids = list(
+            Embedding.objects.filter(
+                file__knowledge_category=knowledge_cat
+            ).values_list("id", flat=True)
+        )
+
+        category_id = knowledge_cat.id
         knowledge_cat.delete()
 
+        knowledge_category_deleted(org, category_id, embedding_ids)
+
         return JsonResponse(
             {"msg": f"Category deleted successfully"},
             status=status.HTTP_200_OK,
@@ -606,8 +1611,14 @@ def delete_document(request, file_uuid):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        embedding_ids = list(
+            Embedding.objects.filter(file=file).values_list("id", flat=True)
+        )
+
         file.delete()
 
+        embeddings_removed(org, file.knowledge_category, embedding_ids)
+
         return JsonResponse(
             {"msg": f"File and its embeddings deleted successfully"},
             status=status.HTTP_200_OK,
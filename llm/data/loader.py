@@ -2,19 +2,29 @@ import os
 from typing import List
 
 from django.conf import settings
-from langchain.document_loaders import PyPDFLoader
 from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from llm.utils.pdf_extraction import extract_pages
 
 
 def load_pdfs() -> List[Document]:
     chunks = []
+    text_splitter = RecursiveCharacterTextSplitter()
     path = os.path.join(settings.BASE_DIR, "llm", "data", "sources")
     for filename in os.listdir(path):
         filepath = os.path.join(path, filename)
         is_pdf_file = os.path.isfile(filepath) and filename.endswith(".pdf")
         if is_pdf_file:
-            loader = PyPDFLoader(filepath)
-            chunks += loader.load_and_split()
+            # same documents PyPDFLoader produces, with the pages extracted in parallel
+            pages = [
+                Document(
+                    page_content=page_text, metadata={"source": filepath, "page": page}
+                )
+                for page, page_text, error in extract_pages(filepath)
+                if error is None
+            ]
+            chunks += text_splitter.split_documents(pages)
 
     print(f"Loaded PDFs. Chunks: {len(chunks)}")
 
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from llm.utils.ingestion import run_worker
+
+
+class Command(BaseCommand):
+    help = "Processes queued document uploads (ingestion jobs)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=2,
+            help="Number of jobs processed at the same time",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait before polling again when the queue is empty",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Starting ingestion worker with concurrency {options['concurrency']}"
+        )
+        run_worker(
+            concurrency=options["concurrency"],
+            poll_interval=options["poll_interval"],
+        )
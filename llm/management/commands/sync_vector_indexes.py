@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from llm.utils.retrieval import sync_vector_indexes
+
+
+class Command(BaseCommand):
+    help = "Builds the vector indexes the organizations' retrieval settings search and drops the unused ones"
+
+    def handle(self, *args, **options):
+        sync_vector_indexes()
+        self.stdout.write("Vector indexes are in sync")
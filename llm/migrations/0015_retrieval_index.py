@@ -0,0 +1,46 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:18
+
+from django.db import migrations, models
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm', '0014_alter_file_knowledge_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='retrieval_distance',
+            field=models.CharField(choices=[('l2', 'l2'), ('cosine', 'cosine'), ('inner_product', 'inner_product')], default='l2', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='retrieval_ef_search',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='retrieval_probes',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='retrieval_top_k',
+            field=models.IntegerField(default=20),
+        ),
+        migrations.AddIndex(
+            model_name='embedding',
+            index=pgvector.django.HnswIndex(ef_construction=64, fields=['text_vectors'], m=16, name='embedding_vectors_l2_idx', opclasses=['vector_l2_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='embedding',
+            index=pgvector.django.HnswIndex(ef_construction=64, fields=['text_vectors'], m=16, name='embedding_vectors_cosine_idx', opclasses=['vector_cosine_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='embedding',
+            index=pgvector.django.HnswIndex(ef_construction=64, fields=['text_vectors'], m=16, name='embedding_vectors_ip_idx', opclasses=['vector_ip_ops']),
+        ),
+    ]
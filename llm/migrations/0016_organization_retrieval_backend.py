@@ -0,0 +1,18 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm', '0015_retrieval_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='retrieval_backend',
+            field=models.CharField(choices=[('pgvector', 'pgvector'), ('faiss', 'faiss')], default='pgvector', max_length=50),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0016_organization_retrieval_backend"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organization",
+            name="language_detection_threshold",
+            field=models.FloatField(default=0.8),
+        ),
+    ]
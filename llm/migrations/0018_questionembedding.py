@@ -0,0 +1,26 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:23
+
+from django.db import migrations, models
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0017_organization_language_detection_threshold"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuestionEmbedding",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("model", models.CharField(max_length=255)),
+                ("text_hash", models.CharField(max_length=64, unique=True)),
+                ("text_vectors", pgvector.django.VectorField(dimensions=1536)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "db_table": "question_embedding",
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0018_questionembedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organization",
+            name="answer_cache_enabled",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="organization",
+            name="answer_cache_similarity",
+            field=models.FloatField(default=0.95),
+        ),
+        migrations.CreateModel(
+            name="AnswerCache",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("prompt_version", models.CharField(max_length=64)),
+                ("language", models.CharField(max_length=255)),
+                ("question", models.TextField()),
+                ("question_vectors", pgvector.django.VectorField(dimensions=1536)),
+                ("answer", models.TextField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "knowledge_category",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="llm.knowledgecategory",
+                    ),
+                ),
+                (
+                    "organization",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="llm.organization",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "answer_cache",
+                "indexes": [
+                    pgvector.django.HnswIndex(
+                        ef_construction=64,
+                        fields=["question_vectors"],
+                        m=16,
+                        name="answer_cache_vectors_idx",
+                        opclasses=["vector_cosine_ops"],
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0019_answercache"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IngestionJob",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "uuid",
+                    models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+                ("content", models.BinaryField(null=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("queued", "queued"),
+                            ("processing", "processing"),
+                            ("completed", "completed"),
+                            ("failed", "failed"),
+                        ],
+                        default="queued",
+                        max_length=50,
+                    ),
+                ),
+                ("pages_total", models.IntegerField(default=0)),
+                ("pages_processed", models.IntegerField(default=0)),
+                ("pages_failed", models.IntegerField(default=0)),
+                ("error", models.TextField(null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(null=True)),
+                ("finished_at", models.DateTimeField(null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "file",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="llm.file"
+                    ),
+                ),
+                (
+                    "organization",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="llm.organization",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "ingestion_job",
+                "indexes": [
+                    models.Index(
+                        fields=["status", "id"], name="ingestion_j_status_3e7c42_idx"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0020_ingestionjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ingestionjob",
+            name="batch_timings",
+            field=models.JSONField(default=list),
+        ),
+    ]
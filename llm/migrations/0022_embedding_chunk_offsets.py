@@ -0,0 +1,37 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0021_ingestionjob_batch_timings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="embedding",
+            name="chunk_end",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="embedding",
+            name="chunk_start",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="embedding",
+            name="page_number",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="ingestionjob",
+            name="chunks_failed",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="ingestionjob",
+            name="chunks_processed",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:31
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_existing_embeddings(apps, schema_editor):
+    """
+    Every stored chunk was embedded with text-embedding-ada-002
+    """
+    Embedding = apps.get_model("llm", "Embedding")
+    embeddings = []
+    for embedding in (
+        Embedding.objects.filter(content_hash__isnull=True)
+        .only("id", "original_text")
+        .iterator(chunk_size=2000)
+    ):
+        normalized_text = " ".join(embedding.original_text.split())
+        embedding.content_hash = hashlib.sha256(
+            f"text-embedding-ada-002\n{normalized_text}".encode()
+        ).hexdigest()
+        embeddings.append(embedding)
+        if len(embeddings) >= 2000:
+            Embedding.objects.bulk_update(embeddings, ["content_hash"])
+            embeddings = []
+    Embedding.objects.bulk_update(embeddings, ["content_hash"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0022_embedding_chunk_offsets"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="embedding",
+            name="content_hash",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="embedding",
+            index=models.Index(
+                fields=["content_hash"], name="embedding_content_hash_idx"
+            ),
+        ),
+        migrations.RunPython(hash_existing_embeddings, migrations.RunPython.noop),
+    ]
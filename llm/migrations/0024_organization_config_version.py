@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0023_embedding_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organization",
+            name="config_version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0024_organization_config_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SessionSummary",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                ("session_id", models.TextField(unique=True)),
+                ("summary", models.TextField()),
+                ("summarized_until", models.IntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "db_table": "session_summary",
+            },
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="created_at",
+            field=models.DateTimeField(
+                auto_now_add=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["session_id", "created_at"], name="messages_session_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0025_message_created_at_sessionsummary"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="organization",
+            name="retrieval_backend",
+            field=models.CharField(
+                choices=[
+                    ("pgvector", "pgvector"),
+                    ("faiss", "faiss"),
+                    ("hybrid", "hybrid"),
+                ],
+                default="pgvector",
+                max_length=50,
+            ),
+        ),
+        # a stored generated column, kept in sync with original_text by postgres.
+        # Adding it rewrites the embedding table.
+        migrations.RunSQL(
+            sql=[
+                "ALTER TABLE embedding ADD COLUMN search_vector tsvector "
+                "GENERATED ALWAYS AS (to_tsvector('english', coalesce(original_text, ''))) STORED",
+                "CREATE INDEX embedding_search_vector_idx ON embedding USING gin (search_vector)",
+            ],
+            reverse_sql=[
+                "DROP INDEX embedding_search_vector_idx",
+                "ALTER TABLE embedding DROP COLUMN search_vector",
+            ],
+        ),
+    ]
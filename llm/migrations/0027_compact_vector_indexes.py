@@ -0,0 +1,26 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0026_embedding_search_vector"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organization",
+            name="retrieval_precision",
+            field=models.CharField(
+                choices=[("full", "full"), ("half", "half"), ("binary", "binary")],
+                default="full",
+                max_length=50,
+            ),
+        ),
+        migrations.AddField(
+            model_name="organization",
+            name="retrieval_rerank_candidates",
+            field=models.IntegerField(null=True),
+        ),
+    ]
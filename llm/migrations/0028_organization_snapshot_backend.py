@@ -0,0 +1,26 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0027_compact_vector_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="organization",
+            name="retrieval_backend",
+            field=models.CharField(
+                choices=[
+                    ("pgvector", "pgvector"),
+                    ("faiss", "faiss"),
+                    ("hybrid", "hybrid"),
+                    ("snapshot", "snapshot"),
+                ],
+                default="pgvector",
+                max_length=50,
+            ),
+        ),
+    ]
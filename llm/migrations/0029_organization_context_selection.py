@@ -0,0 +1,35 @@
+# Generated by Django 4.2.6 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llm", "0028_organization_snapshot_backend"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="organization",
+            name="context_dedup_similarity",
+            field=models.FloatField(default=0.95),
+        ),
+        migrations.AddField(
+            model_name="organization",
+            name="context_mmr_lambda",
+            field=models.FloatField(default=0.7),
+        ),
+        migrations.AddField(
+            model_name="organization",
+            name="context_selection",
+            field=models.CharField(
+                choices=[
+                    ("retrieval", "retrieval"),
+                    ("dedup", "dedup"),
+                    ("mmr", "mmr"),
+                ],
+                default="retrieval",
+                max_length=50,
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:02
+
+from django.db import migrations
+from django.db.models import Q
+
+# distance -> full precision index, as built by retrieval.sync_vector_indexes
+INDEXES = {
+    "cosine": ("embedding_vectors_cosine_idx", "vector_cosine_ops"),
+    "inner_product": ("embedding_vectors_ip_idx", "vector_ip_ops"),
+}
+
+
+def drop_unused_indexes(apps, schema_editor):
+    """
+    The cosine and inner product indexes are left to sync_vector_indexes,
+    the ones an org still searches with are kept
+    """
+    Organization = apps.get_model("llm", "Organization")
+    used = set(
+        Organization.objects.exclude(retrieval_backend="faiss")
+        .filter(Q(retrieval_precision="full") | ~Q(retrieval_backend="pgvector"))
+        .values_list("retrieval_distance", flat=True)
+    )
+    for distance, (name, _) in INDEXES.items():
+        if distance not in used:
+            schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def create_indexes(apps, schema_editor):
+    for name, opclass in INDEXES.values():
+        schema_editor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON embedding USING hnsw (text_vectors {opclass}) WITH (m = 16, ef_construction = 64)"
+        )
+
+
+class Migration(migrations.Migration):
+    # CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("llm", "0029_organization_context_selection"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name="embedding",
+                    name="embedding_vectors_cosine_idx",
+                ),
+                migrations.RemoveIndex(
+                    model_name="embedding",
+                    name="embedding_vectors_ip_idx",
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(drop_unused_indexes, create_indexes),
+            ],
+        ),
+    ]
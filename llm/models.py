@@ -1,7 +1,7 @@
 import uuid
 from django.db import models
 
-from pgvector.django import VectorField
+from pgvector.django import VectorField, HnswIndex
 
 
 class Message(models.Model):
@@ -18,9 +18,31 @@ class Message(models.Model):
     )
     message = models.TextField()
     evaluation_score = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = "messages"
+        indexes = [
+            models.Index(
+                name="messages_session_created_idx", fields=["session_id", "created_at"]
+            )
+        ]
+
+
+class SessionSummary(models.Model):
+    """
+    Rolling summary of the turns of a session that no longer fit in the chat history budget
+    """
+
+    id = models.AutoField(primary_key=True)
+    session_id = models.TextField(unique=True)
+    summary = models.TextField()
+    # id of the newest message folded into the summary
+    summarized_until = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "session_summary"
 
 
 class Organization(models.Model):
@@ -33,6 +55,54 @@ class Organization(models.Model):
     )  # { "confidence": "Your task is to...", "friendliness": "Your task is to..." }
     examples_text = models.TextField(null=True)
     openai_key = models.CharField(max_length=255, unique=True, null=True)
+    # local language detection below this confidence falls back to openai
+    language_detection_threshold = models.FloatField(default=0.8)
+    answer_cache_enabled = models.BooleanField(default=False)
+    # cosine similarity above which a new question reuses a cached answer
+    answer_cache_similarity = models.FloatField(default=0.95)
+    retrieval_backend = models.CharField(
+        max_length=50,
+        default="pgvector",
+        choices=(
+            ("pgvector", "pgvector"),
+            ("faiss", "faiss"),
+            ("hybrid", "hybrid"),
+            ("snapshot", "snapshot"),
+        ),
+    )
+    retrieval_top_k = models.IntegerField(default=20)
+    retrieval_distance = models.CharField(
+        max_length=50,
+        default="l2",
+        choices=(
+            ("l2", "l2"),
+            ("cosine", "cosine"),
+            ("inner_product", "inner_product"),
+        ),
+    )
+    retrieval_ef_search = models.IntegerField(null=True)  # hnsw.ef_search
+    retrieval_probes = models.IntegerField(null=True)  # ivfflat.probes
+    # half and binary search a compact index first, then re-rank the
+    # candidates by their full precision vectors
+    retrieval_precision = models.CharField(
+        max_length=50,
+        default="full",
+        choices=(("full", "full"), ("half", "half"), ("binary", "binary")),
+    )
+    retrieval_rerank_candidates = models.IntegerField(null=True)
+    # how retrieved chunks are picked for the prompt: in retrieval order,
+    # without near-duplicates (dedup), or by maximal marginal relevance (mmr)
+    context_selection = models.CharField(
+        max_length=50,
+        default="retrieval",
+        choices=(("retrieval", "retrieval"), ("dedup", "dedup"), ("mmr", "mmr")),
+    )
+    # cosine similarity above which a chunk is a near-duplicate of one already picked
+    context_dedup_similarity = models.FloatField(default=0.95)
+    # mmr trade-off between relevance to the question (1) and diversity (0)
+    context_mmr_lambda = models.FloatField(default=0.7)
+    # bumped on every settings update, tells workers their cached org is stale
+    config_version = models.IntegerField(default=0)
 
     class Meta:
         db_table = "organization"
@@ -69,6 +139,45 @@ class File(models.Model):
         db_table = "files"
 
 
+class IngestionJob(models.Model):
+    """
+    Queued document upload, processed by the ingestion worker (python manage.py ingestion_worker)
+    """
+
+    id = models.AutoField(primary_key=True)
+    uuid = models.UUIDField(unique=True, editable=False, default=uuid.uuid4)
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    file = models.ForeignKey(File, on_delete=models.CASCADE)
+    content = models.BinaryField(null=True)  # the uploaded pdf, cleared once processed
+    status = models.CharField(
+        max_length=50,
+        default="queued",
+        choices=(
+            ("queued", "queued"),
+            ("processing", "processing"),
+            ("completed", "completed"),
+            ("failed", "failed"),
+        ),
+    )
+    pages_total = models.IntegerField(default=0)
+    pages_processed = models.IntegerField(default=0)
+    pages_failed = models.IntegerField(default=0)
+    chunks_processed = models.IntegerField(default=0)
+    chunks_failed = models.IntegerField(default=0)
+    error = models.TextField(null=True)
+    # [{ "chunks", "reused", "embedded", "tokens", "embed_seconds", "insert_seconds" }] per embedding batch
+    batch_timings = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    # heartbeat of the worker processing the job
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "ingestion_job"
+        indexes = [models.Index(fields=["status", "id"])]
+
+
 class Embedding(models.Model):
     id = models.AutoField(primary_key=True)
     source_name = models.TextField()
@@ -77,6 +186,79 @@ class Embedding(models.Model):
     organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
     num_tokens = models.IntegerField(default=0)
     file = models.ForeignKey(File, on_delete=models.CASCADE, null=True)
+    # where the chunk comes from: its first page and its character offsets in the document text
+    page_number = models.IntegerField(null=True)
+    chunk_start = models.IntegerField(null=True)
+    chunk_end = models.IntegerField(null=True)
+    # sha256 of the embedding model and the whitespace normalized text, rows with
+    # the same hash share the same vector
+    content_hash = models.CharField(max_length=64, null=True)
+    # the table also has search_vector, a tsvector generated by postgres from
+    # original_text with a gin index (migration 0026), used by hybrid retrieval.
+    # It is left out of the model so django never writes it. The compact
+    # half precision and binary hnsw indexes are expression indexes on
+    # text_vectors, built by retrieval.sync_vector_indexes for the precisions
+    # in use, the full precision vectors are kept for re-ranking.
 
     class Meta:
         db_table = "embedding"
+        indexes = [
+            models.Index(name="embedding_content_hash_idx", fields=["content_hash"]),
+            # the ANN index of the default distance, the cosine and inner
+            # product ones are only built while an org searches with them
+            # (retrieval.sync_vector_indexes)
+            HnswIndex(
+                name="embedding_vectors_l2_idx",
+                fields=["text_vectors"],
+                m=16,
+                ef_construction=64,
+                opclasses=["vector_l2_ops"],
+            ),
+        ]
+
+
+class QuestionEmbedding(models.Model):
+    """
+    Shared cache of question embeddings, keyed by a hash of the embedding model
+    and the normalized question text
+    """
+
+    id = models.AutoField(primary_key=True)
+    model = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64, unique=True)
+    text_vectors = VectorField(dimensions=1536)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "question_embedding"
+
+
+class AnswerCache(models.Model):
+    """
+    Previous answers, reused for near duplicate questions that start a new session
+    """
+
+    id = models.AutoField(primary_key=True)
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    knowledge_category = models.ForeignKey(
+        KnowledgeCategory, on_delete=models.CASCADE, null=True
+    )
+    # hash of the system prompt, examples text and gpt model the answer was generated with
+    prompt_version = models.CharField(max_length=64)
+    language = models.CharField(max_length=255)
+    question = models.TextField()
+    question_vectors = VectorField(dimensions=1536)
+    answer = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "answer_cache"
+        indexes = [
+            HnswIndex(
+                name="answer_cache_vectors_idx",
+                fields=["question_vectors"],
+                m=16,
+                ef_construction=64,
+                opclasses=["vector_cosine_ops"],
+            ),
+        ]
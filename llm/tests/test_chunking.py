@@ -0,0 +1,43 @@
+from django.test import SimpleTestCase
+
+from llm.utils.chunking import chunk_pages, content_hash
+
+HINDI_PAGES = [
+    (1, "पेशाब की जगह से खराश हो रही है। यह मूत्र मार्ग संक्रमण हो सकता है।"),
+    (2, "डॉक्टर से सलाह लें और पर्याप्त पानी पिएं। दवा का पूरा कोर्स करें।"),
+]
+
+
+class ChunkPagesTest(SimpleTestCase):
+    def document(self, pages):
+        return "".join(page_text + " " for _, page_text in pages)
+
+    def test_hindi_chunks_are_cut_on_character_boundaries(self):
+        document = self.document(HINDI_PAGES)
+        chunks = list(chunk_pages(iter(HINDI_PAGES), chunk_tokens=7, overlap_tokens=2))
+
+        self.assertGreater(len(chunks), 2)
+        for chunk in chunks:
+            self.assertNotIn("�", chunk.text)
+            self.assertEqual(chunk.text, document[chunk.start : chunk.end])
+
+    def test_chunks_cover_the_document(self):
+        document = self.document(HINDI_PAGES)
+        for overlap_tokens in (0, 3):
+            chunks = list(
+                chunk_pages(
+                    iter(HINDI_PAGES), chunk_tokens=9, overlap_tokens=overlap_tokens
+                )
+            )
+            self.assertEqual(chunks[0].start, 0)
+            self.assertEqual(chunks[-1].end, len(document))
+            for previous, chunk in zip(chunks, chunks[1:]):
+                self.assertLessEqual(chunk.start, previous.end)
+            self.assertEqual(chunks[-1].page_number, 2)
+
+    def test_content_hash_ignores_whitespace_only(self):
+        self.assertEqual(content_hash("दवा  का\nकोर्स"), content_hash(" दवा का कोर्स "))
+        self.assertNotEqual(content_hash("HIV test"), content_hash("hiv test"))
+        self.assertNotEqual(
+            content_hash("HIV test"), content_hash("HIV test", model="other-model")
+        )
@@ -20,11 +20,19 @@ from django.urls import path
 
 from llm.api import (
     create_chat,
+    acreate_chat,
+    acreate_chat_batch,
+    acreate_chat_stream,
+    get_metrics,
     set_system_prompt,
     FileUploadView,
+    get_upload_status,
     set_evaluator_prompt,
     set_examples_text,
     set_openai_key,
+    set_retrieval_config,
+    set_answer_cache,
+    set_language_detection_threshold,
     create_knowledge_category,
     get_knowledge_categories,
     delete_knowledge_category,
@@ -35,11 +43,23 @@ from llm.api import (
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/chat", create_chat, name="create_chat"),
+    path("api/chat/async", acreate_chat, name="acreate_chat"),
+    path("api/chat/batch", acreate_chat_batch, name="acreate_chat_batch"),
+    path("api/chat/stream", acreate_chat_stream, name="acreate_chat_stream"),
+    path("api/metrics", get_metrics, name="get_metrics"),
     path("api/upload", FileUploadView.as_view(), name="file_upload"),
+    path("api/upload/<str:job_uuid>", get_upload_status, name="get_upload_status"),
     path("api/system_prompt", set_system_prompt, name="set_system_prompt"),
     path("api/evaluator_prompt", set_evaluator_prompt, name="set_evaluator_prompt"),
     path("api/examples_text", set_examples_text, name="set_examples_text"),
     path("api/openai_key", set_openai_key, name="set_openai_key"),
+    path(
+        "api/language_detection",
+        set_language_detection_threshold,
+        name="set_language_detection_threshold",
+    ),
+    path("api/answer_cache", set_answer_cache, name="set_answer_cache"),
+    path("api/retrieval_config", set_retrieval_config, name="set_retrieval_config"),
     path(
         "api/knowledge/category",
         create_knowledge_category,
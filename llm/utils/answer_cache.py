@@ -0,0 +1,91 @@
+import hashlib
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+from django.db.models import Q
+from pgvector.django import CosineDistance
+
+from llm.models import Organization, KnowledgeCategory, AnswerCache
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+
+def prompt_version(
+    system_prompt: Union[str, None], examples_text: Union[str, None], gpt_model: str
+) -> str:
+    """
+    Answers are only reused for the exact prompt inputs they were generated with
+    """
+    return hashlib.sha256(
+        "\n".join([system_prompt or "", examples_text or "", gpt_model]).encode()
+    ).hexdigest()
+
+
+def lookup_answer(
+    organization: Organization,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    version: str,
+    language: str,
+    prompt_embeddings: list[float],
+) -> Union[AnswerCache, None]:
+    """
+    Closest previous answer whose question is within the org's similarity threshold
+    """
+    distance = CosineDistance("question_vectors", prompt_embeddings)
+
+    cached_answer = (
+        AnswerCache.objects.filter(
+            organization=organization,
+            knowledge_category=knowledge_cat,
+            prompt_version=version,
+            language=language,
+        )
+        .alias(distance=distance)
+        .filter(distance__lte=1 - organization.answer_cache_similarity)
+        .order_by(distance)
+        .first()
+    )
+
+    if cached_answer:
+        logger.info(f"answer cache hit on question: {cached_answer.question}")
+
+    return cached_answer
+
+
+def store_answer(
+    organization: Organization,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    version: str,
+    language: str,
+    prompt_embeddings: list[float],
+    question: str,
+    answer: str,
+) -> None:
+    AnswerCache.objects.create(
+        organization=organization,
+        knowledge_category=knowledge_cat,
+        prompt_version=version,
+        language=language,
+        question=question,
+        question_vectors=prompt_embeddings,
+        answer=answer,
+    )
+
+
+def invalidate_answers(
+    organization: Organization, knowledge_cat: Union[KnowledgeCategory, None] = None
+) -> None:
+    """
+    Without a category every cached answer of the org goes. With one, the answers
+    for that category and the category-less ones (which searched all of the org's
+    documents) go.
+    """
+    cached_answers = AnswerCache.objects.filter(organization=organization)
+    if knowledge_cat:
+        cached_answers = cached_answers.filter(
+            Q(knowledge_category=knowledge_cat) | Q(knowledge_category__isnull=True)
+        )
+    deleted, _ = cached_answers.delete()
+    if deleted:
+        logger.info(f"invalidated {deleted} cached answers for org {organization.name}")
@@ -0,0 +1,97 @@
+import os
+import hashlib
+from typing import Iterator, NamedTuple
+
+import tiktoken
+
+# chunk sizes in tokens of the encoder used by count_tokens_for_text
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 400))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 50))
+# the model chunks are embedded with, part of their content hash
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+class Chunk(NamedTuple):
+    text: str
+    num_tokens: int
+    page_number: int  # page the chunk starts on
+    start: int  # character offsets in the document text (pages joined by a space)
+    end: int
+
+
+def chunk_pages(
+    pages: Iterator[tuple[int, str]],
+    chunk_tokens: int = CHUNK_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> Iterator[Chunk]:
+    """
+    Slides a window of chunk_tokens tokens, overlapping by overlap_tokens, over the
+    text of all the pages. Pages are pulled one at a time so only the current
+    window and page are ever held in memory.
+    """
+    if not 0 <= overlap_tokens < chunk_tokens:
+        raise ValueError("overlap should be smaller than the chunk size")
+
+    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    stride = chunk_tokens - overlap_tokens
+
+    # token ids, their character offset in the document and their page
+    tokens: list[int] = []
+    offsets: list[int] = []
+    page_numbers: list[int] = []
+    # document text from the first token of the window on, starting at text_start
+    window_text = ""
+    text_start = 0
+    document_length = 0
+    emitted_until = 0  # tokens of the window already covered by an emitted chunk
+
+    def window(size: int) -> Chunk:
+        # cut from the text rather than decoding the tokens: a multibyte
+        # character (e.g. Devanagari) can be split across tokens, and a slice
+        # of tokens would decode the pieces at its edges to U+FFFD. A token
+        # that continues a character has the offset of that character.
+        start = offsets[0]
+        end = offsets[size] if size < len(tokens) else document_length
+        return Chunk(
+            text=window_text[start - text_start : end - text_start],
+            num_tokens=size,
+            page_number=page_numbers[0],
+            start=start,
+            end=end,
+        )
+
+    for page_number, page_text in pages:
+        if not page_text:
+            continue
+
+        page_text = page_text + " "
+        page_tokens = encoding.encode(page_text)
+        _, page_offsets = encoding.decode_with_offsets(page_tokens)
+
+        tokens += page_tokens
+        offsets += [document_length + offset for offset in page_offsets]
+        page_numbers += [page_number] * len(page_tokens)
+        window_text += page_text
+        document_length += len(page_text)
+
+        while len(tokens) >= chunk_tokens:
+            yield window(chunk_tokens)
+            del tokens[:stride], offsets[:stride], page_numbers[:stride]
+            new_start = offsets[0] if offsets else document_length
+            window_text = window_text[new_start - text_start :]
+            text_start = new_start
+            emitted_until = overlap_tokens
+
+    # the tail, unless it is only the overlap of the last chunk
+    if len(tokens) > emitted_until:
+        chunk = window(len(tokens))
+        if chunk.text.strip():
+            yield chunk
+
+
+def content_hash(text: str, model: str = EMBEDDING_MODEL) -> str:
+    """
+    Chunks are only whitespace normalized, case can change what a document says
+    """
+    normalized_text = " ".join(text.split())
+    return hashlib.sha256(f"{model}\n{normalized_text}".encode()).hexdigest()
@@ -0,0 +1,118 @@
+from logging import basicConfig, INFO, getLogger
+
+import numpy as np
+
+from llm.models import Organization, Embedding
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+def candidate_vectors(embedding_results: list[Embedding]) -> np.ndarray:
+    """
+    Unit vectors of the retrieved chunks, in their order. The retrieval
+    backends defer text_vectors, so they are read in one query. Chunks without
+    a vector get a zero vector, similar to nothing.
+    """
+    vectors_by_id = dict(
+        Embedding.objects.filter(
+            id__in=[embedding.id for embedding in embedding_results]
+        ).values_list("id", "text_vectors")
+    )
+    vectors = np.zeros((len(embedding_results), EMBEDDING_DIMENSIONS), np.float32)
+    for row, embedding in enumerate(embedding_results):
+        if vectors_by_id.get(embedding.id) is not None:
+            vectors[row] = vectors_by_id[embedding.id]
+    return normalize(vectors)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def dedup_order(similarity: np.ndarray, max_similarity: float) -> list[int]:
+    """
+    Rows in their order, without the ones at least max_similarity similar to
+    a row kept before them
+    """
+    kept = []
+    redundancy = np.zeros(len(similarity), np.float32)
+    for row in range(len(similarity)):
+        if redundancy[row] < max_similarity:
+            kept.append(row)
+            # highest similarity of every row to the rows kept so far
+            redundancy = np.maximum(redundancy, similarity[row])
+    return kept
+
+
+def mmr_order(
+    relevance: np.ndarray,
+    similarity: np.ndarray,
+    mmr_lambda: float,
+    max_similarity: float,
+) -> list[int]:
+    """
+    Maximal marginal relevance: repeatedly picks the row with the best
+    mmr_lambda * relevance - (1 - mmr_lambda) * similarity to the rows picked
+    so far. Rows at least max_similarity similar to a picked one are dropped.
+    """
+    remaining = np.ones(len(relevance), bool)
+    redundancy = np.zeros(len(relevance), np.float32)
+    order = []
+    while remaining.any():
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~remaining] = -np.inf
+        row = int(np.argmax(scores))
+        order.append(row)
+        remaining[row] = False
+        redundancy = np.maximum(redundancy, similarity[row])
+        remaining &= redundancy < max_similarity
+    return order
+
+
+def rank_relevance(relevance: np.ndarray) -> np.ndarray:
+    """
+    The relevances handed out in retrieval order, the best to the first row.
+    Hybrid results are ranked by their fused vector and full-text ranks, which
+    the similarity to the question alone would undo for keyword matches.
+    """
+    return np.sort(relevance)[::-1]
+
+
+def select_context(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    embedding_results: list[Embedding],
+) -> list[Embedding]:
+    """
+    The retrieved chunks in the order they should be packed into the prompt,
+    with the org's context_selection. Near-duplicate pages of overlapping
+    documents otherwise take a large share of the context window.
+    """
+    if organization.context_selection == "retrieval" or len(embedding_results) < 2:
+        return embedding_results
+
+    vectors = candidate_vectors(embedding_results)
+    similarity = vectors @ vectors.T
+
+    if organization.context_selection == "mmr":
+        relevance = vectors @ normalize(np.asarray(prompt_embeddings, np.float32))
+        if organization.retrieval_backend == "hybrid":
+            relevance = rank_relevance(relevance)
+        order = mmr_order(
+            relevance,
+            similarity,
+            organization.context_mmr_lambda,
+            organization.context_dedup_similarity,
+        )
+    else:
+        order = dedup_order(similarity, organization.context_dedup_similarity)
+
+    logger.info(
+        f"{organization.context_selection} context selection kept {len(order)}/{len(embedding_results)} chunks"
+    )
+
+    return [embedding_results[row] for row in order]
@@ -0,0 +1,235 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from logging import basicConfig, INFO, getLogger
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from llm.models import QuestionEmbedding
+from llm.utils import llm_client
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# in-memory tier, per worker
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+# shared tier, the question_embedding table
+EMBEDDING_CACHE_DB_SIZE = int(os.getenv("EMBEDDING_CACHE_DB_SIZE", 200000))
+# both tiers
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 60 * 60))
+
+# prune the shared tier every N inserts of this worker
+PRUNE_EVERY = 500
+
+_memory_cache: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+_lock = threading.Lock()
+_inserts_since_prune = 0
+
+stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+
+def cache_key(question: str, model: str = EMBEDDING_MODEL) -> str:
+    normalized_question = " ".join(question.lower().split())
+    return hashlib.sha256(f"{model}\n{normalized_question}".encode()).hexdigest()
+
+
+def _count(stat: str) -> None:
+    with _lock:
+        stats[stat] += 1
+    logger.info(f"question embedding cache {stat.replace('_', ' ')}, totals: {stats}")
+
+
+def _memory_get(key: str):
+    with _lock:
+        cached = _memory_cache.get(key)
+        if cached is None:
+            return None
+        stored_at, vector = cached
+        if time.time() - stored_at > EMBEDDING_CACHE_TTL:
+            del _memory_cache[key]
+            return None
+        _memory_cache.move_to_end(key)
+        return vector
+
+
+def _memory_set(key: str, vector: list[float], stored_at: float = None) -> None:
+    with _lock:
+        _memory_cache[key] = (stored_at or time.time(), vector)
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > EMBEDDING_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _db_query(key: str):
+    return QuestionEmbedding.objects.filter(
+        text_hash=key,
+        created_at__gte=timezone.now() - timedelta(seconds=EMBEDDING_CACHE_TTL),
+    )
+
+
+def _should_prune() -> bool:
+    global _inserts_since_prune
+    with _lock:
+        _inserts_since_prune += 1
+        if _inserts_since_prune < PRUNE_EVERY:
+            return False
+        _inserts_since_prune = 0
+        return True
+
+
+def prune() -> None:
+    """
+    Drop expired rows and keep only the newest EMBEDDING_CACHE_DB_SIZE rows
+    """
+    QuestionEmbedding.objects.filter(
+        created_at__lt=timezone.now() - timedelta(seconds=EMBEDDING_CACHE_TTL)
+    ).delete()
+    oldest_kept = (
+        QuestionEmbedding.objects.order_by("-id")
+        .values_list("id", flat=True)[
+            EMBEDDING_CACHE_DB_SIZE : EMBEDDING_CACHE_DB_SIZE + 1
+        ]
+        .first()
+    )
+    if oldest_kept is not None:
+        QuestionEmbedding.objects.filter(id__lte=oldest_kept).delete()
+
+
+def get_question_embedding(
+    question: str, model: str = EMBEDDING_MODEL, **openai_kwargs
+) -> list[float]:
+    """
+    Embedding of the question from the worker's LRU, then the shared table,
+    and only then from openai
+    """
+    key = cache_key(question, model)
+
+    vector = _memory_get(key)
+    if vector is not None:
+        _count("memory_hits")
+        return vector
+
+    cached = _db_query(key).first()
+    if cached is not None:
+        _count("db_hits")
+        vector = cached.text_vectors.tolist()
+        _memory_set(key, vector, cached.created_at.timestamp())
+        return vector
+
+    _count("misses")
+    response = llm_client.embedding(model=model, input=question, **openai_kwargs)
+    vector = response["data"][0]["embedding"]
+
+    _memory_set(key, vector)
+    QuestionEmbedding.objects.bulk_create(
+        [QuestionEmbedding(model=model, text_hash=key, text_vectors=vector)],
+        # an expired row for the same question is refreshed in place
+        update_conflicts=True,
+        unique_fields=["text_hash"],
+        update_fields=["text_vectors", "created_at"],
+    )
+    if _should_prune():
+        prune()
+
+    return vector
+
+
+async def aget_question_embedding(
+    question: str, model: str = EMBEDDING_MODEL, **openai_kwargs
+) -> list[float]:
+    key = cache_key(question, model)
+
+    vector = _memory_get(key)
+    if vector is not None:
+        _count("memory_hits")
+        return vector
+
+    cached = await _db_query(key).afirst()
+    if cached is not None:
+        _count("db_hits")
+        vector = cached.text_vectors.tolist()
+        _memory_set(key, vector, cached.created_at.timestamp())
+        return vector
+
+    _count("misses")
+    response = await llm_client.aembedding(model=model, input=question, **openai_kwargs)
+    vector = response["data"][0]["embedding"]
+
+    _memory_set(key, vector)
+    await QuestionEmbedding.objects.abulk_create(
+        [QuestionEmbedding(model=model, text_hash=key, text_vectors=vector)],
+        update_conflicts=True,
+        unique_fields=["text_hash"],
+        update_fields=["text_vectors", "created_at"],
+    )
+    if _should_prune():
+        await sync_to_async(prune)()
+
+    return vector
+
+
+async def aget_question_embeddings(
+    questions: list[str], model: str = EMBEDDING_MODEL, **openai_kwargs
+) -> list[list[float]]:
+    """
+    Embeddings of many questions, in order, with one openai request for all
+    the ones neither cache tier has
+    """
+    keys = [cache_key(question, model) for question in questions]
+    vectors = {}
+
+    for key in set(keys):
+        vector = _memory_get(key)
+        if vector is not None:
+            _count("memory_hits")
+            vectors[key] = vector
+
+    missing = set(keys) - vectors.keys()
+    if missing:
+        async for cached in QuestionEmbedding.objects.filter(
+            text_hash__in=missing,
+            created_at__gte=timezone.now() - timedelta(seconds=EMBEDDING_CACHE_TTL),
+        ):
+            _count("db_hits")
+            vector = cached.text_vectors.tolist()
+            _memory_set(cached.text_hash, vector, cached.created_at.timestamp())
+            vectors[cached.text_hash] = vector
+
+    # one question per missing key, in the order they were asked
+    to_embed = {}
+    for key, question in zip(keys, questions):
+        if key not in vectors and key not in to_embed:
+            to_embed[key] = question
+
+    if to_embed:
+        for _ in to_embed:
+            _count("misses")
+        response = await llm_client.aembedding(
+            model=model, input=list(to_embed.values()), **openai_kwargs
+        )
+        embedded = [
+            data["embedding"]
+            for data in sorted(response["data"], key=lambda data: data["index"])
+        ]
+        for key, vector in zip(to_embed, embedded):
+            _memory_set(key, vector)
+            vectors[key] = vector
+        await QuestionEmbedding.objects.abulk_create(
+            [
+                QuestionEmbedding(model=model, text_hash=key, text_vectors=vectors[key])
+                for key in to_embed
+            ],
+            update_conflicts=True,
+            unique_fields=["text_hash"],
+            update_fields=["text_vectors", "created_at"],
+        )
+        if _should_prune():
+            await sync_to_async(prune)()
+
+    return [vectors[key] for key in keys]
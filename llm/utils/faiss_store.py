@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+import faiss
+import numpy as np
+
+from llm.models import Embedding
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+EMBEDDING_DIMENSIONS = 1536
+
+# how often (seconds) a worker checks the db for rows written/deleted by other workers
+FAISS_SYNC_INTERVAL = int(os.getenv("FAISS_SYNC_INTERVAL", 30))
+
+BUILD_BATCH_SIZE = 2000
+
+
+class FaissIndex:
+    """
+    In-process exact (flat) index over the embeddings of one org, or of one
+    knowledge category of that org. Ids in the index are Embedding primary keys.
+    """
+
+    def __init__(
+        self, organization_id: int, category_id: Union[int, None], distance: str
+    ):
+        self.organization_id = organization_id
+        self.category_id = category_id
+        self.distance = distance
+        self.lock = threading.Lock()
+        self.index = None
+        self.max_id = 0
+        self.synced_at = 0.0
+
+    def scope(self):
+        query = Embedding.objects.filter(organization_id=self.organization_id)
+        if self.category_id is not None:
+            query = query.filter(file__knowledge_category_id=self.category_id)
+        return query
+
+    def _vectors(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(
+            -1, EMBEDDING_DIMENSIONS
+        )
+        if self.distance == "cosine":
+            vectors = np.ascontiguousarray(vectors)
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def _add(self, ids: list[int], vectors: list) -> None:
+        if not ids:
+            return
+        self.index.add_with_ids(self._vectors(vectors), np.asarray(ids, dtype=np.int64))
+        self.max_id = max(self.max_id, max(ids))
+
+    def _add_from_db(self, query) -> None:
+        ids, vectors = [], []
+        for embedding_id, text_vectors in (
+            query.exclude(text_vectors__isnull=True)
+            .values_list("id", "text_vectors")
+            .iterator(chunk_size=BUILD_BATCH_SIZE)
+        ):
+            ids.append(embedding_id)
+            vectors.append(text_vectors)
+            if len(ids) >= BUILD_BATCH_SIZE:
+                self._add(ids, vectors)
+                ids, vectors = [], []
+        self._add(ids, vectors)
+
+    def _build(self) -> None:
+        start = time.time()
+        flat_index = (
+            faiss.IndexFlatL2(EMBEDDING_DIMENSIONS)
+            if self.distance == "l2"
+            else faiss.IndexFlatIP(EMBEDDING_DIMENSIONS)
+        )
+        self.index = faiss.IndexIDMap2(flat_index)
+        self.max_id = 0
+        self._add_from_db(self.scope())
+        self.synced_at = time.time()
+        logger.info(
+            f"built faiss index for org {self.organization_id} category {self.category_id} with {self.index.ntotal} vectors in {time.time() - start:.2f}s"
+        )
+
+    def _sync(self) -> None:
+        """
+        Pick up rows inserted by other workers, and rebuild if the row count
+        still does not match (rows were deleted elsewhere)
+        """
+        self._add_from_db(self.scope().filter(id__gt=self.max_id))
+        if self.scope().exclude(text_vectors__isnull=True).count() != self.index.ntotal:
+            logger.info(
+                f"faiss index for org {self.organization_id} category {self.category_id} is stale, rebuilding"
+            )
+            self._build()
+        self.synced_at = time.time()
+
+    def search(self, prompt_embeddings: list[float], top_k: int) -> list[int]:
+        with self.lock:
+            if self.index is None:
+                self._build()
+            elif time.time() - self.synced_at > FAISS_SYNC_INTERVAL:
+                self._sync()
+
+            _, ids = self.index.search(self._vectors(prompt_embeddings), top_k)
+
+        return [int(embedding_id) for embedding_id in ids[0] if embedding_id != -1]
+
+    def add(self, embeddings: list[Embedding]) -> None:
+        with self.lock:
+            if self.index is None:
+                return  # built lazily on first search
+            self._add(
+                [embedding.id for embedding in embeddings],
+                [embedding.text_vectors for embedding in embeddings],
+            )
+
+    def remove(self, embedding_ids: list[int]) -> None:
+        with self.lock:
+            if self.index is None or not embedding_ids:
+                return
+            self.index.remove_ids(np.asarray(embedding_ids, dtype=np.int64))
+
+
+# (organization_id, category_id or None, distance) -> FaissIndex
+_indexes: dict[tuple, FaissIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(
+    organization_id: int, category_id: Union[int, None], distance: str
+) -> FaissIndex:
+    key = (organization_id, category_id, distance)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = FaissIndex(organization_id, category_id, distance)
+        return _indexes[key]
+
+
+def _loaded_indexes(organization_id: int, category_id: Union[int, None]):
+    with _indexes_lock:
+        return [
+            index
+            for (org_id, cat_id, _), index in _indexes.items()
+            if org_id == organization_id and cat_id in (None, category_id)
+        ]
+
+
+def search(
+    organization_id: int,
+    category_id: Union[int, None],
+    distance: str,
+    prompt_embeddings: list[float],
+    top_k: int,
+) -> list[int]:
+    """
+    Returns the ids of the top k nearest embeddings, nearest first
+    """
+    return get_index(organization_id, category_id, distance).search(
+        prompt_embeddings, top_k
+    )
+
+
+def add_embeddings(
+    organization_id: int, category_id: Union[int, None], embeddings: list[Embedding]
+) -> None:
+    """
+    Add freshly stored embeddings to the org and category indexes already loaded in this worker
+    """
+    for index in _loaded_indexes(organization_id, category_id):
+        index.add(embeddings)
+
+
+def remove_embeddings(
+    organization_id: int, category_id: Union[int, None], embedding_ids: list[int]
+) -> None:
+    """
+    Remove deleted embeddings from the org and category indexes already loaded in this worker
+    """
+    for index in _loaded_indexes(organization_id, category_id):
+        index.remove(embedding_ids)
+
+
+def drop_category(organization_id: int, category_id: int) -> None:
+    with _indexes_lock:
+        for key in [
+            key for key in _indexes if key[:2] == (organization_id, category_id)
+        ]:
+            del _indexes[key]
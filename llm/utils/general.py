@@ -1,6 +1,59 @@
+import os
+import json
 import string, secrets
+from concurrent.futures import ThreadPoolExecutor, Future
+from logging import basicConfig, INFO, getLogger
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", 4))
+
+_background_executor = ThreadPoolExecutor(
+    max_workers=BACKGROUND_WORKERS, thread_name_prefix="background"
+)
 
 
 def generate_session_id(length=6):
     alphanumeric = string.ascii_letters + string.digits
     return "".join(secrets.choice(alphanumeric) for _ in range(length))
+
+
+def config_number(data: dict, key: str, cast=float):
+    """
+    data[key] as a float (or as cast), a ValueError naming the key when it is
+    missing, null or not a number
+    """
+    try:
+        return cast(data[key])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        raise ValueError(
+            f"{key} should be {'an integer' if cast is int else 'a number'}"
+        )
+
+
+def sse_event(event: str, data: dict) -> str:
+    """
+    One server-sent event, data as a single line of json
+    """
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+def run_in_background(fn, *args, **kwargs) -> Future:
+    """
+    Run fn after the response has been sent, in this worker's background thread pool
+    """
+
+    def task():
+        try:
+            return fn(*args, **kwargs)
+        except Exception as error:
+            logger.error(f"Background task {fn.__name__} failed: {error}")
+        finally:
+            # each pool thread holds its own db connection
+            close_old_connections()
+
+    return _background_executor.submit(task)
@@ -0,0 +1,183 @@
+import os
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+from django.utils import timezone
+
+from llm.models import Message, SessionSummary
+from llm.utils import llm_client
+from llm.utils.prompt import count_tokens_for_text
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# tokens of past turns kept out of the summary, older turns are folded into it
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 1000))
+# most messages sent with a question, however short they are. Only reached when
+# summaries fail to keep up, the turns past it are then left out with a warning
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", 40))
+# most tokens of those messages, the same fallback for a few very long turns
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 2 * HISTORY_TOKEN_BUDGET))
+# messages that must have left the history budget before they are summarized
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", 4))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+
+
+def recent_messages(messages: list[Message]) -> list[Message]:
+    """
+    The newest messages (given newest first) that fit in the history budget,
+    returned oldest first
+    """
+    recent = []
+    token_count = 0
+    for message in messages:
+        token_count += count_tokens_for_text(message.message)
+        if token_count > HISTORY_TOKEN_BUDGET:
+            break
+        recent.append(message)
+    # start on a question, not on the answer to one that was cut off
+    while recent and recent[-1].role != "user":
+        recent.pop()
+    return recent[::-1]
+
+
+def unsummarized_messages_query(session_id: str, summarized_until: int):
+    """
+    Messages of the session the summary does not cover yet, newest first
+    """
+    return Message.objects.filter(
+        session_id=session_id, id__gt=summarized_until
+    ).order_by("-created_at", "-id")
+
+
+def history_messages(session_id: str, messages: list[Message]) -> list[Message]:
+    """
+    Every turn (given newest first, one more than HISTORY_MAX_MESSAGES read) the
+    summary does not cover yet, oldest first. Turns past the history budget stay
+    until the summary covers them, even if summarizing them failed, up to
+    HISTORY_MAX_MESSAGES messages and HISTORY_MAX_TOKENS tokens.
+    """
+    sent = len(messages)
+    if sent > HISTORY_MAX_MESSAGES:
+        logger.warning(
+            f"session {session_id} has more than {HISTORY_MAX_MESSAGES} messages not covered by its summary, sending the newest {HISTORY_MAX_MESSAGES}"
+        )
+        sent = HISTORY_MAX_MESSAGES
+    token_count = 0
+    for index, message in enumerate(messages[:sent]):
+        token_count += count_tokens_for_text(message.message)
+        if token_count > HISTORY_MAX_TOKENS:
+            logger.warning(
+                f"session {session_id} has more than {HISTORY_MAX_TOKENS} tokens not covered by its summary, sending the newest {index} messages"
+            )
+            sent = index
+            break
+    if sent < len(messages):
+        messages = messages[:sent]
+        while messages and messages[-1].role != "user":
+            messages.pop()
+    return messages[::-1]
+
+
+def load_history(session_id: str) -> tuple[Union[str, None], list[Message]]:
+    """
+    (summary of the earlier turns, turns since the summary oldest first) of the session
+    """
+    summary, summarized_until = SessionSummary.objects.filter(
+        session_id=session_id
+    ).values_list("summary", "summarized_until").first() or (None, 0)
+    messages = list(
+        unsummarized_messages_query(session_id, summarized_until)[
+            : HISTORY_MAX_MESSAGES + 1
+        ]
+    )
+    return summary, history_messages(session_id, messages)
+
+
+async def aload_history(session_id: str) -> tuple[Union[str, None], list[Message]]:
+    summary, summarized_until = await SessionSummary.objects.filter(
+        session_id=session_id
+    ).values_list("summary", "summarized_until").afirst() or (None, 0)
+    messages = [
+        message
+        async for message in unsummarized_messages_query(session_id, summarized_until)[
+            : HISTORY_MAX_MESSAGES + 1
+        ]
+    ]
+    return summary, history_messages(session_id, messages)
+
+
+def summary_messages(summary: Union[str, None], messages: list[Message]) -> list[dict]:
+    turns = "\n".join(f"{message.role}: {message.message}" for message in messages)
+    return [
+        {
+            "role": "system",
+            "content": f"You keep a running summary of a conversation between a user and a chatbot. Update the summary with the new turns. Keep what the user shared about themselves and the questions that were asked and answered. Reply in English with the summary only, in at most {SUMMARY_MAX_TOKENS // 2} words.",
+        },
+        {
+            "role": "user",
+            "content": f"Summary so far:\n{summary or 'None'}\n\nNew turns:\n{turns}",
+        },
+    ]
+
+
+def summarize_history(session_id: str, gpt_model: str, **openai_kwargs) -> None:
+    """
+    Fold the turns that fell out of the history budget into the session summary.
+    Runs in the background after a chat, so it never delays the response.
+    """
+    session_summary = SessionSummary.objects.filter(session_id=session_id).first()
+    summarized_until = session_summary.summarized_until if session_summary else 0
+
+    recent_ids = {
+        message.id
+        for message in recent_messages(
+            list(
+                unsummarized_messages_query(session_id, summarized_until)[
+                    :HISTORY_MAX_MESSAGES
+                ]
+            )
+        )
+    }
+    # the oldest turns first, a session that fell behind catches up over several chats
+    pending = [
+        message
+        for message in unsummarized_messages_query(
+            session_id, summarized_until
+        ).reverse()[:HISTORY_MAX_MESSAGES]
+        if message.id not in recent_ids
+    ]
+    if len(pending) < SUMMARY_MIN_MESSAGES:
+        return
+
+    response = llm_client.chat_completion(
+        model=gpt_model,
+        messages=summary_messages(
+            session_summary.summary if session_summary else None, pending
+        ),
+        max_tokens=SUMMARY_MAX_TOKENS,
+        **openai_kwargs,
+    )
+    summary = response.choices[0].message.content.strip()
+    summarized_until_now = max(message.id for message in pending)
+
+    if session_summary is None:
+        # unique session_id, a concurrent first summary makes this one fail
+        SessionSummary.objects.create(
+            session_id=session_id,
+            summary=summary,
+            summarized_until=summarized_until_now,
+        )
+    elif not SessionSummary.objects.filter(
+        id=session_summary.id, summarized_until=summarized_until
+    ).update(
+        summary=summary,
+        summarized_until=summarized_until_now,
+        updated_at=timezone.now(),
+    ):
+        # another chat of the session folded its turns first, the next one picks up these
+        return
+
+    logger.info(
+        f"folded {len(pending)} messages into the summary of session {session_id}"
+    )
@@ -0,0 +1,322 @@
+import os
+import time
+import tempfile
+import threading
+from datetime import timedelta
+from typing import Iterator, Union
+from logging import basicConfig, INFO, getLogger
+
+from django.db import transaction, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from llm.models import IngestionJob, Embedding, Organization
+from llm.utils import llm_client
+from llm.utils.chunking import Chunk, chunk_pages, content_hash
+from llm.utils.pdf_extraction import count_pages, extract_pages
+from llm.utils.retrieval import embeddings_added, embeddings_removed
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# seconds without a heartbeat after which a processing job is considered abandoned
+INGESTION_JOB_TIMEOUT = int(os.getenv("INGESTION_JOB_TIMEOUT", 600))
+
+# embedding requests are capped at 2048 inputs, and each input at 8191 tokens
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 32000))
+EMBEDDING_INSERT_BATCH_SIZE = int(os.getenv("EMBEDDING_INSERT_BATCH_SIZE", 500))
+
+
+def claim_job() -> Union[IngestionJob, None]:
+    """
+    Lock the oldest queued (or abandoned) job for this worker. SKIP LOCKED lets
+    any number of workers poll the same table without handing out a job twice.
+    """
+    abandoned_before = timezone.now() - timedelta(seconds=INGESTION_JOB_TIMEOUT)
+    with transaction.atomic():
+        job = (
+            IngestionJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status="queued")
+                | Q(status="processing", updated_at__lt=abandoned_before)
+            )
+            .order_by("id")
+            .first()
+        )
+        if job is None:
+            return None
+
+        job.status = "processing"
+        job.started_at = job.started_at or timezone.now()
+        job.save(update_fields=["status", "started_at", "updated_at"])
+
+    return job
+
+
+def read_pages(path: str, progress: dict) -> Iterator[tuple[int, str]]:
+    """
+    Yields (page_number, text), counting read and unreadable pages in progress
+    """
+    for page_number, page_text, error in extract_pages(path):
+        if error is not None:
+            logger.error(f"Could not extract page {page_number}: {error}")
+            progress["pages_failed"] += 1
+            continue
+        progress["pages_processed"] += 1
+        yield page_number, page_text.replace("\n", " ")
+
+
+def embedding_batches(
+    chunks: Iterator[Chunk],
+    max_tokens: int = EMBEDDING_BATCH_TOKENS,
+    max_inputs: int = EMBEDDING_BATCH_SIZE,
+) -> Iterator[list[Chunk]]:
+    """
+    Groups chunks into batches that fit in a single embedding request
+    """
+    batch, batch_tokens = [], 0
+    for chunk in chunks:
+        if batch and (
+            batch_tokens + chunk.num_tokens > max_tokens or len(batch) >= max_inputs
+        ):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += chunk.num_tokens
+    if batch:
+        yield batch
+
+
+def embed_texts(texts: list[str], **openai_kwargs) -> list[list[float]]:
+    """
+    One embedding request for all the texts, vectors returned in the same order
+    """
+    response = llm_client.embedding(
+        model="text-embedding-ada-002", input=texts, **openai_kwargs
+    )
+    vectors = [
+        data["embedding"] for data in sorted(response["data"], key=lambda d: d["index"])
+    ]
+    for vector in vectors:
+        if len(vector) != 1536:
+            raise ValueError(f"Invalid embedding length: #{len(vector)}")
+    return vectors
+
+
+def reusable_vectors(
+    organization: Organization, hashes: list[str]
+) -> dict[str, list[float]]:
+    """
+    Vectors the org already stored for any of the content hashes, by hash.
+    Never looked up across orgs, the reused counts of a job would tell
+    whether another org uploaded the same text.
+    """
+    vectors = {}
+    for content_hash, text_vectors in (
+        Embedding.objects.filter(
+            organization=organization, content_hash__in=set(hashes)
+        )
+        .exclude(text_vectors__isnull=True)
+        .order_by("content_hash")
+        .distinct("content_hash")
+        .values_list("content_hash", "text_vectors")
+    ):
+        vectors[content_hash] = text_vectors
+    return vectors
+
+
+def process_batch(job: IngestionJob, batch: list[Chunk]) -> list[Embedding]:
+    org = job.organization
+    file = job.file
+
+    start = time.time()
+    hashes = [content_hash(chunk.text) for chunk in batch]
+    vectors_by_hash = reusable_vectors(org, hashes)
+    reused = sum(1 for chunk_hash in hashes if chunk_hash in vectors_by_hash)
+
+    # identical chunks within the batch are embedded once
+    texts_to_embed = {
+        chunk_hash: chunk.text
+        for chunk_hash, chunk in zip(hashes, batch)
+        if chunk_hash not in vectors_by_hash
+    }
+    if texts_to_embed:
+        vectors = embed_texts(list(texts_to_embed.values()), api_key=org.openai_key)
+        vectors_by_hash.update(zip(texts_to_embed.keys(), vectors))
+    embed_seconds = time.time() - start
+
+    start = time.time()
+    new_embeddings = Embedding.objects.bulk_create(
+        [
+            Embedding(
+                source_name=file.name,
+                original_text=chunk.text,
+                text_vectors=vectors_by_hash[chunk_hash],
+                organization=org,
+                num_tokens=chunk.num_tokens,
+                file=file,
+                page_number=chunk.page_number,
+                chunk_start=chunk.start,
+                chunk_end=chunk.end,
+                content_hash=chunk_hash,
+            )
+            for chunk_hash, chunk in zip(hashes, batch)
+        ],
+        batch_size=EMBEDDING_INSERT_BATCH_SIZE,
+    )
+    insert_seconds = time.time() - start
+
+    batch_timing = {
+        "chunks": len(batch),
+        "reused": reused,
+        "embedded": len(texts_to_embed),
+        "tokens": sum(chunk.num_tokens for chunk in batch),
+        "embed_seconds": round(embed_seconds, 3),
+        "insert_seconds": round(insert_seconds, 3),
+    }
+    job.batch_timings.append(batch_timing)
+    logger.info(f"ingestion job {job.uuid} batch: {batch_timing}")
+
+    return new_embeddings
+
+
+def process_job(job: IngestionJob) -> None:
+    org = job.organization
+    file = job.file
+    knowledge_cat = file.knowledge_category
+    logger.info(f"processing ingestion job {job.uuid} for file {file.name}")
+
+    try:
+        # chunks can span pages, so a reclaimed job starts over. Its rows
+        # are looked up rather than its progress, a worker can die after
+        # inserting a batch but before counting it.
+        stale_embeddings = Embedding.objects.filter(file=file)
+        stale_ids = list(stale_embeddings.values_list("id", flat=True))
+        if stale_ids:
+            stale_embeddings.delete()
+            embeddings_removed(org, knowledge_cat, stale_ids)
+
+        # the extraction processes read the PDF from a file rather than each
+        # getting a copy of it
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(job.content)
+            pdf_file.flush()
+
+            progress = {
+                "pages_total": count_pages(pdf_file.name),
+                "pages_processed": 0,
+                "pages_failed": 0,
+                "chunks_processed": 0,
+                "chunks_failed": 0,
+            }
+            job.batch_timings = []
+
+            new_embeddings: list[Embedding] = []
+            chunks = chunk_pages(read_pages(pdf_file.name, progress))
+            for batch in embedding_batches(chunks):
+                try:
+                    new_embeddings += process_batch(job, batch)
+                    progress["chunks_processed"] += len(batch)
+                except Exception as error:
+                    logger.error(
+                        f"Error on chunks of pages {batch[0].page_number}-{batch[-1].page_number} of {file.name}: {error}"
+                    )
+                    progress["chunks_failed"] += len(batch)
+
+                IngestionJob.objects.filter(id=job.id).update(
+                    **progress,
+                    batch_timings=job.batch_timings,
+                    updated_at=timezone.now(),
+                )
+
+        embeddings_added(org, knowledge_cat, new_embeddings)
+
+        IngestionJob.objects.filter(id=job.id).update(**progress)
+        job.refresh_from_db()
+        if job.chunks_failed and not job.chunks_processed:
+            job.status = "failed"
+            job.error = "None of the chunks could be embedded"
+        elif job.pages_total and job.pages_failed == job.pages_total:
+            job.status = "failed"
+            job.error = "None of the pages could be read"
+        else:
+            job.status = "completed"
+    except Exception as error:
+        logger.error(f"Ingestion job {job.uuid} failed: {error}")
+        job.refresh_from_db()
+        job.status = "failed"
+        job.error = str(error)
+
+    job.content = None
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "content", "finished_at", "updated_at"])
+    logger.info(f"ingestion job {job.uuid} {job.status}")
+
+
+def process_next_job() -> bool:
+    """
+    Returns False when there was nothing to process
+    """
+    job = claim_job()
+    if job is None:
+        return False
+    process_job(job)
+    return True
+
+
+def run_worker(
+    concurrency: int = 1,
+    poll_interval: float = 2.0,
+    stop_event: Union[threading.Event, None] = None,
+) -> None:
+    """
+    Runs `concurrency` threads, each processing one job at a time, until stop_event is set
+    """
+    stop_event = stop_event or threading.Event()
+
+    def loop():
+        while not stop_event.is_set():
+            try:
+                processed = process_next_job()
+            except Exception as error:
+                logger.error(f"Ingestion worker error: {error}")
+                processed = False
+            finally:
+                close_old_connections()
+            if not processed:
+                stop_event.wait(poll_interval)
+
+    threads = [
+        threading.Thread(target=loop, name=f"ingestion-{i}", daemon=True)
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def job_status(job: IngestionJob) -> dict:
+    started_at = job.started_at
+    elapsed = (
+        ((job.finished_at or timezone.now()) - started_at).total_seconds()
+        if started_at
+        else 0
+    )
+    return {
+        "job_id": job.uuid,
+        "file": {"name": job.file.name, "uuid": job.file.uuid},
+        "status": job.status,
+        "pages_total": job.pages_total,
+        "pages_processed": job.pages_processed,
+        "pages_failed": job.pages_failed,
+        "chunks_processed": job.chunks_processed,
+        "chunks_failed": job.chunks_failed,
+        "pages_per_second": round(job.pages_processed / elapsed, 2) if elapsed else 0,
+        "batch_timings": job.batch_timings,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": started_at,
+        "finished_at": job.finished_at,
+    }
@@ -0,0 +1,199 @@
+import re
+from typing import Union
+from collections import Counter
+from logging import basicConfig, INFO, getLogger
+
+from llm.models import Organization
+from llm.utils.prompt import detect_languages, adetect_languages
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# unicode block -> language for the non latin scripts we see in our traffic
+SCRIPT_LANGUAGES = [
+    ((0x0900, 0x097F), "Hindi"),  # Devanagari, see MARATHI_WORDS
+    ((0x0980, 0x09FF), "Bengali"),
+    ((0x0A00, 0x0A7F), "Punjabi"),
+    ((0x0A80, 0x0AFF), "Gujarati"),
+    ((0x0B00, 0x0B7F), "Odia"),
+    ((0x0B80, 0x0BFF), "Tamil"),
+    ((0x0C00, 0x0C7F), "Telugu"),
+    ((0x0C80, 0x0CFF), "Kannada"),
+    ((0x0D00, 0x0D7F), "Malayalam"),
+    ((0x0600, 0x06FF), "Urdu"),
+]
+
+MARATHI_WORDS = {"आहे", "नाही", "काय", "आणि", "मला", "तुम्ही", "होते", "कसे"}
+
+ENGLISH_WORDS = set(
+    """
+    a an the is are was were be been am i me my we you your he she it they them
+    this that these those what which who whom why how when where do does did
+    can could should would will shall may might must have has had not no yes
+    and or but if of to in on at for from with about into after before during
+    there here any some all much many more most very too also only just so than
+    get got feel feeling pain period periods pregnant pregnancy doctor baby
+    please help tell know want need time day days after should safe normal
+    hi hello thanks thank ok okay
+    """.split()
+)
+
+# romanized hindi function words, pronouns and common verbs
+HINGLISH_WORDS = set(
+    """
+    hai hain ho hota hoti hote hua hui hue tha thi raha rahi rahe rha rhi
+    ka ki ke ko se mein mai pe tak bhi toh aur ya lekin kyun
+    kyu kyon kya kaise kaisa kaisi kab kahan kaun kitna kitni kitne jab tab
+    mujhe mujhko mera meri mere hum hamara hamari aap aapka aapki aapke tum
+    tumhara tera teri yeh ye woh wo vo unka unki iska iski uska uski apna apni
+    nahi nahin haan ji accha acha theek thik sahi bahut bohot zyada kam
+    karna karne karo kare karu karta karti kar kiya kiye liye chahiye sakta
+    sakti sakte hoga hogi jana jaana jata jati aana aata aati dena deta deti
+    lena leta leti baat samasya dard raat abhi pehle baad sath
+    jagah wala wali wale kuch sab koi kisi
+    """.split()
+)
+
+# word endings that are common in romanized hindi verbs/postpositions and rare in english
+HINGLISH_SUFFIXES = (
+    "aa",
+    "ee",
+    "oon",
+    "iye",
+    "ega",
+    "egi",
+    "enge",
+    "kar",
+    "wala",
+    "wali",
+)
+
+WORD_PATTERN = re.compile(r"[a-z']+")
+
+
+def script_language(text: str) -> tuple[str, float]:
+    """
+    Returns the dominant script language among the letters and the share of
+    letters written in it. "English" stands for any latin script text
+    """
+    scripts = Counter()
+    for char in text:
+        if not char.isalpha():
+            continue
+        code = ord(char)
+        if code < 0x0250:
+            scripts["English"] += 1
+            continue
+        for (start, end), language in SCRIPT_LANGUAGES:
+            if start <= code <= end:
+                scripts[language] += 1
+                break
+        else:
+            scripts["Other"] += 1
+
+    total = sum(scripts.values())
+    if total == 0:
+        return "Other", 0.0
+
+    language, count = scripts.most_common(1)[0]
+    return language, count / total
+
+
+def latin_language(text: str) -> tuple[str, float]:
+    """
+    English vs romanized hindi from function words and hindi specific word endings
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if not words:
+        return "English", 0.0
+
+    english_score = hinglish_score = 0.0
+    for word in words:
+        if word in HINGLISH_WORDS:
+            hinglish_score += 1
+        elif word in ENGLISH_WORDS:
+            english_score += 1
+        elif len(word) > 3 and word.endswith(HINGLISH_SUFFIXES):
+            hinglish_score += 0.5
+
+    matched = english_score + hinglish_score
+    if matched == 0:
+        return "English", 0.0
+
+    # confident once one side dominates and at least half the words were recognized
+    coverage = min(1.0, 2 * matched / len(words))
+    if hinglish_score > english_score:
+        return "Hindi (romanized)", coverage * hinglish_score / matched
+    return "English", coverage * english_score / matched
+
+
+def local_language_detection(question: str) -> dict:
+    """
+    CPU only language detection, same shape as the detect_languages function call.
+    Non english questions are passed through untranslated, the completion model
+    answers them directly in the detected language.
+    """
+    language, confidence = script_language(question)
+
+    if language == "English":
+        latin, latin_confidence = latin_language(question)
+        language, confidence = latin, confidence * latin_confidence
+    elif language == "Hindi" and MARATHI_WORDS & set(question.split()):
+        language = "Marathi"
+    elif language == "Other":
+        confidence = 0.0
+
+    return {
+        "language": language,
+        "confidence": round(confidence, 2),
+        "english_translation": question,
+        "translation_confidence": 1.0 if language == "English" else 0.0,
+        "detector": "local",
+    }
+
+
+def english_question(language_results: dict) -> Union[str, None]:
+    """
+    The question in english, None when local detection passed a non english
+    question through untranslated
+    """
+    if (
+        language_results["language"] == "English"
+        or language_results.get("detector") == "openai"
+    ):
+        return language_results["english_translation"]
+    return None
+
+
+def detect_language(
+    question: str, organization: Organization, gpt_model: str, **openai_kwargs
+) -> dict:
+    """
+    Language detection stage: local detection first, the detect_languages
+    function call only when local confidence is under the org's threshold
+    """
+    language_results = local_language_detection(question)
+    if language_results["confidence"] >= organization.language_detection_threshold:
+        return language_results
+
+    logger.info(
+        f"Local language detection not confident ({language_results['language']}: {language_results['confidence']}), falling back to openai"
+    )
+    language_results = detect_languages(question, gpt_model, **openai_kwargs)
+    language_results["detector"] = "openai"
+    return language_results
+
+
+async def adetect_language(
+    question: str, organization: Organization, gpt_model: str, **openai_kwargs
+) -> dict:
+    language_results = local_language_detection(question)
+    if language_results["confidence"] >= organization.language_detection_threshold:
+        return language_results
+
+    logger.info(
+        f"Local language detection not confident ({language_results['language']}: {language_results['confidence']}), falling back to openai"
+    )
+    language_results = await adetect_languages(question, gpt_model, **openai_kwargs)
+    language_results["detector"] = "openai"
+    return language_results
@@ -0,0 +1,178 @@
+import os
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from logging import basicConfig, INFO, getLogger
+
+import aiohttp
+import openai
+import requests
+from django.core.handlers.asgi import ASGIRequest
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from llm.utils.metrics import record_usage
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 60))
+# retries on rate limits, timeouts and openai 5xx, with exponential backoff
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_MAX_BACKOFF = float(os.getenv("LLM_MAX_BACKOFF", 20))
+# keep-alive connections to openai held by this worker
+LLM_HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", 32))
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+# one pool for every thread, the api key goes in the headers of each call so
+# connections can be shared between orgs
+_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=LLM_HTTP_POOL_SIZE, max_retries=0
+)
+
+
+class PooledSession(requests.Session):
+    """
+    openai keeps a session per thread and closes it every few minutes, closing
+    it must leave the pool shared with the other threads open
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mount("https://", _adapter)
+        self.mount("http://", _adapter)
+
+    def close(self):
+        pass
+
+
+openai.requestssession = PooledSession
+
+# aiohttp sessions are tied to their event loop
+_aiosessions: dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+_aiosessions_lock = threading.Lock()
+
+
+def _loop_aiosession() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    with _aiosessions_lock:
+        session = _aiosessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=LLM_HTTP_POOL_SIZE)
+            )
+            _aiosessions[loop] = session
+        return session
+
+
+@asynccontextmanager
+async def pooled_aiosession(request):
+    """
+    Async openai calls made inside share the event loop's keep-alive session,
+    including the ones in tasks started inside. Under ASGI the loop, and so the
+    session, lives as long as the worker. Under WSGI every request runs in a
+    loop of its own, so the session is closed with the request.
+    """
+    session = _loop_aiosession()
+    token = openai.aiosession.set(session)
+    try:
+        yield session
+    finally:
+        openai.aiosession.reset(token)
+        if not isinstance(request, ASGIRequest):
+            with _aiosessions_lock:
+                _aiosessions.pop(asyncio.get_running_loop(), None)
+            await session.close()
+
+
+def _log_retry(retry_state) -> None:
+    logger.info(
+        f"openai call failed ({retry_state.outcome.exception()}), retry {retry_state.attempt_number}/{LLM_MAX_RETRIES}"
+    )
+
+
+_retrying = retry(
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    wait=wait_random_exponential(min=1, max=LLM_MAX_BACKOFF),
+    stop=stop_after_attempt(LLM_MAX_RETRIES + 1),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+
+
+class LLMClient:
+    """
+    openai calls billed to one api key, with timeouts and retries
+    """
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    def _kwargs(self, kwargs: dict) -> dict:
+        return {
+            "api_key": self.api_key,
+            "request_timeout": (LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT),
+            **kwargs,
+        }
+
+    @_retrying
+    def chat_completion(self, **kwargs):
+        response = openai.ChatCompletion.create(**self._kwargs(kwargs))
+        record_usage(response)
+        return response
+
+    @_retrying
+    async def achat_completion(self, **kwargs):
+        response = await openai.ChatCompletion.acreate(**self._kwargs(kwargs))
+        record_usage(response)
+        return response
+
+    @_retrying
+    def embedding(self, **kwargs):
+        return openai.Embedding.create(**self._kwargs(kwargs))
+
+    @_retrying
+    async def aembedding(self, **kwargs):
+        return await openai.Embedding.acreate(**self._kwargs(kwargs))
+
+
+_clients: dict[str, LLMClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key: str) -> LLMClient:
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = LLMClient(api_key)
+        return _clients[api_key]
+
+
+# the **openai_kwargs threaded through the pipeline carry the org's api_key
+
+
+def chat_completion(api_key: str, **kwargs):
+    return get_client(api_key).chat_completion(**kwargs)
+
+
+async def achat_completion(api_key: str, **kwargs):
+    return await get_client(api_key).achat_completion(**kwargs)
+
+
+def embedding(api_key: str, **kwargs):
+    return get_client(api_key).embedding(**kwargs)
+
+
+async def aembedding(api_key: str, **kwargs):
+    return await get_client(api_key).aembedding(**kwargs)
@@ -0,0 +1,181 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+from llm.models import Organization
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# the metrics endpoint needs "Authorization: Bearer <METRICS_TOKEN>", it is
+# disabled when no token is set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+ROW_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 200)
+
+CHAT_REQUEST_SECONDS = Histogram(
+    "chat_request_seconds",
+    "Time to answer a chat request",
+    ["org_id", "model", "endpoint"],
+    buckets=STAGE_BUCKETS,
+)
+CHAT_STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Time spent in each stage of the chat pipeline",
+    ["org_id", "model", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+CHAT_TOKENS = Histogram(
+    "chat_tokens",
+    "OpenAI tokens used per chat request, kind is prompt or completion",
+    ["org_id", "model", "kind"],
+    buckets=TOKEN_BUCKETS,
+)
+CHAT_RETRIEVAL_ROWS = Histogram(
+    "chat_retrieval_rows",
+    "Document chunks retrieved per chat request",
+    ["org_id", "model"],
+    buckets=ROW_BUCKETS,
+)
+
+# the metrics of the chat being answered, openai usage is added to them
+_current: ContextVar[Union["ChatMetrics", None]] = ContextVar(
+    "chat_metrics", default=None
+)
+
+
+class ChatMetrics:
+    """
+    Stage timings, token counts and retrieved rows of one chat request
+    """
+
+    def __init__(self, endpoint: str, organization: Organization, model_family: str):
+        """
+        Labelled with the org's id and the family of the model (token_budget's
+        model_family), so clients can't create new series at will
+        """
+        self.endpoint = endpoint
+        self.org = str(organization.id)
+        self.model = model_family
+        self.stages: dict[str, float] = {}
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.retrieval_rows: Union[int, None] = None
+        self.started_at = time.perf_counter()
+        self.total: Union[float, None] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    async def timed(self, name: str, awaitable):
+        """
+        Await under a stage timer, for stages that run concurrently
+        """
+        with self.stage(name):
+            return await awaitable
+
+    @contextmanager
+    def active(self):
+        """
+        Count the usage of the openai calls made inside towards this request
+        """
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        self.tokens["prompt"] += prompt_tokens
+        self.tokens["completion"] += completion_tokens
+
+    def finish(self) -> None:
+        """
+        Stop the clock and add this request to the histograms
+        """
+        if self.total is not None:
+            return
+        self.total = time.perf_counter() - self.started_at
+
+        CHAT_REQUEST_SECONDS.labels(self.org, self.model, self.endpoint).observe(
+            self.total
+        )
+        for name, seconds in self.stages.items():
+            CHAT_STAGE_SECONDS.labels(self.org, self.model, name).observe(seconds)
+        for kind, tokens in self.tokens.items():
+            CHAT_TOKENS.labels(self.org, self.model, kind).observe(tokens)
+        if self.retrieval_rows is not None:
+            CHAT_RETRIEVAL_ROWS.labels(self.org, self.model).observe(
+                self.retrieval_rows
+            )
+
+    def as_dict(self) -> dict:
+        return {
+            "stages_ms": {
+                name: round(seconds * 1000, 1) for name, seconds in self.stages.items()
+            },
+            "total_ms": round(
+                (self.total or time.perf_counter() - self.started_at) * 1000, 1
+            ),
+            "tokens": self.tokens,
+            "retrieval_rows": self.retrieval_rows,
+        }
+
+    def server_timing(self) -> str:
+        """
+        Server-Timing header value, e.g. language;dur=2.1, retrieval;dur=14.3;desc="20 rows"
+        """
+        entries = []
+        for name, seconds in self.stages.items():
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if name == "retrieval" and self.retrieval_rows is not None:
+                entry += f';desc="{self.retrieval_rows} rows"'
+            entries.append(entry)
+        entries.append(
+            f'tokens;desc="prompt={self.tokens["prompt"]} completion={self.tokens["completion"]}"'
+        )
+        total = self.total or time.perf_counter() - self.started_at
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def record_usage(response) -> None:
+    """
+    Add the token usage of an openai response to the current chat's metrics
+    """
+    metrics = _current.get()
+    # streamed responses are generators, without usage
+    usage = response.get("usage") if isinstance(response, dict) else None
+    if metrics is None or not usage:
+        return
+    metrics.add_tokens(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+
+def render_metrics() -> bytes:
+    """
+    The histograms in Prometheus text format. With PROMETHEUS_MULTIPROC_DIR
+    set, the samples of every gunicorn worker are merged.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
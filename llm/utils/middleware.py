@@ -1,30 +1,51 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.http import Http404
 from django.http import JsonResponse
 from rest_framework.response import Response
 from rest_framework import status
-from llm.models import Organization
+from llm.utils.org_cache import get_organization, aget_organization
 from logging import basicConfig, INFO, getLogger
 
 basicConfig(level=INFO)
 logger = getLogger()
 
+# paths served without an org api key, the metrics view checks a token of its own
+PUBLIC_PATHS = ("/api/metrics",)
+
 
 class CustomMiddleware:
+    # lets async views (served via llm.asgi) run without a thread hop for this middleware
+    sync_capable = True
+    async_capable = True
+
     @staticmethod
     def current_organization(request):
         api_key = request.headers.get("Authorization")
         if not api_key:
             return None
 
-        try:
-            return Organization.objects.get(api_key=api_key)
-        except Organization.DoesNotExist:
+        return get_organization(api_key)
+
+    @staticmethod
+    async def acurrent_organization(request):
+        api_key = request.headers.get("Authorization")
+        if not api_key:
             return None
 
+        return await aget_organization(api_key)
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        if request.path in PUBLIC_PATHS:
+            return self.get_response(request)
+
         # Code to be executed for each request before
         # the view (and later middleware) are called.
         logger.info("routing request via the middleware")
@@ -44,3 +65,20 @@ class CustomMiddleware:
         # the view is called.
 
         return response
+
+    async def __acall__(self, request):
+        logger.info("routing request via the async middleware")
+
+        if request.path in PUBLIC_PATHS:
+            return await self.get_response(request)
+
+        org = await CustomMiddleware.acurrent_organization(request)
+
+        if not org:
+            return JsonResponse(
+                {"error": "Invalid API key"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        request.org = org
+        return await self.get_response(request)
@@ -0,0 +1,112 @@
+import os
+import copy
+import time
+import threading
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+from django.db.models import F
+
+from llm.models import Organization
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# seconds a cached org is served before it is reloaded from the db
+ORG_CACHE_TTL = int(os.getenv("ORG_CACHE_TTL", 300))
+# seconds a cached org is served before checking its config_version, which
+# catches updates made through other workers
+ORG_CACHE_VERSION_CHECK = float(os.getenv("ORG_CACHE_VERSION_CHECK", 5))
+
+
+class CachedOrganization:
+    def __init__(self, organization: Organization):
+        self.organization = organization
+        self.loaded_at = self.checked_at = time.time()
+
+
+# api key -> CachedOrganization
+_organizations: dict[str, CachedOrganization] = {}
+_lock = threading.Lock()
+
+
+def _cached(api_key: str) -> Union[CachedOrganization, None]:
+    with _lock:
+        cached = _organizations.get(api_key)
+    if cached is None or time.time() - cached.loaded_at > ORG_CACHE_TTL:
+        return None
+    return cached
+
+
+def _store(api_key: str, organization: Organization) -> None:
+    with _lock:
+        _organizations[api_key] = CachedOrganization(organization)
+
+
+def _is_current(cached: CachedOrganization, version: Union[int, None]) -> bool:
+    if version != cached.organization.config_version:
+        return False
+    cached.checked_at = time.time()
+    return True
+
+
+def _needs_version_check(cached: CachedOrganization) -> bool:
+    return time.time() - cached.checked_at > ORG_CACHE_VERSION_CHECK
+
+
+def get_organization(api_key: str) -> Union[Organization, None]:
+    """
+    The org for the api key, from this worker's cache when it is still current.
+    Each request gets its own copy, so views can't change the cached one.
+    """
+    cached = _cached(api_key)
+    if cached is not None and _needs_version_check(cached):
+        version = (
+            Organization.objects.filter(id=cached.organization.id)
+            .values_list("config_version", flat=True)
+            .first()
+        )
+        if not _is_current(cached, version):
+            cached = None
+
+    if cached is None:
+        organization = Organization.objects.filter(api_key=api_key).first()
+        if organization is None:
+            return None
+        _store(api_key, organization)
+        return copy.copy(organization)
+
+    return copy.copy(cached.organization)
+
+
+async def aget_organization(api_key: str) -> Union[Organization, None]:
+    cached = _cached(api_key)
+    if cached is not None and _needs_version_check(cached):
+        version = await (
+            Organization.objects.filter(id=cached.organization.id)
+            .values_list("config_version", flat=True)
+            .afirst()
+        )
+        if not _is_current(cached, version):
+            cached = None
+
+    if cached is None:
+        organization = await Organization.objects.filter(api_key=api_key).afirst()
+        if organization is None:
+            return None
+        _store(api_key, organization)
+        return copy.copy(organization)
+
+    return copy.copy(cached.organization)
+
+
+def update_organization(organization: Organization, **fields) -> None:
+    """
+    Write org settings and bump config_version, so every worker reloads the org
+    """
+    Organization.objects.filter(id=organization.id).update(
+        **fields, config_version=F("config_version") + 1
+    )
+    with _lock:
+        _organizations.pop(organization.api_key, None)
+    logger.info(f"updated {', '.join(fields)} for org {organization.name}")
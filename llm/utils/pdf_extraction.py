@@ -0,0 +1,108 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, Union
+from logging import basicConfig, INFO, getLogger
+
+from pypdf import PdfReader
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# processes extracting page text, shared by all the jobs of this worker
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", os.cpu_count() or 1))
+# pages handed to a process at a time
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 8))
+# page ranges submitted ahead of the one being consumed, per process
+PDF_TASKS_IN_FLIGHT = 2
+
+_pool: Union[ProcessPoolExecutor, None] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, the ingestion worker and web server are multithreaded and
+            # forking them could copy a held lock into the child
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACTION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _reset_pool(pool: ProcessPoolExecutor) -> None:
+    """
+    A process that died (e.g. killed for memory) breaks the pool for good,
+    the next extraction starts a new one
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def extract_page_range(
+    path: str, start: int, end: int
+) -> list[tuple[int, Union[str, None], Union[str, None]]]:
+    """
+    Runs in a pool process: (page_number, text, error) for pages start to end - 1
+    """
+    pdf_reader = PdfReader(path)
+    pages = []
+    for page_number in range(start, end):
+        try:
+            pages.append(
+                (page_number, pdf_reader.pages[page_number].extract_text(), None)
+            )
+        except Exception as error:
+            pages.append((page_number, None, str(error)))
+    return pages
+
+
+def count_pages(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def extract_pages(
+    path: str,
+    workers: int = PDF_EXTRACTION_WORKERS,
+    pages_per_task: int = PDF_PAGES_PER_TASK,
+) -> Iterator[tuple[int, Union[str, None], Union[str, None]]]:
+    """
+    Yields (page_number, text, error) for every page of the PDF at path, in page
+    order. Page ranges are extracted in a process pool with only a few ranges
+    per process in flight, so memory stays bounded however long the PDF is.
+    """
+    num_pages = count_pages(path)
+    ranges = deque(
+        (start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    )
+
+    # not worth a round trip to the pool
+    if workers <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            yield from extract_page_range(path, start, end)
+        return
+
+    pool = _get_pool()
+    in_flight = deque()
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < workers * PDF_TASKS_IN_FLIGHT:
+                start, end = ranges.popleft()
+                in_flight.append(pool.submit(extract_page_range, path, start, end))
+            yield from in_flight.popleft().result()
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        raise
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -1,6 +1,11 @@
 from llm.models import Message, Organization, Embedding
-import openai
+from llm.utils import llm_client
+import json
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
+from functools import lru_cache
 import tiktoken
 from logging import basicConfig, INFO, getLogger
 
@@ -8,19 +13,97 @@ basicConfig(level=INFO)
 logger = getLogger()
 
 
+DETECT_LANGUAGES_FUNCTION = {
+    "name": "detect_languages",
+    "description": "Detecting language and other insights on a piece of user input text.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "language": {
+                "title": "Language",
+                "description": "The primary detected language e.g English, French, Hindi, etc",
+                "type": "string",
+            },
+            "confidence": {
+                "title": "Confidence",
+                "description": "Confidence level of the language detection from scale of 0 to 1",
+                "type": "number",
+            },
+            "english_translation": {
+                "title": "English translation",
+                "description": "English translation of the user input text if not in English",
+                "type": "string",
+            },
+            "translation_confidence": {
+                "title": "Confidence",
+                "description": "Confidence level of the language translation to English from scale of 0 to 1",
+                "type": "number",
+            },
+        },
+        "required": [
+            "language",
+            "confidence",
+            "english_translation",
+            "translation_confidence",
+        ],
+    },
+}
+
+
+def detect_languages_request(question: str, gpt_model: str) -> dict:
+    return {
+        "model": gpt_model,
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Detect the languages in this text: {question}",
+            }
+        ],
+        "functions": [DETECT_LANGUAGES_FUNCTION],
+        "function_call": {"name": "detect_languages"},
+        "temperature": 0,
+    }
+
+
+def detect_languages(question: str, gpt_model: str, **openai_kwargs) -> dict:
+    """
+    Function calling to detect the language of the question and translate it to english
+    """
+    response = llm_client.chat_completion(
+        **detect_languages_request(question, gpt_model), **openai_kwargs
+    )
+    return json.loads(response["choices"][0]["message"]["function_call"]["arguments"])
+
+
+async def adetect_languages(question: str, gpt_model: str, **openai_kwargs) -> dict:
+    response = await llm_client.achat_completion(
+        **detect_languages_request(question, gpt_model), **openai_kwargs
+    )
+    return json.loads(response["choices"][0]["message"]["function_call"]["arguments"])
+
+
 def context_prompt_messages(
     system_prompt: str,
-    organization_id: int,
+    organization: Organization,
     language: str,
     english_context: str,
     question: str,
     historical_chats: list[Message],
+    history_summary: Union[str, None] = None,
 ) -> list[dict]:
-    org = Organization.objects.filter(id=organization_id).first()
-
-    examples_text = org.examples_text
+    examples_text = organization.examples_text
 
     system_message_prompt = {"role": "system", "content": system_prompt}
+    summary_message_prompts = (
+        [
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {history_summary}",
+            }
+        ]
+        if history_summary
+        else []
+    )
     human_message_prompt = {
         "role": "user",
         "content": f"""Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
@@ -39,25 +122,48 @@ def context_prompt_messages(
 
     chat_prompt_messages = (
         [system_message_prompt]
+        + summary_message_prompts
         + [{"role": chat.role, "content": chat.message} for chat in historical_chats]
         + [human_message_prompt]
     )
     return chat_prompt_messages
 
 
+def evaluator_messages(evaluator_prompt: str, prompt: str, response) -> list[dict]:
+    # replace the place holders for question and response in the evaluator prompt
+    evaluator_prompt = evaluator_prompt.replace("[[QUESTION]]", prompt).replace(
+        "[[RESPONSE]]", response.content
+    )
+    return [{"role": "system", "content": evaluator_prompt}]
+
+
 def evaluate_criteria_score(
-    evaluator_prompt: str, prompt: str, response: str, gpt_model: str
+    evaluator_prompt: str, prompt: str, response: str, gpt_model: str, **openai_kwargs
 ) -> Union[int, None]:
     evaluation_score: Union[int, None] = None
     if evaluator_prompt is not None:
-        # replace the place holders for question and response in the evaluator prompt
-        evaluator_prompt = evaluator_prompt.replace("[[QUESTION]]", prompt).replace(
-            "[[RESPONSE]]", response.content
+        response = llm_client.chat_completion(
+            model=gpt_model,
+            messages=evaluator_messages(evaluator_prompt, prompt, response),
+            **openai_kwargs,
         )
+        response_text = response.choices[0].message.content
+
+        logger.info(f"response_text: {response_text}")
+        evaluation_score = int(response_text)
+
+    return evaluation_score
+
 
-        response = openai.ChatCompletion.create(
+async def aevaluate_criteria_score(
+    evaluator_prompt: str, prompt: str, response: str, gpt_model: str, **openai_kwargs
+) -> Union[int, None]:
+    evaluation_score: Union[int, None] = None
+    if evaluator_prompt is not None:
+        response = await llm_client.achat_completion(
             model=gpt_model,
-            messages=[{"role": "system", "content": evaluator_prompt}],
+            messages=evaluator_messages(evaluator_prompt, prompt, response),
+            **openai_kwargs,
         )
         response_text = response.choices[0].message.content
 
@@ -67,11 +173,104 @@ def evaluate_criteria_score(
     return evaluation_score
 
 
+def evaluate_response(
+    evaluator_prompts: dict,
+    prompt: str,
+    response,
+    gpt_model: str,
+    **openai_kwargs,
+) -> dict:
+    """
+    Scores every criteria concurrently, returns { criteria: score }
+    """
+    if not evaluator_prompts:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(evaluator_prompts)) as executor:
+        # each call runs in a copy of this context, so its usage counts towards the request
+        futures = {
+            criteria: executor.submit(
+                contextvars.copy_context().run,
+                evaluate_criteria_score,
+                evaluator_prompt,
+                prompt,
+                response,
+                gpt_model,
+                **openai_kwargs,
+            )
+            for criteria, evaluator_prompt in evaluator_prompts.items()
+        }
+        evaluation_scores = {
+            criteria: future.result() for criteria, future in futures.items()
+        }
+
+    logger.info(f"Evaluated criteria scores: {evaluation_scores}")
+    return evaluation_scores
+
+
+async def aevaluate_response(
+    evaluator_prompts: dict,
+    prompt: str,
+    response,
+    gpt_model: str,
+    **openai_kwargs,
+) -> dict:
+    if not evaluator_prompts:
+        return {}
+
+    scores = await asyncio.gather(
+        *[
+            aevaluate_criteria_score(
+                evaluator_prompt, prompt, response, gpt_model, **openai_kwargs
+            )
+            for evaluator_prompt in evaluator_prompts.values()
+        ]
+    )
+    evaluation_scores = dict(zip(evaluator_prompts.keys(), scores))
+
+    logger.info(f"Evaluated criteria scores: {evaluation_scores}")
+    return evaluation_scores
+
+
+def evaluate_messages(
+    message_ids: list[int],
+    evaluator_prompts: dict,
+    prompt: str,
+    response,
+    gpt_model: str,
+    **openai_kwargs,
+) -> dict:
+    """
+    Deferred evaluation: scores the response and writes the scores on the stored messages
+    """
+    evaluation_scores = evaluate_response(
+        evaluator_prompts, prompt, response, gpt_model, **openai_kwargs
+    )
+    Message.objects.filter(id__in=message_ids).update(
+        evaluation_score=evaluation_scores
+    )
+    logger.info(f"Stored deferred evaluation scores for messages {message_ids}")
+    return evaluation_scores
+
+
+@lru_cache(maxsize=None)
+def encoding_for_model(model: str) -> tiktoken.Encoding:
+    """
+    The model's tiktoken encoder, loaded once per model. Models tiktoken does
+    not know get the encoder of gpt-3.5-turbo and gpt-4.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 def count_tokens_for_text(
     prompt_text: str, model: str = "text-embedding-ada-002"
 ) -> int:
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-
-    tokens_arr = encoding.encode(prompt_text)
+    # user text can contain special tokens like <|endoftext|>, counted as plain text
+    tokens_arr = encoding_for_model(model).encode(
+        prompt_text or "", disallowed_special=()
+    )
 
     return len(tokens_arr)
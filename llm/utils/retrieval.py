@@ -0,0 +1,548 @@
+import os
+import time
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+from django.db import connection, transaction
+from django.db.models import Q
+from pgvector.django import L2Distance, CosineDistance, MaxInnerProduct
+from pgvector.utils import to_db
+
+from llm.models import Organization, Embedding, KnowledgeCategory
+from llm.utils import faiss_store, snapshot_store
+from llm.utils.answer_cache import invalidate_answers
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# organization.retrieval_distance -> pgvector operator, each backed by its own hnsw index
+# (see sync_vector_indexes)
+DISTANCE_FUNCTIONS = {
+    "l2": L2Distance,
+    "cosine": CosineDistance,
+    "inner_product": MaxInnerProduct,
+}
+# the same operators in sql, for the hybrid query
+DISTANCE_OPERATORS = {
+    "l2": "<->",
+    "cosine": "<=>",
+    "inner_product": "<#>",
+}
+
+# hybrid retrieval: chunks taken from each of the vector and full-text
+# rankings before fusing them, and the k of reciprocal rank fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 40))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+
+# half and binary precision: chunks taken from the compact index to be
+# re-ranked at full precision, unless the org sets retrieval_rerank_candidates
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 100))
+
+# pgvector only accepts hnsw.ef_search up to this, which bounds every count
+# of rows an hnsw scan is asked for
+MAX_EF_SEARCH = 1000
+
+# see pgvector_version
+_pgvector_version = None
+
+# the hnsw indexes besides the full precision l2 one of the model, each only
+# built while an org searches with it (see sync_vector_indexes): distance ->
+# index name part, full and half precision operator classes. binary is
+# compared by hamming distance whatever the org's distance.
+VECTOR_INDEX_OPCLASSES = {
+    "l2": ("l2", "vector_l2_ops", "halfvec_l2_ops"),
+    "cosine": ("cosine", "vector_cosine_ops", "halfvec_cosine_ops"),
+    "inner_product": ("ip", "vector_ip_ops", "halfvec_ip_ops"),
+}
+VECTOR_INDEX_PARAMS = "WITH (m = 16, ef_construction = 64)"
+# pg_advisory_lock key, one index sync at a time across workers
+VECTOR_INDEX_LOCK = 27
+VECTOR_INDEX_LOCK_POLL_INTERVAL = 1
+
+
+def retrieve_embeddings(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    knowledge_cat: Union[KnowledgeCategory, None] = None,
+    question: Union[str, None] = None,
+) -> list[Embedding]:
+    """
+    Fetch the org's top k chunks nearest to the prompt, nearest first,
+    from the retrieval backend configured for the org. The hybrid backend
+    also matches the words of the question, when it is in english (None
+    otherwise), its english stemming is meaningless on other languages.
+    """
+    via = organization.retrieval_backend
+    if organization.retrieval_backend == "faiss":
+        embedding_results = faiss_embeddings(
+            organization, prompt_embeddings, knowledge_cat
+        )
+    elif organization.retrieval_backend == "snapshot":
+        embedding_results = snapshot_embeddings(
+            organization, prompt_embeddings, knowledge_cat
+        )
+    elif organization.retrieval_backend == "hybrid" and question:
+        embedding_results = hybrid_embeddings(
+            organization, prompt_embeddings, question, knowledge_cat
+        )
+    elif organization.retrieval_precision in ("half", "binary"):
+        embedding_results = compact_embeddings(
+            organization, prompt_embeddings, knowledge_cat
+        )
+        via = f"pgvector at {organization.retrieval_precision} precision"
+    else:
+        embedding_results = pgvector_embeddings(
+            organization, prompt_embeddings, knowledge_cat
+        )
+        via = "pgvector"
+
+    embedding_results = collapse_duplicates(embedding_results)
+
+    logger.info(
+        f"retrieved top {len(embedding_results)}/{organization.retrieval_top_k} chunks by {organization.retrieval_distance} distance via {via}"
+    )
+
+    return embedding_results
+
+
+def collapse_duplicates(embedding_results: list[Embedding]) -> list[Embedding]:
+    """
+    The same text uploaded in several documents only makes it into the context
+    once, at its best rank
+    """
+    seen = set()
+    unique_embeddings = []
+    for embedding in embedding_results:
+        key = embedding.content_hash or embedding.original_text
+        if key not in seen:
+            seen.add(key)
+            unique_embeddings.append(embedding)
+    return unique_embeddings
+
+
+def pgvector_embeddings(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    knowledge_cat: Union[KnowledgeCategory, None] = None,
+) -> list[Embedding]:
+    """
+    The ORDER BY distance + LIMIT shape is what lets postgres use the ANN index
+    instead of sorting every row in scope
+    """
+    distance = DISTANCE_FUNCTIONS[organization.retrieval_distance]
+
+    embedding_results_query = Embedding.objects.filter(organization=organization)
+
+    if knowledge_cat:
+        embedding_results_query = embedding_results_query.filter(
+            file__knowledge_category=knowledge_cat
+        )
+
+    embedding_results_query = embedding_results_query.defer("text_vectors").order_by(
+        distance("text_vectors", prompt_embeddings)
+    )[: organization.retrieval_top_k]
+
+    with transaction.atomic():
+        set_index_params(organization, min_ef_search=organization.retrieval_top_k)
+        embedding_results = list(embedding_results_query)
+        if len(
+            embedding_results
+        ) < organization.retrieval_top_k and pgvector_version() < (0, 8):
+            # the index scan ran out of rows passing the org and category
+            # filters, which happens when the scope is a small part of the
+            # table, so the scope is searched exactly instead
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('enable_indexscan', 'off', true)")
+            embedding_results = list(embedding_results_query.all())
+        return embedding_results
+
+
+def pgvector_version() -> tuple:
+    """
+    (major, minor) of the installed pgvector, read once per worker
+    """
+    global _pgvector_version
+    if _pgvector_version is None:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+            )
+            _pgvector_version = tuple(
+                int(part) for part in cursor.fetchone()[0].split(".")[:2]
+            )
+    return _pgvector_version
+
+
+def set_index_params(organization: Organization, min_ef_search: int = 0) -> None:
+    """
+    Apply the org's ANN index params to the current transaction. SET LOCAL only
+    lives until the end of the transaction, so the params never leak into other
+    queries on a pooled connection. An hnsw scan returns at most ef_search
+    rows, queries wanting more pass min_ef_search. From pgvector 0.8 the scan
+    goes on until enough rows pass the org and category filters, in order.
+    """
+    with connection.cursor() as cursor:
+        ef_search = min(
+            max(organization.retrieval_ef_search or 0, min_ef_search), MAX_EF_SEARCH
+        )
+        if ef_search:
+            cursor.execute(
+                "SELECT set_config('hnsw.ef_search', %s, true)",
+                [str(ef_search)],
+            )
+        if pgvector_version() >= (0, 8):
+            cursor.execute(
+                "SELECT set_config('hnsw.iterative_scan', 'strict_order', true)"
+            )
+        if organization.retrieval_probes:
+            cursor.execute(
+                "SELECT set_config('ivfflat.probes', %s, true)",
+                [str(organization.retrieval_probes)],
+            )
+
+
+def compact_embeddings(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    knowledge_cat: Union[KnowledgeCategory, None] = None,
+) -> list[Embedding]:
+    """
+    Two stage search: the nearest candidates on the half precision (or
+    binary, by hamming distance) hnsw index, which is a fraction of the size
+    of the full precision one, then only those candidates are re-ranked by
+    the exact distance of their full precision vectors
+    """
+    dimensions = Embedding._meta.get_field("text_vectors").dimensions
+    operator = DISTANCE_OPERATORS[organization.retrieval_distance]
+
+    # must match the expressions of vector_index
+    if organization.retrieval_precision == "binary":
+        compact_distance = f"binary_quantize(embedding.text_vectors)::bit({dimensions}) <~> binary_quantize(%(vector)s::vector)"
+    else:
+        compact_distance = f"embedding.text_vectors::halfvec({dimensions}) {operator} %(vector)s::halfvec({dimensions})"
+
+    scope = "embedding.organization_id = %(organization_id)s"
+    if knowledge_cat:
+        scope += " AND embedding.file_id IN (SELECT id FROM files WHERE knowledge_category_id = %(category_id)s)"
+
+    columns = ", ".join(
+        f"embedding.{field.column}"
+        for field in Embedding._meta.concrete_fields
+        if field.name != "text_vectors"
+    )
+
+    # the full precision distance is only computed for the rows the limit lets through
+    sql = f"""
+        SELECT *
+        FROM (
+            SELECT {columns}, embedding.text_vectors {operator} %(vector)s::vector AS distance
+            FROM embedding
+            WHERE {scope}
+            ORDER BY {compact_distance}
+            LIMIT %(candidates)s
+        ) candidates
+        ORDER BY distance, id
+        LIMIT %(top_k)s
+    """
+    candidates = max(
+        organization.retrieval_rerank_candidates or RERANK_CANDIDATES,
+        organization.retrieval_top_k,
+    )
+    params = {
+        "organization_id": organization.id,
+        "category_id": knowledge_cat.id if knowledge_cat else None,
+        "vector": to_db(prompt_embeddings),
+        "candidates": candidates,
+        "top_k": organization.retrieval_top_k,
+    }
+
+    with transaction.atomic():
+        set_index_params(organization, min_ef_search=candidates)
+        return list(Embedding.objects.raw(sql, params))
+
+
+def vector_index(precision: str, distance: str) -> tuple[str, str]:
+    """
+    Name and hnsw definition of the index searched at an org's precision and
+    distance. The compact ones are expression indexes on the stored vectors,
+    postgres computes the compact vectors of the existing rows while building
+    them and of new rows on insert, so there is nothing to backfill.
+    """
+    dimensions = Embedding._meta.get_field("text_vectors").dimensions
+    if precision == "binary":
+        return (
+            "embedding_vectors_binary_idx",
+            f"(binary_quantize(text_vectors)::bit({dimensions})) bit_hamming_ops",
+        )
+    short_name, full_opclass, half_opclass = VECTOR_INDEX_OPCLASSES[distance]
+    if precision == "full":
+        return f"embedding_vectors_{short_name}_idx", f"text_vectors {full_opclass}"
+    return (
+        f"embedding_vectors_{short_name}_halfvec_idx",
+        f"(text_vectors::halfvec({dimensions})) {half_opclass}",
+    )
+
+
+def _wanted_vector_indexes() -> set[tuple[str, str]]:
+    """
+    The vector indexes some org searches with
+    """
+    organizations = Organization.objects.exclude(retrieval_backend="faiss")
+    # hybrid and the pgvector fallback of snapshot search at full precision,
+    # and hybrid falls back to the pgvector search for untranslated questions
+    full_distances = (
+        organizations.filter(
+            Q(retrieval_precision="full") | ~Q(retrieval_backend="pgvector")
+        )
+        .values_list("retrieval_distance", flat=True)
+        .distinct()
+    )
+    compact_precisions = (
+        organizations.filter(
+            retrieval_precision__in=("half", "binary"),
+            retrieval_backend__in=("pgvector", "hybrid"),
+        )
+        .values_list("retrieval_precision", "retrieval_distance")
+        .distinct()
+    )
+    return {vector_index("full", distance) for distance in full_distances} | {
+        vector_index(precision, distance) for precision, distance in compact_precisions
+    }
+
+
+def sync_vector_indexes() -> None:
+    """
+    Build the vector indexes of the precisions and distances the orgs search
+    with, and drop the ones nobody uses anymore, every index takes memory and
+    slows down each insert. The full precision l2 index, of the default
+    distance, is part of the model and always kept. CONCURRENTLY keeps the
+    embedding table writable during a build, which takes minutes on a large
+    table, and cannot run inside a transaction. Until its index is built, an
+    org's search scans its rows instead.
+    """
+    managed = {vector_index("binary", None)} | {
+        vector_index(precision, distance)
+        for precision in ("full", "half")
+        for distance in VECTOR_INDEX_OPCLASSES
+    }
+    managed.discard(vector_index("full", "l2"))
+    table = Embedding._meta.db_table
+
+    with connection.cursor() as cursor:
+        # a session waiting in pg_advisory_lock is inside a transaction, which
+        # CREATE INDEX CONCURRENTLY waits for, so the waiters poll instead
+        while True:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [VECTOR_INDEX_LOCK])
+            if cursor.fetchone()[0]:
+                break
+            time.sleep(VECTOR_INDEX_LOCK_POLL_INTERVAL)
+        try:
+            # read once the lock is held, so the last sync sees the last change
+            wanted = _wanted_vector_indexes()
+            cursor.execute(
+                """
+                SELECT index_class.relname, pg_index.indisvalid
+                FROM pg_index
+                JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+                WHERE pg_index.indrelid = %s::regclass
+                """,
+                [table],
+            )
+            existing = dict(cursor.fetchall())
+
+            for name, definition in sorted(managed):
+                # an interrupted concurrent build leaves an invalid index behind
+                if name in existing and (
+                    (name, definition) not in wanted or not existing[name]
+                ):
+                    logger.info(f"dropping vector index {name}")
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                    existing.pop(name)
+                if (name, definition) in wanted and name not in existing:
+                    logger.info(f"building vector index {name}")
+                    cursor.execute(
+                        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING hnsw ({definition}) {VECTOR_INDEX_PARAMS}"
+                    )
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [VECTOR_INDEX_LOCK])
+
+
+def hybrid_embeddings(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    question: str,
+    knowledge_cat: Union[KnowledgeCategory, None] = None,
+) -> list[Embedding]:
+    """
+    Candidates from the ANN index and from the full-text index on
+    search_vector, fused with reciprocal rank fusion, in one query. A chunk
+    scores 1 / (HYBRID_RRF_K + rank) for each ranking it is in, so exact
+    keyword matches (drug names, scheme names) make it in even when their
+    vectors are not among the nearest.
+    """
+    scope = "embedding.organization_id = %(organization_id)s"
+    if knowledge_cat:
+        scope += " AND embedding.file_id IN (SELECT id FROM files WHERE knowledge_category_id = %(category_id)s)"
+
+    # every field but the vectors, like the other backends
+    columns = ", ".join(
+        f"embedding.{field.column}"
+        for field in Embedding._meta.concrete_fields
+        if field.name != "text_vectors"
+    )
+    operator = DISTANCE_OPERATORS[organization.retrieval_distance]
+
+    # plainto_tsquery ands the words of the question, or-ing them lets chunks
+    # match some of them and ts_rank_cd ranks the ones matching more first
+    sql = f"""
+        WITH vector_candidates AS (
+            SELECT id, row_number() OVER (ORDER BY distance) AS rank
+            FROM (
+                SELECT embedding.id, embedding.text_vectors {operator} %(vector)s::vector AS distance
+                FROM embedding
+                WHERE {scope}
+                ORDER BY distance
+                LIMIT %(candidates)s
+            ) nearest
+        ),
+        lexical_candidates AS (
+            SELECT id, row_number() OVER (ORDER BY score DESC) AS rank
+            FROM (
+                SELECT embedding.id, ts_rank_cd(embedding.search_vector, query) AS score
+                FROM embedding, (
+                    SELECT replace(plainto_tsquery('english', %(question)s)::text, ' & ', ' | ')::tsquery AS query
+                ) question
+                WHERE {scope} AND embedding.search_vector @@ query
+                ORDER BY score DESC
+                LIMIT %(candidates)s
+            ) matches
+        ),
+        fused AS (
+            SELECT
+                coalesce(vector_candidates.id, lexical_candidates.id) AS id,
+                coalesce(1.0 / (%(rrf_k)s + vector_candidates.rank), 0)
+                    + coalesce(1.0 / (%(rrf_k)s + lexical_candidates.rank), 0) AS hybrid_score
+            FROM vector_candidates
+            FULL OUTER JOIN lexical_candidates ON vector_candidates.id = lexical_candidates.id
+        )
+        SELECT {columns}, fused.hybrid_score
+        FROM fused JOIN embedding ON embedding.id = fused.id
+        ORDER BY fused.hybrid_score DESC, embedding.id
+        LIMIT %(top_k)s
+    """
+    params = {
+        "organization_id": organization.id,
+        "category_id": knowledge_cat.id if knowledge_cat else None,
+        "vector": to_db(prompt_embeddings),
+        "question": question,
+        "candidates": max(HYBRID_CANDIDATES, organization.retrieval_top_k),
+        "rrf_k": HYBRID_RRF_K,
+        "top_k": organization.retrieval_top_k,
+    }
+
+    with transaction.atomic():
+        # the vector leg wants more rows than the default ef_search may give
+        set_index_params(organization, min_ef_search=params["candidates"])
+        return list(Embedding.objects.raw(sql, params))
+
+
+def faiss_embeddings(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    knowledge_cat: Union[KnowledgeCategory, None] = None,
+) -> list[Embedding]:
+    """
+    Vector search happens in the worker's faiss index, postgres only
+    fetches the k winning rows by primary key
+    """
+    embedding_ids = faiss_store.search(
+        organization.id,
+        knowledge_cat.id if knowledge_cat else None,
+        organization.retrieval_distance,
+        prompt_embeddings,
+        organization.retrieval_top_k,
+    )
+
+    embeddings_by_id = Embedding.objects.defer("text_vectors").in_bulk(embedding_ids)
+
+    return [
+        embeddings_by_id[embedding_id]
+        for embedding_id in embedding_ids
+        if embedding_id in embeddings_by_id
+    ]
+
+
+def snapshot_embeddings(
+    organization: Organization,
+    prompt_embeddings: list[float],
+    knowledge_cat: Union[KnowledgeCategory, None] = None,
+) -> list[Embedding]:
+    """
+    Vector search is a matrix-vector product over the memory mapped snapshot
+    of the category (or org), postgres only fetches the k winning rows by
+    primary key. Scopes too large for a snapshot fall back to pgvector.
+    """
+    embedding_ids = snapshot_store.search(
+        organization.id,
+        knowledge_cat.id if knowledge_cat else None,
+        organization.retrieval_distance,
+        prompt_embeddings,
+        organization.retrieval_top_k,
+    )
+    if embedding_ids is None:
+        return pgvector_embeddings(organization, prompt_embeddings, knowledge_cat)
+
+    embeddings_by_id = Embedding.objects.defer("text_vectors").in_bulk(embedding_ids)
+
+    return [
+        embeddings_by_id[embedding_id]
+        for embedding_id in embedding_ids
+        if embedding_id in embeddings_by_id
+    ]
+
+
+def embeddings_added(
+    organization: Organization,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    embeddings: list[Embedding],
+) -> None:
+    """
+    Call after storing new embeddings so in-process indexes and cached answers stay in sync
+    """
+    invalidate_answers(organization, knowledge_cat)
+    faiss_store.add_embeddings(
+        organization.id, knowledge_cat.id if knowledge_cat else None, embeddings
+    )
+    snapshot_store.refresh_scopes(
+        organization.id, knowledge_cat.id if knowledge_cat else None
+    )
+
+
+def embeddings_removed(
+    organization: Organization,
+    knowledge_cat: Union[KnowledgeCategory, None],
+    embedding_ids: list[int],
+) -> None:
+    """
+    Call after deleting embeddings so in-process indexes and cached answers stay in sync
+    """
+    invalidate_answers(organization, knowledge_cat)
+    faiss_store.remove_embeddings(
+        organization.id, knowledge_cat.id if knowledge_cat else None, embedding_ids
+    )
+    snapshot_store.refresh_scopes(
+        organization.id, knowledge_cat.id if knowledge_cat else None
+    )
+
+
+def knowledge_category_deleted(
+    organization: Organization,
+    category_id: int,
+    embedding_ids: list[int],
+) -> None:
+    """
+    Takes the id saved before the delete, Django sets the deleted instance's id to None
+    """
+    embeddings_removed(organization, None, embedding_ids)
+    faiss_store.drop_category(organization.id, category_id)
+    snapshot_store.drop_category(organization.id, category_id)
@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+import numpy as np
+from django.conf import settings
+
+from llm.models import Embedding
+from llm.utils.general import run_in_background
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+EMBEDDING_DIMENSIONS = 1536
+
+# shared by every worker on the host, the snapshots are read through the page cache
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(settings.BASE_DIR, "snapshots"))
+# scopes with more chunks than this are searched with pgvector instead
+SNAPSHOT_MAX_ROWS = int(os.getenv("SNAPSHOT_MAX_ROWS", 50000))
+# how often (seconds) a worker checks a snapshot against the db, for changes
+# made on other hosts
+SNAPSHOT_SYNC_INTERVAL = int(os.getenv("SNAPSHOT_SYNC_INTERVAL", 30))
+
+EXPORT_BATCH_SIZE = 2000
+
+
+def scope_dir(organization_id: int, category_id: Union[int, None]) -> str:
+    return os.path.join(
+        SNAPSHOT_DIR,
+        str(organization_id),
+        "all" if category_id is None else str(category_id),
+    )
+
+
+def scope_query(organization_id: int, category_id: Union[int, None]):
+    query = Embedding.objects.filter(organization_id=organization_id).exclude(
+        text_vectors__isnull=True
+    )
+    if category_id is not None:
+        query = query.filter(file__knowledge_category_id=category_id)
+    return query
+
+
+def scope_state(organization_id: int, category_id: Union[int, None]) -> dict:
+    """
+    Row count and highest id of the scope in the db, a snapshot with other
+    values is stale
+    """
+    return {
+        "rows": scope_query(organization_id, category_id).count(),
+        "max_id": scope_query(organization_id, category_id)
+        .order_by("-id")
+        .values_list("id", flat=True)
+        .first()
+        or 0,
+    }
+
+
+def export(organization_id: int, category_id: Union[int, None]) -> bool:
+    """
+    Writes the scope's vectors to a new snapshot directory and points the
+    scope's "current" symlink to it with a rename, so readers see either the
+    old snapshot or the new one. Exports of a scope are serialized by a file
+    lock and read the db once they hold it, so the last one to finish has the
+    latest rows, and the ones finding the current snapshot up to date skip
+    the work. Returns False, and removes the snapshot, when the scope is too
+    large.
+    """
+    directory = scope_dir(organization_id, category_id)
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, "lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        start = time.time()
+
+        state = scope_state(organization_id, category_id)
+        if state["rows"] > SNAPSHOT_MAX_ROWS:
+            logger.info(
+                f"org {organization_id} category {category_id} has {state['rows']} chunks, too many for a snapshot"
+            )
+            _remove_versions(directory, keep=None)
+            return False
+        if current_meta(directory) == state:
+            return True
+
+        ids, num_tokens, batches, batch = [], [], [], []
+        for embedding_id, text_vectors, tokens in (
+            scope_query(organization_id, category_id)
+            .order_by("id")
+            .values_list("id", "text_vectors", "num_tokens")
+            .iterator(chunk_size=EXPORT_BATCH_SIZE)
+        ):
+            ids.append(embedding_id)
+            num_tokens.append(tokens)
+            batch.append(text_vectors)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                batches.append(np.asarray(batch, dtype=np.float32))
+                batch = []
+        batches.append(np.asarray(batch, dtype=np.float32))
+        vectors = np.concatenate(
+            [batch.reshape(-1, EMBEDDING_DIMENSIONS) for batch in batches]
+        )
+
+        version = f"v{time.time_ns()}"
+        version_dir = os.path.join(directory, version)
+        os.makedirs(version_dir)
+        arrays = {
+            "vectors": vectors,
+            "norms": np.linalg.norm(vectors, axis=1).astype(np.float32),
+            "ids": np.asarray(ids, dtype=np.int64),
+            "num_tokens": np.asarray(num_tokens, dtype=np.int32),
+        }
+        for name, array in arrays.items():
+            with open(os.path.join(version_dir, f"{name}.npy"), "wb") as file:
+                np.save(file, np.ascontiguousarray(array))
+                file.flush()
+                os.fsync(file.fileno())
+        with open(os.path.join(version_dir, "meta.json"), "w") as file:
+            json.dump({"rows": len(ids), "max_id": max(ids, default=0)}, file)
+
+        link = os.path.join(directory, f"current.{version}")
+        os.symlink(version, link)
+        os.replace(link, os.path.join(directory, "current"))
+        # workers still mapping an older version keep reading it until they
+        # reload, the files are only freed once unmapped
+        _remove_versions(directory, keep=version)
+
+        logger.info(
+            f"exported snapshot of org {organization_id} category {category_id} with {len(ids)} vectors in {time.time() - start:.2f}s"
+        )
+        return True
+
+
+def current_meta(directory: str) -> Union[dict, None]:
+    try:
+        with open(os.path.join(directory, "current", "meta.json")) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _remove_versions(directory: str, keep: Union[str, None]) -> None:
+    if keep is None and os.path.lexists(os.path.join(directory, "current")):
+        os.remove(os.path.join(directory, "current"))
+    for name in os.listdir(directory):
+        if name.startswith("v") and name != keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+class Snapshot:
+    """
+    Read-only memory map of the current snapshot of one org, or of one
+    knowledge category of that org. Row i of the vectors is the Embedding
+    with id ids[i].
+    """
+
+    def __init__(self, organization_id: int, category_id: Union[int, None]):
+        self.organization_id = organization_id
+        self.category_id = category_id
+        self.directory = scope_dir(organization_id, category_id)
+        self.lock = threading.Lock()
+        self.version = None
+        self.arrays = None
+        self.checked_at = 0.0
+        # an export of the scope is running in the background
+        self.exporting = False
+
+    def _current_version(self) -> Union[str, None]:
+        try:
+            return os.readlink(os.path.join(self.directory, "current"))
+        except FileNotFoundError:
+            return None
+
+    def _load(self, version: str) -> None:
+        version_dir = os.path.join(self.directory, version)
+        self.arrays = {
+            name: np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r")
+            for name in ("vectors", "norms", "ids", "num_tokens")
+        }
+        self.version = version
+
+    def _export(self) -> None:
+        try:
+            export(self.organization_id, self.category_id)
+        finally:
+            with self.lock:
+                self.exporting = False
+
+    def _refresh(self) -> bool:
+        """
+        Maps the latest snapshot, and exports one in the background if there
+        is none or the db may have changed since it was taken. The mapped
+        snapshot keeps being searched until the export switches "current".
+        False when the scope has no snapshot (yet, or because it is too large).
+        """
+        version = self._current_version()
+        if self.version is None and version is not None:
+            # exported by this or another worker, checked at the next interval
+            self.checked_at = time.time()
+        if (
+            time.time() - self.checked_at > SNAPSHOT_SYNC_INTERVAL
+            and not self.exporting
+        ):
+            self.checked_at = time.time()
+            self.exporting = True
+            run_in_background(self._export)
+
+        if version is None:
+            self.version = self.arrays = None
+            return False
+        if version != self.version:
+            try:
+                self._load(version)
+            except FileNotFoundError:
+                # replaced by a newer export, which is mapped at the next
+                # search, or removed because the scope grew too large
+                if self._current_version() is None:
+                    self.version = self.arrays = None
+                    return False
+                return self.arrays is not None
+        return True
+
+    def search(
+        self, prompt_embeddings: list[float], distance: str, top_k: int
+    ) -> Union[list[int], None]:
+        """
+        Ids of the top k nearest embeddings, nearest first, or None when the
+        scope has no snapshot
+        """
+        with self.lock:
+            if not self._refresh():
+                return None
+            vectors, norms, ids = (
+                self.arrays["vectors"],
+                self.arrays["norms"],
+                self.arrays["ids"],
+            )
+
+        if not len(ids):
+            return []
+
+        query = np.asarray(prompt_embeddings, dtype=np.float32)
+        products = vectors @ query
+        # smaller is nearer, the terms that are the same for every row are left out
+        if distance == "l2":
+            scores = norms * norms - 2 * products
+        elif distance == "cosine":
+            scores = -products / np.maximum(norms, np.finfo(np.float32).tiny)
+        else:
+            scores = -products
+
+        top_k = min(top_k, len(ids))
+        nearest = np.argpartition(scores, top_k - 1)[:top_k]
+        nearest = nearest[np.argsort(scores[nearest], kind="stable")]
+        return ids[nearest].tolist()
+
+
+# (organization_id, category_id or None) -> Snapshot
+_snapshots: dict[tuple, Snapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(organization_id: int, category_id: Union[int, None]) -> Snapshot:
+    key = (organization_id, category_id)
+    with _snapshots_lock:
+        if key not in _snapshots:
+            _snapshots[key] = Snapshot(organization_id, category_id)
+        return _snapshots[key]
+
+
+def search(
+    organization_id: int,
+    category_id: Union[int, None],
+    distance: str,
+    prompt_embeddings: list[float],
+    top_k: int,
+) -> Union[list[int], None]:
+    return get_snapshot(organization_id, category_id).search(
+        prompt_embeddings, distance, top_k
+    )
+
+
+def refresh_scopes(organization_id: int, category_id: Union[int, None]) -> None:
+    """
+    Re-export the snapshots of the org and of the category in the background
+    after their chunks changed, searches keep the old snapshot until then.
+    Scopes nobody searched with the snapshot backend have no snapshot and are
+    skipped.
+    """
+    for scope_category_id in {None, category_id}:
+        if os.path.lexists(
+            os.path.join(scope_dir(organization_id, scope_category_id), "current")
+        ):
+            run_in_background(export, organization_id, scope_category_id)
+
+
+def drop_category(organization_id: int, category_id: int) -> None:
+    with _snapshots_lock:
+        _snapshots.pop((organization_id, category_id), None)
+    shutil.rmtree(scope_dir(organization_id, category_id), ignore_errors=True)
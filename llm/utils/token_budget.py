@@ -0,0 +1,213 @@
+import os
+import json
+from typing import Union
+from logging import basicConfig, INFO, getLogger
+
+from llm.models import Organization, Embedding, Message
+from llm.utils.prompt import (
+    context_prompt_messages,
+    count_tokens_for_text,
+    encoding_for_model,
+)
+
+basicConfig(level=INFO)
+logger = getLogger()
+
+# context window of each model in tokens, dated versions (gpt-4-0613) match
+# their family by prefix, the longest prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    # e.g. MODEL_CONTEXT_WINDOWS='{"gpt-3.5-turbo": 16385}' once the alias moves
+    **json.loads(os.getenv("MODEL_CONTEXT_WINDOWS", "{}")),
+}
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", 4096))
+# tokens left free for the answer, the rest of the window is the prompt's
+COMPLETION_TOKENS = int(os.getenv("COMPLETION_TOKENS", 1000))
+
+# the encoder llm.utils.chunking counts Embedding.num_tokens with
+CHUNK_ENCODING_MODEL = "gpt-3.5-turbo"
+
+# every message is wrapped in <|start|>{role}<|message|>{content}<|end|> and
+# the reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def model_family(gpt_model: str) -> str:
+    """
+    The MODEL_CONTEXT_WINDOWS entry of the model, "other" for unknown models.
+    Also the model label of the metrics, which must not take any client input.
+    """
+    prefixes = [model for model in MODEL_CONTEXT_WINDOWS if gpt_model.startswith(model)]
+    if not prefixes:
+        return "other"
+    return max(prefixes, key=len)
+
+
+def context_window(gpt_model: str) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model_family(gpt_model), DEFAULT_CONTEXT_WINDOW)
+
+
+def count_message_tokens(messages: list[dict], gpt_model: str) -> int:
+    """
+    Prompt tokens openai bills for the chat messages
+    """
+    encoding = encoding_for_model(gpt_model)
+    token_count = TOKENS_PER_REPLY
+    for message in messages:
+        token_count += TOKENS_PER_MESSAGE
+        for value in message.values():
+            token_count += len(encoding.encode(value or "", disallowed_special=()))
+    return token_count
+
+
+def fixed_prompt_fits(
+    gpt_model: str,
+    system_prompt: Union[str, None],
+    organization: Organization,
+    question: str,
+) -> bool:
+    """
+    Whether the prompt fits the model's context window without any context or
+    history, checked before the paid calls of a chat. The question is the
+    user's, its english translation is not known yet.
+    """
+    messages = context_prompt_messages(
+        system_prompt, organization, "English", "", question, []
+    )
+    return (
+        count_message_tokens(messages, gpt_model)
+        <= context_window(gpt_model) - COMPLETION_TOKENS
+    )
+
+
+def build_prompt(
+    gpt_model: str,
+    system_prompt: Union[str, None],
+    organization: Organization,
+    language: str,
+    embedding_results: list[Embedding],
+    question: str,
+    historical_chats: list[Message],
+    history_summary: Union[str, None] = None,
+) -> tuple[list[dict], list[Embedding], dict]:
+    """
+    The chat messages with as many of the candidate chunks, in their given
+    order, as fit in the model's context window once the system prompt,
+    examples, history, question and COMPLETION_TOKENS are counted. The oldest
+    turns of the history are left out when the rest does not fit otherwise.
+    Returns the messages, the chunks used and the token breakdown of the
+    prompt. ValueError when even the prompt without history is too long.
+    """
+
+    def messages_with(english_context: str) -> list[dict]:
+        return context_prompt_messages(
+            system_prompt,
+            organization,
+            language,
+            english_context,
+            question,
+            historical_chats,
+            history_summary,
+        )
+
+    window = context_window(gpt_model)
+    prompt_budget = window - COMPLETION_TOKENS
+    fixed_tokens = count_message_tokens(messages_with(""), gpt_model)
+
+    # the oldest turns are left out until the rest fits, each turn is a
+    # message of its own, worth the same tokens wherever it is
+    history_trimmed = 0
+    if fixed_tokens > prompt_budget:
+        historical_chats = list(historical_chats)
+        # starting on a question, not on the answer to one that was cut off
+        while historical_chats and (
+            fixed_tokens > prompt_budget or historical_chats[0].role != "user"
+        ):
+            chat = historical_chats.pop(0)
+            fixed_tokens -= (
+                count_message_tokens(
+                    [{"role": chat.role, "content": chat.message}], gpt_model
+                )
+                - TOKENS_PER_REPLY
+            )
+            history_trimmed += 1
+        logger.warning(
+            f"left the oldest {history_trimmed} history messages out of the prompt for {gpt_model}"
+        )
+    if fixed_tokens > prompt_budget:
+        raise ValueError(
+            f"the prompt without context or history is {fixed_tokens} tokens, over the {prompt_budget} token budget of {gpt_model}"
+        )
+
+    # the chunker counted num_tokens with the gpt-3.5-turbo encoder, give or
+    # take a token at the chunk's edges. Other encoders count the chunks again,
+    # tiktoken encodes a batch on several threads.
+    encoding = encoding_for_model(gpt_model)
+    if encoding.name == encoding_for_model(CHUNK_ENCODING_MODEL).name:
+        chunk_tokens = [embedding.num_tokens for embedding in embedding_results]
+    else:
+        chunk_tokens = [
+            len(tokens)
+            for tokens in encoding.encode_batch(
+                [embedding.original_text for embedding in embedding_results],
+                disallowed_special=(),
+            )
+        ]
+
+    final_embeddings: list[Embedding] = []
+    context_tokens = 0
+    for embedding, embedding_tokens in zip(embedding_results, chunk_tokens):
+        if fixed_tokens + context_tokens + embedding_tokens > prompt_budget:
+            break
+        final_embeddings.append(embedding)
+        context_tokens += embedding_tokens
+
+    # chunks encoded together can merge a token at their boundaries, the
+    # count of the assembled prompt is the one that matters
+    while True:
+        messages = messages_with(
+            "".join(embedding.original_text for embedding in final_embeddings)
+        )
+        prompt_tokens = count_message_tokens(messages, gpt_model)
+        if prompt_tokens <= prompt_budget or not final_embeddings:
+            break
+        final_embeddings.pop()
+
+    sections = {
+        "system_prompt": count_tokens_for_text(system_prompt, gpt_model),
+        "history_summary": count_tokens_for_text(history_summary, gpt_model),
+        "history": sum(
+            count_tokens_for_text(chat.message, gpt_model) for chat in historical_chats
+        ),
+        "examples": count_tokens_for_text(organization.examples_text, gpt_model),
+        "question": count_tokens_for_text(question, gpt_model),
+        "context": prompt_tokens - fixed_tokens,
+    }
+    breakdown = {
+        "model": gpt_model,
+        "context_window": window,
+        "completion_reserved": COMPLETION_TOKENS,
+        **sections,
+        # instructions, labels and message framing
+        "template": prompt_tokens - sum(sections.values()),
+        "prompt": prompt_tokens,
+        "chunks_used": len(final_embeddings),
+        "chunks_candidates": len(embedding_results),
+        "history_trimmed": history_trimmed,
+    }
+
+    logger.info(
+        f"Using {len(final_embeddings)}/{len(embedding_results)} relevant docs, prompt is {prompt_tokens}/{prompt_budget} tokens of {gpt_model}: {sections}"
+    )
+
+    return messages, final_embeddings, breakdown